@@ -0,0 +1,724 @@
+'''
+Synthetic benchmark for campus_cluster_update_3_fixing_mpi_errors.py: runs
+the real update (same dependency graph, scheduler, jobserver, build cache)
+against local stand-in repos whose cmake/make/cargo only burn CPU, memory
+and disk, so scheduling changes can be timed on one box instead of ICC.
+'''
+import datetime
+import sys
+import subprocess
+import os
+import shutil
+import json
+import re
+import time
+import tarfile
+import glob
+import sqlite3
+
+update_script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "campus_cluster_update_3_fixing_mpi_errors.py")
+
+# Everything (stand-in repos, fake tools, the update's own top level
+# directory) goes in here, and gets wiped at the start of every benchmark.
+bench_dir = os.path.abspath(os.environ.get("HPIC2_BENCH_DIR", "benchmark"))
+bench_marker = ".hpic2_benchmark"
+
+# Cores the update gets (the first ones of our affinity mask, so no more
+# than there are in it), and the variant matrix it builds, like the lists at
+# the top of the update script.
+bench_cores = min(int(os.environ.get("HPIC2_BENCH_CORES", len(os.sched_getaffinity(0)))), len(os.sched_getaffinity(0)))
+bench_openmp_options = [option == "1" for option in os.environ.get("HPIC2_BENCH_OPENMP", "1").split(",")]
+bench_cuda_arch_options = [None if arch == "None" else int(arch) for arch in os.environ.get("HPIC2_BENCH_CUDA_ARCHS", "None,90").split(",")]
+bench_build_types = os.environ.get("HPIC2_BENCH_BUILD_TYPES", "Release").split(",")
+
+# Packages that get a new upstream commit before every run after the first,
+# like an ordinary day where only some of them moved. Empty means nothing
+# moved, which times the "nothing to do" path.
+bench_changed_packages = [package for package in os.environ.get("HPIC2_BENCH_CHANGED", "hpic2").split(",") if package]
+
+# What the fake build of each package does. configure and install are
+# serial CPU seconds, the build is units compile jobs of unit_seconds CPU
+# each (run as many at a time as make's -j/jobserver allows), each holding
+# memory_mb while it runs and writing its share of write_mb. CUDA variants
+# multiply the CPU seconds by cuda_factor. Roughly in proportion to
+# default_build_minutes in the update script. HPIC2_BENCH_SCALE scales all
+# the seconds, HPIC2_BENCH_PROFILE (json, like {"mfem": {"units": 200}})
+# overrides any of it.
+bench_profiles = {
+    "kokkos": {"configure": 2, "units": 60, "unit_seconds": 0.5, "memory_mb": 200, "write_mb": 60, "install": 0.5, "cuda_factor": 2.5},
+    "hdf5": {"configure": 4, "units": 120, "unit_seconds": 0.3, "memory_mb": 100, "write_mb": 120, "install": 1, "cuda_factor": 1},
+    "hypre": {"configure": 3, "units": 80, "unit_seconds": 0.25, "memory_mb": 100, "write_mb": 60, "install": 0.5, "cuda_factor": 1},
+    "mfem": {"configure": 2, "units": 80, "unit_seconds": 0.4, "memory_mb": 300, "write_mb": 80, "install": 0.5, "cuda_factor": 2},
+    "pumiMBBL": {"configure": 1, "units": 10, "unit_seconds": 0.4, "memory_mb": 200, "write_mb": 10, "install": 0.2, "cuda_factor": 2},
+    "spdlog": {"configure": 1, "units": 10, "unit_seconds": 0.3, "memory_mb": 100, "write_mb": 10, "install": 0.2, "cuda_factor": 1},
+    "metis": {"configure": 0.5, "units": 20, "unit_seconds": 0.1, "memory_mb": 50, "write_mb": 10, "install": 0.2, "cuda_factor": 1},
+    "RustBCA": {"configure": 0, "units": 40, "unit_seconds": 0.4, "memory_mb": 150, "write_mb": 40, "install": 0, "cuda_factor": 1},
+    "hpic2": {"configure": 2, "units": 40, "unit_seconds": 0.5, "memory_mb": 300, "write_mb": 40, "install": 0, "cuda_factor": 2},
+}
+for package, overrides in json.loads(os.environ.get("HPIC2_BENCH_PROFILE", "{}")).items():
+    bench_profiles.setdefault(package, {}).update(overrides)
+bench_scale = float(os.environ.get("HPIC2_BENCH_SCALE", 1))
+
+# Every fake tool run appends a line to this: what it did, when, and the CPU
+# it burnt doing it, which is what the update would have to spend anyway.
+bench_events_path = os.environ.get("HPIC2_BENCH_EVENTS")
+
+# One json line per benchmark, to compare runs before and after a change.
+bench_results_path = os.environ.get("HPIC2_BENCH_RESULTS", "benchmark_results.jsonl")
+bench_label = os.environ.get("HPIC2_BENCH_LABEL", "")
+
+# Stand-in upstream repos (named like upstream_sources) and the files each
+# needs on top of a README.
+bench_repos = {
+    "kokkos": {},
+    "hdf5": {},
+    "hypre": {"src/configure": f"#!/bin/sh\nexec \"{sys.executable}\" \"{os.path.abspath(__file__)}\" fake configure \"$@\"\n"},
+    "spdlog": {},
+    "mfem": {},
+    "pumiMBBL": {},
+    "RustBCA": {"RustBCA.h": "// RustBCA stand-in\n"},
+    "hpic2": {},
+}
+bench_git = ["git", "-c", "user.name=benchmark", "-c", "user.email=benchmark@localhost", "-c", "init.defaultBranch=main"]
+
+# The fake Slurm for update_slurm: sbatch, squeue and sacct keep each job's
+# state in here, and its tasks run right here on bench_cores, all at once.
+bench_slurm_dir = f"{bench_dir}/slurm"
+bench_slurm_tools = ["sbatch", "squeue", "sacct"]
+
+def fake_command(tool):
+    # Shell line running this file as the fake tool.
+    return f"exec \"{sys.executable}\" \"{os.path.abspath(__file__)}\" fake {tool} \"$@\""
+
+def write_executable(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as executable_file:
+        executable_file.write(contents)
+    os.chmod(path, 0o755)
+    return True
+
+def setup_benchmark():
+    # Fresh bench_dir with the fake tools in bin/, the stand-in repos and
+    # the metis tarball in up/, and the update's top level directory top/.
+    if os.path.exists(bench_dir):
+        if not os.path.exists(f"{bench_dir}/{bench_marker}"):
+            raise ValueError(f"{bench_dir} exists and is not a benchmark directory, not deleting it")
+        shutil.rmtree(bench_dir)
+    os.makedirs(f"{bench_dir}/up")
+    # There is a cmake module already, so the update does not download one.
+    os.makedirs(f"{bench_dir}/top/cmake")
+    open(f"{bench_dir}/{bench_marker}", 'w').close()
+
+    for tool in ["cmake", "make"] + bench_slurm_tools:
+        write_executable(f"{bench_dir}/bin/{tool}", f"#!/bin/sh\n{fake_command(tool)}\n")
+    for tool in ["module", "mpicc"]:
+        write_executable(f"{bench_dir}/bin/{tool}", "#!/bin/sh\nexit 0\n")
+    # curl only ever downloads the rustup installer, which sh then runs.
+    write_executable(f"{bench_dir}/bin/curl", f"#!/bin/sh\ncat <<'EOF'\n{fake_command('rustup-init')}\nEOF\n")
+
+    for name, files in bench_repos.items():
+        work_path = f"{bench_dir}/up/{name}.work"
+        subprocess.run(bench_git + ["init", "-q", work_path], check=True)
+        with open(f"{work_path}/README", 'w') as readme_file:
+            readme_file.write(f"{name} stand-in for benchmark_update.py\n")
+        for file_name, contents in files.items():
+            write_executable(f"{work_path}/{file_name}", contents)
+        subprocess.run(bench_git + ["-C", work_path, "add", "-A"], check=True)
+        subprocess.run(bench_git + ["-C", work_path, "commit", "-q", "-m", "stand-in"], check=True)
+        subprocess.run(bench_git + ["clone", "-q", "--bare", work_path, f"{bench_dir}/up/{name}.git"], check=True)
+
+    os.makedirs(f"{bench_dir}/up/metis-5.1.0")
+    with open(f"{bench_dir}/up/metis-5.1.0/README", 'w') as readme_file:
+        readme_file.write("metis stand-in for benchmark_update.py\n")
+    with tarfile.open(f"{bench_dir}/up/metis-5.1.0.tar.gz", "w:gz") as tarball:
+        tarball.add(f"{bench_dir}/up/metis-5.1.0", "metis-5.1.0")
+    shutil.rmtree(f"{bench_dir}/up/metis-5.1.0")
+    return True
+
+def commit_upstream_change(name, run):
+    work_path = f"{bench_dir}/up/{name}.work"
+    with open(f"{work_path}/README", 'a') as readme_file:
+        readme_file.write(f"change for run {run}\n")
+    subprocess.run(bench_git + ["-C", work_path, "commit", "-q", "-a", "-m", f"change for run {run}"], check=True)
+    subprocess.run(bench_git + ["-C", work_path, "push", "-q", f"{bench_dir}/up/{name}.git", "HEAD"], check=True)
+    return True
+
+# The fake tools. They work out which package and build directory they are
+# building from the directory they run in, since that is all the build
+# scripts tell them.
+
+def fake_build_package(path):
+    # (build directory name, package) of a fake tool run in path.
+    parts = path.split(os.sep)
+    for i, part in enumerate(parts):
+        if part.startswith("hpic2-"):
+            return part, "hpic2"
+        if part.startswith(("hpic2deps-", "build_once_modules-")) and i + 1 < len(parts):
+            package = parts[i + 1]
+            if package.endswith("_dev"):
+                package = package[:-len("_dev")]
+            elif package.startswith("metis-"):
+                package = "metis"
+            return part, package
+    return None, None
+
+def fake_job_slots():
+    # How many jobs make would run at once, and the jobserver fds if it has
+    # to get tokens for them, from MAKEFLAGS like run_build_script sets it.
+    jobs = 1
+    jobserver = None
+    for flag in os.environ.get("MAKEFLAGS", "").split():
+        if re.fullmatch(r"-j\d+", flag):
+            jobs = int(flag[2:])
+        elif flag.startswith("--jobserver-auth="):
+            read_fd, write_fd = flag.split("=", 1)[1].split(",")
+            jobserver = (int(read_fd), int(write_fd))
+    if jobserver is None and "CARGO_BUILD_JOBS" in os.environ:
+        jobs = int(os.environ["CARGO_BUILD_JOBS"])
+    return jobs, jobserver
+
+def burn_cpu(seconds, memory_mb=0, write_mb=0, write_path=None):
+    # One compile job: hold memory_mb (touched, so it is really resident),
+    # write write_mb to write_path and spin until seconds of CPU are used.
+    memory = bytearray(int(memory_mb * 1024 * 1024))
+    memory[::4096] = b"\1" * len(range(0, len(memory), 4096))
+    if write_path is not None and write_mb > 0:
+        block = b"\0" * (1024 * 1024)
+        with open(write_path, 'wb') as object_file:
+            for _ in range(int(write_mb)):
+                object_file.write(block)
+            object_file.write(block[:int((write_mb % 1) * len(block))])
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        sum(range(1000))
+    return True
+
+def fake_compile(units, unit_seconds, memory_mb, write_mb):
+    # Run units compile jobs, as many at a time as make would: -jN on its
+    # own, or one for free plus one per jobserver token it can get. Tokens
+    # go back as soon as their job is done, like make does.
+    jobs, jobserver = fake_job_slots()
+    token_fd = None
+    if jobserver is not None:
+        # Our own open of the pipe, so it can be non-blocking without making
+        # everyone else's reads on it non-blocking too.
+        token_fd = os.open(f"/proc/self/fd/{jobserver[0]}", os.O_RDONLY | os.O_NONBLOCK)
+    os.makedirs("objects", exist_ok=True)
+    running = {}
+    next_unit = 0
+    failed = False
+    try:
+        while next_unit < units or running:
+            while next_unit < units and len(running) < jobs:
+                token = b""
+                if running and token_fd is not None:
+                    try:
+                        token = os.read(token_fd, 1)
+                    except BlockingIOError:
+                        break
+                    if not token:
+                        break
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        burn_cpu(unit_seconds, memory_mb, write_mb / units, f"objects/unit{next_unit}.o")
+                    finally:
+                        os._exit(0)
+                running[pid] = token
+                next_unit += 1
+            if next_unit < units and token_fd is not None and len(running) < jobs:
+                # Could use another token, so check for one every now and then.
+                pid, wait_status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    time.sleep(0.02)
+                    continue
+            else:
+                pid, wait_status = os.wait()
+            failed = failed or wait_status != 0
+            token = running.pop(pid)
+            if token:
+                os.write(jobserver[1], token)
+    finally:
+        for token in running.values():
+            if token:
+                os.write(jobserver[1], token)
+        if token_fd is not None:
+            os.close(token_fd)
+    return not failed
+
+def fake_install(package, prefix, dir_name):
+    # Something like what make install leaves behind, with the prefix baked
+    # into a cmake config so relocating a reused build has work to do.
+    for sub_dir in ["lib/cmake", "include", "bin"]:
+        os.makedirs(f"{prefix}/{sub_dir}", exist_ok=True)
+    with open(f"{prefix}/lib/cmake/{package}Config.cmake", 'w') as config_file:
+        config_file.write(f'set({package}_PREFIX "{prefix}")\nset({package}_BUILD_DIR "{dir_name}")\n')
+    with open(f"{prefix}/lib/lib{package}.a", 'wb') as library_file:
+        library_file.write(b"!<arch>\n" + b"\0" * 4096)
+    with open(f"{prefix}/include/{package}.h", 'w') as header_file:
+        header_file.write(f"// {package} stand-in\n")
+    return True
+
+def slurm_job_states():
+    # {job id: {task: state}} of every fake Slurm job.
+    states = {}
+    if not os.path.isdir(bench_slurm_dir):
+        return states
+    for file_name in os.listdir(bench_slurm_dir):
+        if file_name.endswith(".state"):
+            job_id, task = file_name[:-len(".state")].split("_")
+            with open(f"{bench_slurm_dir}/{file_name}") as state_file:
+                states.setdefault(job_id, {})[task] = state_file.read().strip()
+    return states
+
+def set_slurm_state(job_id, task, state):
+    with open(f"{bench_slurm_dir}/{job_id}_{task}.state.tmp", 'w') as state_file:
+        state_file.write(state)
+    os.replace(f"{bench_slurm_dir}/{job_id}_{task}.state.tmp", f"{bench_slurm_dir}/{job_id}_{task}.state")
+    return True
+
+def fake_sbatch(args):
+    # sbatch --parsable script: queue the job, with one task per --array
+    # index (or just task 0), and leave it to fake_slurm_job in the
+    # background.
+    script_path = args[-1]
+    with open(script_path) as script_file:
+        options = dict(line[len("#SBATCH --"):].strip().split("=", 1) for line in script_file if line.startswith("#SBATCH --") and "=" in line)
+    os.makedirs(bench_slurm_dir, exist_ok=True)
+    job_id = str(1000 + len(slurm_job_states()))
+    tasks = options["array"].split(",") if "array" in options else ["0"]
+    for task in tasks:
+        set_slurm_state(job_id, task, "PENDING")
+    with open(f"{bench_slurm_dir}/{job_id}.json", 'w') as job_file:
+        json.dump({"script": script_path, "options": options, "array": "array" in options}, job_file)
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "fake", "slurm_job", job_id], start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    print(job_id)
+    return 0
+
+def fake_slurm_job(job_id):
+    # One fake job: wait for its afterok dependency (and get cancelled if
+    # that fails), then run its tasks. The update script in them is run
+    # through slurm_child, which gets it the benchmark's variant matrix.
+    with open(f"{bench_slurm_dir}/{job_id}.json") as job_file:
+        job = json.load(job_file)
+    tasks = sorted(slurm_job_states()[job_id])
+    after_job_id = job["options"].get("dependency", "").replace("afterok:", "")
+    while after_job_id:
+        after_states = slurm_job_states().get(after_job_id, {}).values()
+        if all(state == "COMPLETED" for state in after_states):
+            break
+        if any(state not in ["PENDING", "RUNNING"] for state in after_states):
+            for task in tasks:
+                set_slurm_state(job_id, task, "CANCELLED")
+            return 0
+        time.sleep(0.2)
+    with open(job["script"]) as script_file:
+        script = script_file.read().replace(f"python3 -u {update_script_path} ", f"\"{sys.executable}\" -u \"{os.path.abspath(__file__)}\" slurm_child ")
+    processes = {}
+    for task in tasks:
+        env = dict(os.environ, SLURM_JOB_ID=job_id)
+        if job["array"]:
+            env["SLURM_ARRAY_TASK_ID"] = task
+        with open(job["options"]["output"].replace("%a", task), 'w') as output_file:
+            processes[task] = subprocess.Popen(["/bin/bash", "-c", script], env=env, stdout=output_file, stderr=subprocess.STDOUT)
+        set_slurm_state(job_id, task, "RUNNING")
+    exit_codes = {task: process.wait() for task, process in processes.items()}
+    # The job is not a child of the update, so its CPU time has to get to
+    # benchmark_run some other way.
+    with open(f"{bench_slurm_dir}/{job_id}.cpu", 'w') as cpu_file:
+        cpu_file.write(str(sum(os.times()[2:4])))
+    for task, exit_code in exit_codes.items():
+        set_slurm_state(job_id, task, "COMPLETED" if exit_code == 0 else "FAILED")
+    return 0
+
+def slurm_jobs_cpu():
+    # CPU seconds of the fake Slurm jobs that finished since the last call.
+    cpu = 0.0
+    for cpu_path in glob.glob(f"{bench_slurm_dir}/*.cpu"):
+        with open(cpu_path) as cpu_file:
+            cpu += float(cpu_file.read())
+        os.remove(cpu_path)
+    return cpu
+
+def fake_squeue(args):
+    # squeue -h -o %i -j ids: the tasks still pending or running, or the
+    # error real squeue gives once it has forgotten about all of them.
+    job_ids = args[args.index("-j") + 1].split(",")
+    states = slurm_job_states()
+    active = [f"{job_id}_{task}" for job_id in job_ids for task, state in states.get(job_id, {}).items() if state in ["PENDING", "RUNNING"]]
+    if not active:
+        print("slurm_load_jobs error: Invalid job id specified", file=sys.stderr)
+        return 1
+    print("\n".join(active))
+    return 0
+
+def fake_sacct(args):
+    # sacct -n -X -P -o State -j ids
+    job_ids = args[args.index("-j") + 1].split(",")
+    states = slurm_job_states()
+    for job_id in job_ids:
+        for state in states.get(job_id, {}).values():
+            print(state)
+    return 0
+
+def fake_tool(tool, args):
+    # Entry point of the fake cmake, configure, make, cargo, rustup and
+    # Slurm commands. Returns the exit code.
+    if tool == "sbatch":
+        return fake_sbatch(args)
+    elif tool == "slurm_job":
+        return fake_slurm_job(args[0])
+    elif tool == "squeue":
+        return fake_squeue(args)
+    elif tool == "sacct":
+        return fake_sacct(args)
+    if tool == "rustup-init":
+        # Sets up CARGO_HOME like rustup would, with cargo being us.
+        cargo_home = os.environ["CARGO_HOME"]
+        os.makedirs(os.environ["RUSTUP_HOME"], exist_ok=True)
+        write_executable(f"{cargo_home}/bin/cargo", f"#!/bin/sh\n{fake_command('cargo')}\n")
+        write_executable(f"{cargo_home}/bin/rustup", "#!/bin/sh\nexit 0\n")
+        with open(f"{cargo_home}/env", 'w') as env_file:
+            env_file.write(f'export PATH="{cargo_home}/bin:$PATH"\n')
+        return 0
+
+    dir_name, package = fake_build_package(os.getcwd())
+    profile = dict(bench_profiles.get(package, {}))
+    seconds_factor = bench_scale
+    if dir_name is not None and "cuda-arch-" in dir_name and "cuda-arch-None" not in dir_name:
+        seconds_factor *= profile.get("cuda_factor", 1)
+    state_path = ".fake_build.json"
+    phase = None
+    parallel = False
+    start = time.time()
+    start_cpu = sum(os.times()[:4])
+
+    if tool in ["cmake", "configure"] or (tool == "make" and args[:1] == ["config"]):
+        phase = "configure"
+        prefix = os.path.abspath("../install")
+        for arg in args:
+            if arg.startswith("-DCMAKE_INSTALL_PREFIX="):
+                prefix = os.path.abspath(arg.split("=", 1)[1])
+            elif arg.startswith("--prefix="):
+                prefix = os.path.abspath(arg.split("=", 1)[1])
+            elif arg.startswith("prefix="):
+                # metis installs into build/<arch>/<prefix>
+                os.makedirs("build/Linux-x86_64", exist_ok=True)
+                prefix = os.path.abspath(f"build/Linux-x86_64/{arg.split('=', 1)[1]}")
+        with open(state_path, 'w') as state_file:
+            json.dump({"prefix": prefix, "args": args}, state_file)
+        burn_cpu(profile.get("configure", 0) * seconds_factor)
+        exit_code = 0
+    elif tool == "make" and args[:1] == ["install"]:
+        phase = "install"
+        if not os.path.exists(state_path):
+            print(f"fake make: nothing configured in {os.getcwd()}", file=sys.stderr)
+            return 2
+        with open(state_path) as state_file:
+            prefix = json.load(state_file)["prefix"]
+        burn_cpu(profile.get("install", 0) * seconds_factor)
+        fake_install(package, prefix, dir_name)
+        if package == "hypre":
+            # hypre also installs into src/hypre, which is what mfem uses.
+            fake_install(package, os.path.abspath("hypre"), dir_name)
+        exit_code = 0
+    elif tool == "make" or (tool == "cargo" and args[:1] == ["build"]):
+        phase = "build"
+        parallel = True
+        exit_code = 0 if fake_compile(int(profile.get("units", 0)), profile.get("unit_seconds", 0) * seconds_factor, profile.get("memory_mb", 0), profile.get("write_mb", 0)) else 1
+        if tool == "cargo":
+            target_dir = os.environ.get("CARGO_TARGET_DIR", "target")
+            os.makedirs(f"{target_dir}/release", exist_ok=True)
+            with open(f"{target_dir}/release/liblibRustBCA.so", 'wb') as library_file:
+                library_file.write(b"\x7fELF" + b"\0" * 4096)
+        elif package == "hpic2":
+            write_executable(f"{os.getcwd()}/hpic2", "#!/bin/sh\necho hpic2 stand-in\n")
+    elif tool == "cargo" and args[:1] == ["vendor"]:
+        vendor_dir = [arg for arg in args[1:] if not arg.startswith("-")]
+        if vendor_dir:
+            os.makedirs(vendor_dir[0], exist_ok=True)
+        exit_code = 0
+    else:
+        print(f"fake {tool}: does not know what to do with {' '.join(args)}", file=sys.stderr)
+        return 2
+
+    if phase is not None and bench_events_path:
+        event = {"dir": dir_name, "package": package, "phase": phase, "start": start, "end": time.time(),
+                 "cpu": sum(os.times()[:4]) - start_cpu, "parallel": parallel}
+        with open(bench_events_path, 'a') as events_file:
+            events_file.write(json.dumps(event) + "\n")
+    return exit_code
+
+def import_update_script():
+    # The update script, set up for the benchmark's variant matrix.
+    sys.path.insert(0, os.path.dirname(update_script_path))
+    import campus_cluster_update_3_fixing_mpi_errors as update_script
+    update_script.openmp_options = bench_openmp_options
+    update_script.cuda_arch_options = bench_cuda_arch_options
+    update_script.build_types_arr = bench_build_types
+    # The fake Slurm is no slower to ask than the fake builds are to run.
+    update_script.slurm_poll_seconds = 1
+    return update_script
+
+def slurm_child(command, run_dir):
+    # What the fake Slurm jobs run instead of the update script's own
+    # slurm_build_once/slurm_task.
+    update_script = import_update_script()
+    return getattr(update_script, command)(run_dir)
+
+def benchmark_child(command):
+    # Runs in its own process for every benchmark run, since the update
+    # script sets itself up (top level directory, cores, today's date) when
+    # it gets imported.
+    os.sched_setaffinity(0, sorted(os.sched_getaffinity(0))[:bench_cores])
+    os.chdir(f"{bench_dir}/top")
+    update_script = import_update_script()
+    start = time.time()
+    start_times = os.times()
+    succeeded = getattr(update_script, command)()
+    end = time.time()
+    end_times = os.times()
+    with open(os.environ["HPIC2_BENCH_RESULT"], 'w') as result_file:
+        json.dump({"start": start, "end": end, "self_cpu": sum(end_times[:2]) - sum(start_times[:2]),
+                   "children_cpu": sum(end_times[2:4]) - sum(start_times[2:4]), "succeeded": bool(succeeded)}, result_file)
+    return True
+
+def run_build_tasks(run_id):
+    # {task name: deps} of the build graphs the update ran, from its timing
+    # database.
+    timing_db_path = f"{bench_dir}/top/builds/build_times.sqlite"
+    if not os.path.exists(timing_db_path):
+        return {}
+    timing_db_connection = sqlite3.connect(timing_db_path, timeout=60)
+    try:
+        rows = timing_db_connection.execute("SELECT name, deps FROM build_tasks WHERE run = ?", (run_id,)).fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    timing_db_connection.close()
+    return {name: json.loads(deps) for name, deps in rows}
+
+def event_task(event, tasks):
+    # Build task a fake tool run belonged to. Variant tasks are named
+    # without the date their build directory has, build-once tasks with it,
+    # hpic2 just by its directory.
+    dir_name = event["dir"] or ""
+    undated_dir_name = re.sub(r"-\d{4}-\d\d-\d\d$", "", dir_name)
+    for name in [f"{dir_name}/{event['package']}", f"{undated_dir_name}/{event['package']}", undated_dir_name]:
+        if name in tasks:
+            return name
+    return f"{dir_name}/{event['package']}"
+
+def ideal_schedule(tasks, events, cores):
+    # Lower bound on the makespan: the longest chain of tasks, each taking
+    # its serial CPU plus its parallel CPU spread over every core, or all
+    # the CPU spread over every core, whichever is longer. Returns the
+    # bound, the chain, and the chain's length.
+    task_seconds = {name: 0.0 for name in tasks}
+    task_deps = dict(tasks)
+    for event in events:
+        name = event_task(event, task_deps)
+        task_deps.setdefault(name, [])
+        task_seconds[name] = task_seconds.get(name, 0.0) + (event["cpu"] / cores if event["parallel"] else event["cpu"])
+    finish = {}
+    def chain_seconds(name):
+        if name not in finish:
+            finish[name] = task_seconds[name] + max((chain_seconds(dep) for dep in task_deps[name] if dep in task_deps), default=0)
+        return finish[name]
+    if not task_deps:
+        return 0.0, [], 0.0
+    chain = [max(task_deps, key=chain_seconds)]
+    while [dep for dep in task_deps[chain[-1]] if dep in task_deps]:
+        chain.append(max((dep for dep in task_deps[chain[-1]] if dep in task_deps), key=chain_seconds))
+    work_seconds = sum(event["cpu"] for event in events) / cores
+    # Tasks that did no work (reused builds, modulefiles) only clutter it.
+    return max(finish[chain[0]], work_seconds), [name for name in chain[::-1] if task_seconds[name] > 0], finish[chain[0]]
+
+def benchmark_run(command, run, days_ago, changed_packages, incremental=False):
+    # One update in a fresh process, days_ago days before today, after
+    # moving changed_packages upstream. Returns its numbers.
+    build_date = (datetime.date.today() - datetime.timedelta(days=days_ago)).strftime("%Y-%m-%d")
+    for name in changed_packages:
+        commit_upstream_change(name, run)
+    run_id = f"benchmark-{run + 1}"
+    events_path = f"{bench_dir}/events-{run + 1}.jsonl"
+    result_path = f"{bench_dir}/result-{run + 1}.json"
+    log_path = f"{bench_dir}/run-{run + 1}.log"
+    env = dict(os.environ,
+               PATH=f"{bench_dir}/bin:{os.environ['PATH']}",
+               HPIC2_SBATCH=f"{bench_dir}/bin/sbatch",
+               HPIC2_SQUEUE=f"{bench_dir}/bin/squeue",
+               HPIC2_SACCT=f"{bench_dir}/bin/sacct",
+               HPIC2_UPSTREAM_BASE=f"file://{bench_dir}/up",
+               HPIC2_BUILD_DATE=build_date,
+               HPIC2_RUN_ID=run_id,
+               HPIC2_BENCH_EVENTS=events_path,
+               HPIC2_BENCH_RESULT=result_path,
+               HPIC2_BENCH_DIR=bench_dir)
+    env.pop("HPIC2_FORCE_UPDATE", None)
+    env.pop("HPIC2_INCREMENTAL", None)
+    if incremental:
+        env["HPIC2_INCREMENTAL"] = "1"
+    # The update's memory caps should go by what the fake builds use, not
+    # by what real ones would.
+    env.setdefault("HPIC2_MEMORY_PER_JOB_GB", ",".join(f"{package}={profile.get('memory_mb', 0) / 1024:g}" for package, profile in bench_profiles.items()))
+    with open(log_path, 'w') as log_file:
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), "child", command], env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    if child.returncode != 0 or not os.path.exists(result_path):
+        print(f"Run {run + 1} failed (exit code {child.returncode}), see {log_path}")
+        return None
+    with open(result_path) as result_file:
+        result = json.load(result_file)
+    events = []
+    if os.path.exists(events_path):
+        with open(events_path) as events_file:
+            events = [json.loads(line) for line in events_file]
+
+    makespan = result["end"] - result["start"]
+    total_cpu = result["self_cpu"] + result["children_cpu"] + slurm_jobs_cpu()
+    work_cpu = sum(event["cpu"] for event in events)
+    lower_bound, chain, chain_seconds = ideal_schedule(run_build_tasks(run_id), events, bench_cores)
+    numbers = {
+        "run": run + 1,
+        "date": build_date,
+        "makespan": makespan,
+        "lower_bound": lower_bound,
+        "critical_path": chain_seconds,
+        "work_cpu": work_cpu,
+        "total_cpu": total_cpu,
+        "orchestrator_cpu": result["self_cpu"],
+        "overhead_cpu": total_cpu - work_cpu,
+        "utilization": total_cpu / max(makespan * bench_cores, 1e-9),
+        "work_utilization": work_cpu / max(makespan * bench_cores, 1e-9),
+        "first_build": min((event["start"] for event in events), default=result["end"]) - result["start"],
+        "after_last_build": result["end"] - max((event["end"] for event in events), default=result["start"]),
+        "builds": len({(event["dir"], event["package"]) for event in events}),
+        "succeeded": result["succeeded"],
+    }
+
+    print(f"Run {run + 1} ({'cold' if run == 0 else 'changed: ' + (', '.join(changed_packages) or 'nothing')}, {build_date}{', incremental' if incremental else ''}), log in {log_path}:")
+    if not result["succeeded"]:
+        print(f"    the update did not build everything, see {log_path}")
+    print(f"    makespan       {makespan:8.1f} s for {numbers['builds']} package builds")
+    if lower_bound > 0:
+        print(f"    lower bound    {lower_bound:8.1f} s ({makespan / lower_bound:.2f}x), critical path {chain_seconds:.1f} s, all the work on {bench_cores} cores {work_cpu / bench_cores:.1f} s")
+    print(f"    cores busy     {numbers['utilization']:8.0%} ({numbers['work_utilization']:.0%} on the builds themselves)")
+    print(f"    overhead       {numbers['overhead_cpu']:8.1f} CPU s (bash, git, copies, fake tool startup), {numbers['orchestrator_cpu']:.1f} of it in the update script itself")
+    if events:
+        print(f"    idle ends      {numbers['first_build']:8.1f} s before the first build, {numbers['after_last_build']:.1f} s after the last")
+    if chain:
+        print(f"    critical path  {' -> '.join(chain)}")
+    return numbers
+
+def benchmark(command, runs):
+    print(f"Benchmarking {command} on {bench_cores} cores in {bench_dir}: openmp {bench_openmp_options}, cuda archs {bench_cuda_arch_options}, build types {bench_build_types}, scale {bench_scale:g}")
+    setup_benchmark()
+    results = []
+    for run in range(runs):
+        results.append(benchmark_run(command, run, runs - 1 - run, bench_changed_packages if run > 0 else []))
+    completed = [numbers for numbers in results if numbers is not None]
+    if len(completed) > 1:
+        print(f"\n    {'run':>4} {'makespan':>9} {'bound':>9} {'ratio':>6} {'busy':>6} {'overhead':>9}")
+        for numbers in completed:
+            ratio = f"{numbers['makespan'] / numbers['lower_bound']:.2f}" if numbers["lower_bound"] > 0 else "-"
+            print(f"    {numbers['run']:>4} {numbers['makespan']:>9.1f} {numbers['lower_bound']:>9.1f} {ratio:>6} {numbers['utilization']:>6.0%} {numbers['overhead_cpu']:>9.1f}")
+    with open(bench_results_path, 'a') as results_file:
+        results_file.write(json.dumps({
+            "label": bench_label,
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "command": command,
+            "cores": bench_cores,
+            "openmp": bench_openmp_options,
+            "cuda_archs": bench_cuda_arch_options,
+            "build_types": bench_build_types,
+            "scale": bench_scale,
+            "changed": bench_changed_packages,
+            "runs": results,
+        }) + "\n")
+    print(f"\nResults appended to {bench_results_path}")
+    return all(numbers is not None for numbers in results)
+
+def build_files(builds_path, before_date):
+    # {path: (inode, mtime, size)} of every file in the builds from before
+    # before_date.
+    files = {}
+    for build_dir_path in glob.glob(f"{builds_path}/*-????-??-??"):
+        if build_dir_path[-len("????-??-??"):] >= before_date:
+            continue
+        for root, dirs, file_names in os.walk(build_dir_path):
+            for file_name in file_names:
+                file_stat = os.lstat(os.path.join(root, file_name))
+                files[os.path.join(root, file_name)] = (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+    return files
+
+def check_incremental(command):
+    # Not a benchmark: an update, one the next day (which slims the first
+    # day's builds), and an incremental one the same day with hypre,
+    # RustBCA and kokkos moved upstream, rebuilding them on top of what
+    # was reused from the first day. All three have to build everything,
+    # without touching a file of the first day's builds, and the last one
+    # has to build every hpic2 again, since it links its deps statically.
+    setup_benchmark()
+    builds_path = f"{bench_dir}/top/builds"
+    today = datetime.date.today().strftime("%Y-%m-%d")
+    problems = []
+    old_files = {}
+    for run, (days_ago, changed_packages, incremental) in enumerate([(1, [], False), (0, ["hpic2"], False), (0, ["hypre", "RustBCA", "kokkos"], True)]):
+        if incremental:
+            old_files = build_files(builds_path, today)
+        numbers = benchmark_run(command, run, days_ago, changed_packages, incremental)
+        if numbers is None or not numbers["succeeded"]:
+            problems.append(f"run {run + 1} did not build everything, see {bench_dir}/run-{run + 1}.log")
+        elif incremental:
+            with open(f"{bench_dir}/events-{run + 1}.jsonl") as events_file:
+                hpic2_built = {event["dir"] for event in map(json.loads, events_file) if event["package"] == "hpic2" and event["phase"] == "build"}
+            for build_dir_path in glob.glob(f"{builds_path}/hpic2-*-{today}"):
+                if os.path.basename(build_dir_path) not in hpic2_built:
+                    problems.append(f"run {run + 1} did not build {os.path.basename(build_dir_path)} again after its deps changed")
+    for git_path in glob.glob(f"{builds_path}/*-????-??-??/**/.git", recursive=True):
+        build_dir_name = os.path.relpath(git_path, builds_path).split(os.sep)[0]
+        if not build_dir_name.endswith(today) and not build_dir_name.startswith("hpic2-"):
+            problems.append(f"{git_path} is still there, {build_dir_name} did not get slimmed")
+    new_files = build_files(builds_path, today)
+    for path, file_state in old_files.items():
+        if path in new_files and new_files[path] != file_state:
+            problems.append(f"{path} changed")
+    for problem in problems[:20]:
+        print(f"    {problem}")
+    print("Incremental check failed" if problems else "Incremental check passed")
+    return not problems
+
+if __name__ == "__main__":
+    help_message = f"""
+Synthetic benchmark of the hpic2 update. Runs the real update script against
+stand-in repos in {bench_dir}, where cmake/make/cargo only burn CPU, memory
+and disk, and reports how close it got to the best possible makespan.
+The first run builds everything, every run after that is a day later with
+HPIC2_BENCH_CHANGED (default hpic2) moved upstream.
+Usage:
+
+python3 {os.path.basename(__file__)}
+python3 {os.path.basename(__file__)} update_parallel [runs]
+python3 {os.path.basename(__file__)} update_slurm [runs]
+python3 {os.path.basename(__file__)} update [runs]
+python3 {os.path.basename(__file__)} check_incremental [update_parallel|update_slurm]
+    """
+
+    if len(sys.argv) >= 3 and sys.argv[1] == "fake":
+        # Only meant to be run as cmake/make/etc. by the benchmarked update.
+        sys.exit(fake_tool(sys.argv[2], sys.argv[3:]))
+    elif len(sys.argv) == 3 and sys.argv[1] == "child":
+        # Same, one run of the update.
+        benchmark_child(sys.argv[2])
+        sys.exit(0)
+    elif len(sys.argv) == 4 and sys.argv[1] == "slurm_child":
+        # Same, in a fake Slurm job.
+        sys.exit(0 if slurm_child(sys.argv[2], sys.argv[3]) else 1)
+    elif len(sys.argv) in [2, 3] and sys.argv[1] == "check_incremental" and sys.argv[2:] in [[], ["update_parallel"], ["update_slurm"]]:
+        sys.exit(0 if check_incremental(sys.argv[2] if len(sys.argv) == 3 else "update_parallel") else 1)
+    elif len(sys.argv) == 1:
+        sys.exit(0 if benchmark("update_parallel", 2) else 1)
+    elif len(sys.argv) in [2, 3] and sys.argv[1] in ["update", "update_parallel", "update_slurm"] and (len(sys.argv) == 2 or sys.argv[2].isdigit()):
+        sys.exit(0 if benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) == 3 else 2) else 1)
+    else:
+        print(help_message)
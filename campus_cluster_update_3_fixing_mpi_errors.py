@@ -10,8 +10,21 @@ import itertools
 import os
 import shutil
 import glob
-import numpy as np
-from mpi4py.futures import MPIPoolExecutor 
+import hashlib
+import re
+import concurrent.futures
+import functools
+import json
+import sqlite3
+import urllib.request
+import time
+import traceback
+import collections
+import gzip
+import threading
+import heapq
+import stat
+import struct
 
 top_level_dir = os.getcwd() #f"/projects/illinois/eng/npre/dcurreli" #
 os.chdir(top_level_dir)
@@ -26,6 +39,12 @@ python_module = "python/3.13.2"
 num_build_cores = len(os.sched_getaffinity(0)) #4
 # Delete old versions of builds if the number exceeds this
 num_versions_kept = 3
+# Also delete builds older than this many days, and the oldest builds (of
+# any variant) while all of them together take more than this many GB.
+# Neither ever deletes a build from today or one a latest modulefile points
+# at. See enforce_retention.
+max_build_age_days = float(os.environ["HPIC2_MAX_BUILD_AGE_DAYS"]) if os.environ.get("HPIC2_MAX_BUILD_AGE_DAYS") else None
+builds_quota_gb = float(os.environ["HPIC2_BUILDS_QUOTA_GB"]) if os.environ.get("HPIC2_BUILDS_QUOTA_GB") else None
 #Module Compile options for OpenMP and CUDA
 openmp_options = [True]#, False] #why would you ever not want openmp? idk
 cuda_arch_options = [None, 90]#, 70, 80, 86, 90] # yeah, you might not want cuda. 
@@ -44,8 +63,813 @@ cmake_module = f"cmake"
 
 current_datetime = datetime.datetime.now()
 datetime_format = '%Y-%m-%d'
-datetime_format_length = 10
 current_datetime = current_datetime.strftime(datetime_format)
+# Slurm array tasks get the date from the driver, otherwise a task that starts
+# after midnight would build into tomorrow's directory.
+current_datetime = os.environ.get("HPIC2_BUILD_DATE", current_datetime)
+
+# Packages built for every variant in build_dependent, and the packages each
+# one needs finished before it can start. Anything not listed as a dependency
+# of something else gets built at the same time as everything else.
+dependent_package_deps = {
+    "kokkos": [],
+    "hdf5": [],
+    "rust": [],
+    "hypre": [],
+    "spdlog": [],
+    "metis": [],
+    "mfem": ["hypre", "metis"],
+    "pumiMBBL": ["kokkos"],
+    "RustBCA": ["rust"],
+}
+# Packages that come out the same no matter the openmp/cuda arch option, and
+# which of the variant settings they do depend on. build_once_modules builds
+# these once per run and every variant gets a hardlinked copy.
+build_once_package_axes = {
+    "rust": [],
+    "spdlog": ["build_type"],
+    "metis": [],
+    "RustBCA": [],
+}
+
+# Where all the sources come from. Everything is cloned/downloaded once into
+# mirror_dir and the builds check out from there, so a full matrix only hits
+# github once per repo. Set HPIC2_UPSTREAM_BASE to something like
+# file:///path/to/repos to use local stand-ins instead, named <name>.git
+# (and the tarballs by their file name).
+upstream_sources = {
+    "kokkos": "https://github.com/kokkos/kokkos.git", #git@github.com:kokkos/kokkos.git
+    "hdf5": "https://github.com/HDFGroup/hdf5.git", #git@github.com:HDFGroup/hdf5.git
+    "hypre": "https://github.com/hypre-space/hypre.git", #git@github.com:hypre-space/hypre.git
+    "spdlog": "https://github.com/gabime/spdlog.git", #git@github.com:gabime/spdlog.git
+    "mfem": "https://github.com/mfem/mfem.git", #git@github.com:mfem/mfem.git
+    "pumiMBBL": "https://github.com/SCOREC/pumiMBBL.git", #git@github.com:SCOREC/pumiMBBL.git
+    "RustBCA": "https://github.com/lcpp-org/RustBCA.git", #git@github.com:lcpp-org/RustBCA.git
+    "hpic2": "https://github.com/lcpp-org/hpic2.git", #git@github.com:lcpp-org/hpic2.git
+}
+upstream_tarballs = {
+    "metis": "https://github.com/mfem/tpls/raw/gh-pages/metis-5.1.0.tar.gz",
+}
+upstream_base = os.environ.get("HPIC2_UPSTREAM_BASE")
+mirror_dir = f"{top_level_dir}/mirrors"
+
+# One rust toolchain for everything, pinned so it only changes when we bump
+# it here, with a persistent CARGO_HOME (crate registry) and a cargo target
+# directory shared by every RustBCA build, so cargo only recompiles what
+# actually changed. Set HPIC2_RUST_OFFLINE=1 to build RustBCA only from the
+# crates vendored in rust_vendor_dir by an earlier (online) run.
+rust_toolchain_version = "1.86.0"
+rust_dir = f"{top_level_dir}/rust"
+rust_vendor_dir = f"{rust_dir}/vendor"
+rust_offline = bool(os.environ.get("HPIC2_RUST_OFFLINE"))
+
+# Normally a second update on the same day starts today's build directories
+# over from scratch. With incremental builds (--incremental or
+# HPIC2_INCREMENTAL=1) they are kept: packages that finished are skipped,
+# sources are moved to the new upstream revision in place and make only
+# rebuilds what changed, so retrying after a late failure is cheap.
+incremental_builds = bool(os.environ.get("HPIC2_INCREMENTAL"))
+
+# Upstream revisions (and a hash of this script) of the last update that
+# built everything successfully. An update stops right away when none of it
+# changed, unless forced with --force.
+upstream_lock_path = f"{top_level_dir}/upstream.lock.json"
+force_update = bool(os.environ.get("HPIC2_FORCE_UPDATE"))
+
+# Compiler cache shared by every C/C++/CUDA build, any variant, any day.
+# Builds just go without it if there is no ccache on the PATH. Each package
+# build logs its hits and misses to ccache_stats_dir for the end-of-update
+# report (the file names carry the dated build directory, so the scripts, and
+# with them the build cache keys, stay the same from day to day).
+ccache_dir = f"{top_level_dir}/ccache"
+ccache_max_size = os.environ.get("HPIC2_CCACHE_MAX_SIZE", "50G")
+ccache_stats_dir = f"{ccache_dir}/stats"
+
+# Settings for update_slurm, which builds every variant as its own Slurm
+# array task on a compute node instead of everything on the login node.
+# HPIC2_SBATCH/HPIC2_SQUEUE/HPIC2_SACCT can point at stand-in scripts for
+# testing without a cluster.
+sbatch_command = os.environ.get("HPIC2_SBATCH", "sbatch")
+squeue_command = os.environ.get("HPIC2_SQUEUE", "squeue")
+sacct_command = os.environ.get("HPIC2_SACCT", "sacct")
+slurm_partition = None # e.g. "eng-research", None uses the default partition
+slurm_account = None
+slurm_time_limit = "12:00:00"
+slurm_cpus_per_task = 16
+# nvcc (kokkos and mfem with CUDA) needs a lot more memory per compile job.
+slurm_mem_per_cpu_gb = 2
+slurm_cuda_mem_per_cpu_gb = 4
+slurm_poll_seconds = 60
+# Give up on squeue after it failed this many times in a row (slurmctld
+# timeouts and the like), about an hour at slurm_poll_seconds.
+slurm_max_poll_errors = 60
+# Job states sacct reports for jobs that are not done yet.
+slurm_active_states = {"PENDING", "RUNNING", "REQUEUED", "RESIZING", "SUSPENDED", "CONFIGURING", "COMPLETING", "STAGE_OUT"}
+
+# Where each package of build_dependent ends up inside a variant's build
+# directory, i.e. everything the modulefile (or a package depending on it)
+# points at. This is what gets reused from an earlier build on a cache hit.
+package_install_dirs = {
+    "kokkos": ["kokkos_dev/install"],
+    "hdf5": ["hdf5_dev/install"],
+    "rust": [], # lives in rust_dir, not in the build directories
+    "hypre": ["hypre_dev/hypre/src/hypre", "hypre_dev/install"],
+    "spdlog": ["spdlog_dev/install"],
+    "metis": ["metis-5.1.0/build/Linux-x86_64/install"],
+    "mfem": ["mfem_dev/install"],
+    "pumiMBBL": ["pumiMBBL_dev/install"],
+    "RustBCA": ["RustBCA"],
+}
+# One small json file per cached package build, named by its cache key.
+build_cache_dir = f"{top_level_dir}/builds/.build_cache"
+# One small json file per build directory (see register_build), which is
+# what retention goes by instead of listing builds/.
+build_manifest_dir = f"{top_level_dir}/builds/.manifest"
+build_dir_prefixes = ("hpic2deps-", "hpic2-", "build_once_modules-")
+# Builds to delete get renamed into here, which is instant, and deleted by a
+# background thread while the update goes on (see trash_build). Whatever an
+# interrupted update left in here gets deleted by the next one.
+trash_dir = f"{top_level_dir}/builds/.trash"
+trash_delete_workers = 16
+
+# HPIC2_SCRATCH_BUILDS=1 builds on node-local scratch (HPIC2_SCRATCH_DIR, or
+# $TMPDIR) instead of on the shared filesystem, where the millions of small
+# writes of a compile are slow for us and everyone else. The directories a
+# package's build script works in (package_work_dirs) become symlinks into
+# scratch_dir, and once it is built only its install directories get copied
+# back (see publish_package). A package only goes on scratch if there are
+# still scratch_package_gb free for it, on top of what the other packages
+# on scratch might take, and goes again in place if scratch fills up anyway.
+scratch_builds = bool(os.environ.get("HPIC2_SCRATCH_BUILDS"))
+scratch_dir = f"{os.path.realpath(os.environ.get('HPIC2_SCRATCH_DIR', os.environ.get('TMPDIR', '/tmp')))}/hpic2_builds_{os.environ.get('USER', os.getuid())}"
+scratch_package_gb = float(os.environ.get("HPIC2_SCRATCH_PACKAGE_GB", 10))
+package_work_dirs = {
+    "kokkos": ["kokkos_dev"],
+    "hdf5": ["hdf5_dev"],
+    "rust": [],
+    "hypre": ["hypre_dev"],
+    "spdlog": ["spdlog_dev"],
+    "metis": ["metis-5.1.0"],
+    "mfem": ["mfem_dev"],
+    "pumiMBBL": ["pumiMBBL_dev"],
+    "RustBCA": ["RustBCA"],
+    "hpic2": ["hpic2", "build"],
+}
+# Once a build is from before today, everything but the install
+# directories in the package_work_dirs of its packages (the git clones, the
+# build directories with their object files, ...) is deleted, which takes
+# most of the files and space out of every build (see slim_old_builds).
+# Today's builds keep all of it, for incremental rebuilds and resume.
+# HPIC2_SLIM_BUILDS=0 keeps all of it for good. The sources are in mirrors/
+# and their revisions in the manifest if they are ever needed again. What RustBCA
+# keeps is more than package_install_dirs says since it has no install
+# prefix of its own. hpic2 itself is left alone, it runs from its build
+# directory and developers want the source that went into it.
+slim_builds = os.environ.get("HPIC2_SLIM_BUILDS", "1") != "0"
+slim_keep_dirs = {
+    "RustBCA": ["RustBCA/RustBCA.h", "RustBCA/include", "RustBCA/lib", "RustBCA/target/release"],
+}
+# With HPIC2_SLIM_DOCS=1 these go from the install directories too.
+slim_docs = bool(os.environ.get("HPIC2_SLIM_DOCS"))
+slim_doc_globs = ["share/doc", "share/man", "share/info", "share/*examples*", "share/*/examples", "doc", "docs", "examples"]
+# Text files bigger than this never have paths in them worth fixing.
+relocate_max_bytes = 16 * 1024 * 1024
+# Binaries get the RPATHs in them fixed up with patchelf (HPIC2_PATCHELF, or
+# the one on the PATH), or in place if the new path is not longer.
+patchelf_path = os.environ.get("HPIC2_PATCHELF") or shutil.which("patchelf")
+# After every update, identical files across the builds we keep get
+# hardlinked together (see dedup_builds), so keeping num_versions_kept days
+# of nearly identical installs costs about one. HPIC2_DEDUP=0 turns it off.
+dedup_enabled = os.environ.get("HPIC2_DEDUP", "1") != "0"
+# Duplicates get replaced by renaming a hardlink with this suffix over them,
+# one left behind by a killed dedup is just an extra link and gets removed.
+dedup_temp_suffix = ".hpic2-dedup"
+
+# How long every stage of every package build took, and the build graphs
+# they ran in, for the report subcommand. Slurm tasks get the driver's run id
+# so the whole update counts as one run.
+timing_db_path = f"{top_level_dir}/builds/build_times.sqlite"
+build_run_id = os.environ.get("HPIC2_RUN_ID", f"{current_datetime}-{int(time.time())}")
+
+# Output of every package build goes to logs/<package>.log in its build
+# directory instead of the console, which only gets a status line per stage.
+# Only the first log_head_bytes and the last log_tail_bytes are kept (the
+# error is nearly always at the end). HPIC2_COMPRESS_LOGS=1 gzips them.
+log_head_bytes = 2 * 1024 * 1024
+log_tail_bytes = 8 * 1024 * 1024
+log_compress = bool(os.environ.get("HPIC2_COMPRESS_LOGS"))
+log_console_lines = 20
+
+# While a package builds, its whole process tree gets looked at in /proc this
+# often (seconds, 0 turns it off), for the CPU, memory and I/O of each stage.
+resource_sample_seconds = float(os.environ.get("HPIC2_SAMPLE_SECONDS", 2))
+
+# GB one compile job of a package takes, for packages the timing database has
+# no samples of yet (see memory_per_job_kb); 0.5 for the rest. nvcc jobs take
+# cuda_memory_factor times as much. HPIC2_MEMORY_PER_JOB_GB="mfem=4,kokkos=3"
+# sets them by hand, over the samples too.
+default_memory_per_job_gb = {"mfem": 2, "kokkos": 2, "hpic2": 2, "pumiMBBL": 1.5, "RustBCA": 1}
+cuda_memory_factor = 2
+configured_memory_per_job_gb = {name: float(gb) for name, gb in (item.split("=") for item in os.environ.get("HPIC2_MEMORY_PER_JOB_GB", "").split(",") if item)}
+# Part of the memory available when the first build starts that builds get
+# to use between them, the rest is headroom for the estimates being off.
+memory_budget_fraction = 0.8
+
+# Minutes a package takes to build, for ordering the builds (see
+# critical_path_priorities) until the timing database knows better.
+default_build_minutes = {"hdf5": 20, "kokkos": 15, "mfem": 15, "hypre": 10, "hpic2": 10, "RustBCA": 8,
+                         "rust": 5, "pumiMBBL": 3, "spdlog": 2, "metis": 2, "modulefile": 0}
+default_cuda_build_minutes = {"kokkos": 40, "mfem": 30, "hpic2": 20, "pumiMBBL": 6}
+
+# analyze_log reads logs this many bytes at a time, and shows this many lines
+# around (and this many of) the errors and warnings of each section.
+analyze_chunk_bytes = 16 * 1024 * 1024
+analyze_context_lines = 3
+analyze_max_shown = 5
+# Lines analyze_log looks at more closely, everything else only gets counted.
+# Plain strings, since bytes.find gets through a log many times faster than
+# any regular expression; the regular expressions below then only run on the
+# lines these turn up.
+analyze_markers = [b"rror", b"arning", b"fatal: ", b"***", b"command not found", b"Traceback", b"FAILED",
+                   b"Cloning into '", b"Entering directory '", b"Build files have been written"]
+# Phases only get timed in logs with timestamps, so these only get looked for there.
+analyze_phase_markers = [b"==> stage ", b"compiler identification", b"checking build system type",
+                         b"config.status: creating Makefile", b"Scanning dependencies of target", b"Compiling ",
+                         b"Install the project...", b"Making install"]
+# Only these lines say which package (and variant) the output is from, other
+# lines mention the install directories of the dependencies too.
+analyze_section_markers = [b"Entering directory '", b"Build files have been written", b"Cloning into '"]
+analyze_section_re = re.compile(rb"(?P<dir>(?:hpic2deps|hpic2|build_once_modules)-[^/\s'\"\]]+)/(?P<package>[A-Za-z0-9_.+-]+)")
+analyze_clone_re = re.compile(rb"Cloning into '(?P<package>[^']+)'")
+analyze_phase_res = [
+    ("fetch", re.compile(rb"Cloning into '|==> stage fetched")),
+    ("configure", re.compile(rb"-- The C(?:XX)? compiler identification|checking build system type|==> stage configured")),
+    ("build", re.compile(rb"-- Build files have been written|config\.status: creating Makefile|Scanning dependencies of target|Compiling |==> stage built")),
+    ("install", re.compile(rb"Install the project\.\.\.|Making install|==> stage installed")),
+]
+analyze_error_re = re.compile(rb"(?i:\b(?:fatal )?error\b(?:\[[^\]\n]*\])?:)|CMake Error|make(?:\[\d+\])?: \*\*\*|^fatal: |undefined reference to|command not found|^Traceback |FAILED \(exit code")
+analyze_warning_re = re.compile(rb"(?i:\bwarning\b(?:\[[^\]\n]*\])?:)|CMake Warning")
+analyze_timestamp_re = re.compile(rb"^\[?(?:(\d{4}-\d\d-\d\d)[ T])?(\d\d):(\d\d):(\d\d)")
+
+# GNU make jobserver shared by every build we start. It holds one token per
+# core in our affinity mask, and make, cmake's generated makefiles and cargo
+# all take tokens from it, so the total number of compile jobs stays at
+# num_build_cores no matter how many packages are building at once.
+# (read fd, write fd) of the jobserver pipe, None until start_jobserver().
+jobserver_fds = None
+
+def start_jobserver(num_tokens=None):
+    global jobserver_fds
+    if jobserver_fds is not None:
+        return jobserver_fds
+    if num_tokens is None:
+        num_tokens = num_build_cores
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b"+" * num_tokens)
+    jobserver_fds = (read_fd, write_fd)
+    return jobserver_fds
+
+def acquire_job_token():
+    # Blocks until a token is free. Every build script we start holds one
+    # token for the implicit job slot make/cargo get without asking.
+    if jobserver_fds is None:
+        return None
+    return os.read(jobserver_fds[0], 1)
+
+def release_job_token(token):
+    if token:
+        os.write(jobserver_fds[1], token)
+
+job_tokens_lock = threading.Lock()
+
+def acquire_job_tokens(num_tokens):
+    # num_tokens tokens for a build running with its own -j. One build at a
+    # time, so two builds each holding a few never wait on each other.
+    with job_tokens_lock:
+        return b"".join(acquire_job_token() for _ in range(num_tokens))
+
+# Memory the running builds have set aside (see reserve_build_memory), out of
+# memory_budget_kb, which gets measured when the first build starts.
+memory_condition = threading.Condition()
+memory_budget_kb = None
+memory_reserved_kb = 0
+# (package, cuda) -> how many times over memory_per_job_kb is, after builds of
+# it ran out of memory during this update.
+memory_oom_factors = {}
+
+def reserve_build_memory(per_job_kb, max_jobs):
+    # Blocks until there is memory for a build to run a fair number of jobs
+    # of per_job_kb each (half of what it would get with the budget to
+    # itself), sets that much aside and returns the number of jobs. With
+    # nothing else running a build gets whatever there is, down to -j1, so
+    # one too big for the whole budget still runs.
+    global memory_budget_kb, memory_reserved_kb
+    with memory_condition:
+        if memory_budget_kb is None:
+            memory_budget_kb = int(available_memory_kb() * memory_budget_fraction)
+        fair_jobs = int(max(1, min(max_jobs, memory_budget_kb // per_job_kb)))
+        while True:
+            jobs = int(min(fair_jobs, (memory_budget_kb - memory_reserved_kb) // per_job_kb))
+            if jobs >= max(1, fair_jobs // 2) or memory_reserved_kb == 0:
+                jobs = max(jobs, 1)
+                memory_reserved_kb += jobs * per_job_kb
+                return jobs
+            memory_condition.wait()
+
+def release_build_memory(reserved_kb):
+    global memory_reserved_kb
+    with memory_condition:
+        memory_reserved_kb -= reserved_kb
+        memory_condition.notify_all()
+    return True
+
+def memory_per_job_kb(package, cuda):
+    # Memory one compile job of package takes: set by hand, otherwise the
+    # most a recent build of it took per busy core (see sample_process_tree),
+    # otherwise default_memory_per_job_gb. Doubled for every time a build of
+    # it ran out of memory during this update.
+    if package in configured_memory_per_job_gb:
+        per_job_kb = configured_memory_per_job_gb[package] * 1024 * 1024
+    else:
+        per_job_kb = learned_memory_per_job_kb(package, cuda)
+        if per_job_kb is None:
+            per_job_kb = default_memory_per_job_gb.get(package, 0.5) * 1024 * 1024
+            if cuda:
+                per_job_kb *= cuda_memory_factor
+    return per_job_kb * memory_oom_factors.get((package, cuda), 1)
+
+def learned_memory_per_job_kb(package, cuda):
+    if not os.path.exists(timing_db_path):
+        return None
+    timing_db_connection = timing_db()
+    rows = timing_db_connection.execute("""SELECT tree_rss_kb, cpu_seconds, duration FROM build_steps
+        WHERE package = ? AND phase = 'built' AND tree_rss_kb IS NOT NULL AND (build_dir LIKE '%cuda-arch-%' AND build_dir NOT LIKE '%cuda-arch-None%') = ?
+        ORDER BY start DESC LIMIT 10""", (package, cuda)).fetchall()
+    timing_db_connection.close()
+    if not rows:
+        return None
+    # Average busy cores rather than the jobs running at the peak, so this
+    # errs on the big side.
+    return max(tree_rss_kb / max(cpu_seconds / max(duration, 1), 1) for tree_rss_kb, cpu_seconds, duration in rows)
+
+def cgroup_memory_dirs():
+    # Memory cgroup directories we are in, innermost first (a limit on any of
+    # them counts, Slurm puts them on the job and on the step).
+    cgroup_dirs = []
+    with open("/proc/self/cgroup") as cgroup_file:
+        for line in cgroup_file:
+            hierarchy, controllers, path = line.rstrip("\n").split(":", 2)
+            if hierarchy == "0" and os.path.exists("/sys/fs/cgroup/cgroup.controllers"):
+                mount = "/sys/fs/cgroup"
+            elif "memory" in controllers.split(","):
+                mount = "/sys/fs/cgroup/memory"
+            else:
+                continue
+            # In a container our cgroup is the root of what is mounted.
+            cgroup_dir = mount + path.rstrip("/")
+            if not os.path.isdir(cgroup_dir):
+                cgroup_dir = mount
+            while True:
+                cgroup_dirs.append(cgroup_dir)
+                if cgroup_dir == mount:
+                    break
+                cgroup_dir = os.path.dirname(cgroup_dir)
+    return cgroup_dirs
+
+def cgroup_memory_limits():
+    # (limit, usage) in kB of every memory cgroup we are in that has a limit,
+    # cgroup v2 or v1.
+    limits = []
+    for cgroup_dir in cgroup_memory_dirs():
+        for limit_name, usage_name in [("memory.max", "memory.current"), ("memory.limit_in_bytes", "memory.usage_in_bytes")]:
+            try:
+                with open(f"{cgroup_dir}/{limit_name}") as limit_file:
+                    limit = limit_file.read().strip()
+                with open(f"{cgroup_dir}/{usage_name}") as usage_file:
+                    usage = int(usage_file.read())
+            except (OSError, ValueError):
+                continue
+            # "max" in v2, a huge number in v1 for no limit.
+            if limit.isdigit() and int(limit) < 2**60:
+                limits.append((int(limit) // 1024, usage // 1024))
+    return limits
+
+def meminfo_kb(field):
+    with open("/proc/meminfo") as meminfo_file:
+        for line in meminfo_file:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1])
+    return None
+
+def node_memory_kb():
+    # All the memory builds could get: the node's, or our cgroup's limit (in
+    # a Slurm job, say) if that is less.
+    return min([meminfo_kb("MemTotal")] + [limit for limit, usage in cgroup_memory_limits()])
+
+def available_memory_kb():
+    return min([meminfo_kb("MemAvailable")] + [limit - usage for limit, usage in cgroup_memory_limits()])
+
+def oom_kill_count():
+    # Processes the kernel killed for memory, on the whole node (vmstat) and
+    # in our cgroups. Only ever compared with an earlier count.
+    oom_kills = 0
+    for events_path in ["/proc/vmstat"] + [f"{cgroup_dir}/{events_name}" for cgroup_dir in cgroup_memory_dirs() for events_name in ["memory.events", "memory.oom_control"]]:
+        try:
+            with open(events_path) as events_file:
+                for line in events_file:
+                    if line.startswith("oom_kill "):
+                        oom_kills += int(line.split()[1])
+        except (OSError, ValueError):
+            continue
+    return oom_kills
+
+def ran_out_of_memory(build_result, oom_kills_before):
+    # Whether a failed build looks like it got killed for memory: by the
+    # kernel (SIGKILL, or an OOM kill anywhere since it started), or
+    # compilers giving up on allocating.
+    if build_result.returncode in [-9, 137] or oom_kill_count() > oom_kills_before:
+        return True
+    out_of_memory_messages = [b"Killed signal terminated program", b"virtual memory exhausted", b"out of memory", b"std::bad_alloc", b"Cannot allocate memory"]
+    return any(message in (build_result.stdout or b"") for message in out_of_memory_messages)
+
+def run_build_script(script, package=None, build_dir_path=None):
+    # Run one build script (see run_build_script_jobs). A package build gets
+    # as many jobs as there is memory for (see reserve_build_memory), and if
+    # it runs out of memory anyway it goes again with half the jobs, from
+    # the stage it got killed in, until it builds or fails with -j1.
+    if package is None:
+        return run_build_script_jobs(script, package, build_dir_path, num_build_cores)
+    build_dir_name = os.path.basename(build_dir_path)
+    cuda = is_cuda_build(build_dir_name)
+    max_jobs = num_build_cores
+    while True:
+        per_job_kb = memory_per_job_kb(package, cuda)
+        jobs = reserve_build_memory(per_job_kb, max_jobs)
+        oom_kills = oom_kill_count()
+        try:
+            build_result = run_build_script_jobs(script, package, build_dir_path, jobs)
+        finally:
+            release_build_memory(jobs * per_job_kb)
+        if build_result.returncode == 0 or jobs == 1 or not ran_out_of_memory(build_result, oom_kills):
+            return build_result
+        # Other variants of it get fewer jobs from now on too.
+        memory_oom_factors[(package, cuda)] = memory_oom_factors.get((package, cuda), 1) * 2
+        max_jobs = jobs // 2
+        print(f"{package} [{build_dir_name}]: ran out of memory with -j{jobs}, trying again with -j{max_jobs}")
+
+def run_build_script_jobs(script, package, build_dir_path, jobs):
+    # Run one build script in its own bash (the scripts use source), hooked
+    # up to the jobserver if there is one, or with its own -j<jobs> when it
+    # gets fewer than num_build_cores (holding that many tokens, so the
+    # total stays at num_build_cores). Either way make and cargo only get
+    # their jobs from MAKEFLAGS/CARGO_BUILD_JOBS, the build scripts never
+    # pass a -j, which would win over them. set -e so the first failing command
+    # fails the whole script, instead of everything after it running
+    # against a half-built package. With package, the output goes to its
+    # log file (see stream_build_log), and its stage times (see
+    # stage_script) and peak memory go into the timing database.
+    script = "set -e\n" + script
+    env = dict(os.environ)
+    pass_fds = ()
+    token = None
+    if jobserver_fds is not None and jobs >= num_build_cores:
+        env["MAKEFLAGS"] = f"-j{num_build_cores} --jobserver-auth={jobserver_fds[0]},{jobserver_fds[1]}"
+        env["CARGO_MAKEFLAGS"] = env["MAKEFLAGS"]
+        pass_fds = jobserver_fds
+        token = acquire_job_token()
+    else:
+        env["MAKEFLAGS"] = f"-j{jobs}"
+        env.pop("CARGO_MAKEFLAGS", None)
+        env["CARGO_BUILD_JOBS"] = str(jobs)
+        if jobserver_fds is not None:
+            token = acquire_job_tokens(jobs)
+    samples = []
+    stop_sampling = threading.Event()
+    try:
+        start = time.time()
+        if package is None:
+            build_process = subprocess.Popen(script, shell=True, executable="/bin/bash", env=env, pass_fds=pass_fds)
+        else:
+            build_process = subprocess.Popen(script, shell=True, executable="/bin/bash", env=env, pass_fds=pass_fds, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if resource_sample_seconds > 0:
+                threading.Thread(target=sample_build, args=(build_process.pid, samples, stop_sampling), daemon=True).start()
+            log_path, last_lines = stream_build_log(build_process, package, build_dir_path)
+        # wait4 rather than wait for the rusage, whose ru_maxrss covers the
+        # biggest process in the whole tree under the script.
+        _, wait_status, rusage = os.wait4(build_process.pid, 0)
+        if os.WIFSIGNALED(wait_status):
+            build_process.returncode = -os.WTERMSIG(wait_status)
+        else:
+            build_process.returncode = os.WEXITSTATUS(wait_status)
+    finally:
+        stop_sampling.set()
+        if token is not None:
+            release_job_token(token)
+    if package is not None:
+        duration = time.time() - start
+        record_build_steps(package, build_dir_path, start, duration, build_process.returncode, rusage, list(samples))
+        build_status = f"{package} [{os.path.basename(build_dir_path)}]:"
+        tree_rss_gb = max((sample[2] for sample in samples), default=0) / 1024 / 1024
+        resources = f"-j{jobs}, {(rusage.ru_utime + rusage.ru_stime) / max(duration, 1):.1f} cores, {tree_rss_gb:.1f} GB at most"
+        if build_process.returncode == 0:
+            print(f"{build_status} done in {duration / 60:.1f} minutes ({resources})")
+        else:
+            # Enough of the log to see what went wrong without opening it.
+            print(f"{build_status} FAILED (exit code {build_process.returncode}, {resources}), full log in {log_path}, it ended with:\n"
+                + "".join(f"    | {line.decode(errors='replace')}" for line in last_lines), end="")
+        return subprocess.CompletedProcess(script, build_process.returncode, stdout=b"".join(last_lines))
+    return subprocess.CompletedProcess(script, build_process.returncode)
+
+def stream_build_log(build_process, package, build_dir_path):
+    # Copy build_process's output into package's log file as it comes,
+    # keeping the first log_head_bytes of it and the last log_tail_bytes
+    # (held back until the end), and print a status line whenever it gets
+    # through a stage. Returns the log path and the last few lines of output.
+    os.makedirs(f"{build_dir_path}/logs", exist_ok=True)
+    log_path = f"{build_dir_path}/logs/{package}.log"
+    open_log = open
+    if log_compress:
+        log_path += ".gz"
+        open_log = gzip.open
+    build_status = f"{package} [{os.path.basename(build_dir_path)}]:"
+    head_bytes = 0
+    tail_lines = collections.deque()
+    tail_bytes = 0
+    left_out_bytes = 0
+    last_lines = collections.deque(maxlen=log_console_lines)
+    with open_log(log_path, 'wb') as log_file:
+        for line in build_process.stdout:
+            last_lines.append(line)
+            if line.startswith(b"==> stage "):
+                print(f"{build_status} {line[len(b'==> stage '):].decode().strip()}")
+            if head_bytes < log_head_bytes:
+                log_file.write(line)
+                head_bytes += len(line)
+                continue
+            tail_lines.append(line)
+            tail_bytes += len(line)
+            while tail_bytes > log_tail_bytes:
+                left_out_line = tail_lines.popleft()
+                tail_bytes -= len(left_out_line)
+                left_out_bytes += len(left_out_line)
+        if left_out_bytes:
+            log_file.write(f"\n[... {left_out_bytes} bytes of output left out here ...]\n\n".encode())
+        log_file.writelines(tail_lines)
+    return log_path, last_lines
+
+def timing_db():
+    timing_db_connection = sqlite3.connect(timing_db_path, timeout=60)
+    timing_db_connection.execute("""CREATE TABLE IF NOT EXISTS build_steps (
+        run TEXT, build_date TEXT, build_dir TEXT, package TEXT, phase TEXT,
+        start REAL, duration REAL, exit_code INTEGER, max_rss_kb INTEGER)""")
+    # Added later (see sample_process_tree), databases from before get them added.
+    build_steps_columns = [row[1] for row in timing_db_connection.execute("PRAGMA table_info(build_steps)")]
+    for column in ["cpu_seconds REAL", "tree_rss_kb INTEGER", "read_bytes INTEGER", "write_bytes INTEGER", "cores INTEGER", "mem_total_kb INTEGER"]:
+        if column.split()[0] not in build_steps_columns:
+            timing_db_connection.execute(f"ALTER TABLE build_steps ADD COLUMN {column}")
+    timing_db_connection.execute("""CREATE TABLE IF NOT EXISTS build_tasks (
+        run TEXT, graph TEXT, name TEXT, deps TEXT,
+        start REAL, duration REAL, exit_code INTEGER)""")
+    return timing_db_connection
+
+def record_build_steps(package, build_dir_path, start, duration, exit_code, rusage, samples):
+    # One row per stage the build script went through (from the times file
+    # stage_script appends to), plus a "total" row for the whole script,
+    # each with what samples (see sample_process_tree) saw during it.
+    build_dir = os.path.basename(build_dir_path)
+    rows = []
+    times_path = f"{build_dir_path}/.stages/{package}.times"
+    if os.path.exists(times_path):
+        with open(times_path) as times_file:
+            for line in times_file:
+                phase, stage_start, stage_end, stage_exit_code = line.split()
+                stage_start, stage_end = float(stage_start), float(stage_end)
+                cpu_seconds, tree_rss_kb, max_rss_kb, read_bytes, write_bytes = samples_between(samples, stage_start, stage_end)
+                rows.append((build_run_id, current_datetime, build_dir, package, phase, stage_start, stage_end - stage_start, int(stage_exit_code), max_rss_kb,
+                             cpu_seconds, tree_rss_kb, read_bytes, write_bytes, num_build_cores, node_memory_kb()))
+        os.remove(times_path)
+    cpu_seconds, tree_rss_kb, max_rss_kb, read_bytes, write_bytes = samples_between(samples, start, start + duration)
+    if rusage is not None:
+        # Exact, unlike the samples, which miss whatever ran between them.
+        cpu_seconds = rusage.ru_utime + rusage.ru_stime
+        max_rss_kb = rusage.ru_maxrss
+    rows.append((build_run_id, current_datetime, build_dir, package, "total", start, duration, exit_code, max_rss_kb,
+                 cpu_seconds, tree_rss_kb, read_bytes, write_bytes, num_build_cores, node_memory_kb()))
+    with timing_db() as timing_db_connection:
+        timing_db_connection.executemany("""INSERT INTO build_steps (run, build_date, build_dir, package, phase, start, duration, exit_code, max_rss_kb,
+            cpu_seconds, tree_rss_kb, read_bytes, write_bytes, cores, mem_total_kb) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+    timing_db_connection.close()
+    return True
+
+def process_tree_pids(root_pid):
+    # root_pid and everything under it, from the children lists in /proc, or
+    # from the parent of every process there is on kernels without those.
+    children = None
+    if not os.path.exists(f"/proc/{root_pid}/task/{root_pid}/children"):
+        children = {}
+        for stat_path in glob.glob("/proc/[0-9]*/stat"):
+            try:
+                with open(stat_path) as stat_file:
+                    parent_pid = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent_pid, []).append(int(stat_path.split("/")[2]))
+    pids = [root_pid]
+    for pid in pids:
+        if children is not None:
+            pids += children.get(pid, [])
+            continue
+        # Any thread of a process can have started a child.
+        for children_path in glob.glob(f"/proc/{pid}/task/*/children"):
+            try:
+                with open(children_path) as children_file:
+                    pids += [int(child_pid) for child_pid in children_file.read().split()]
+            except OSError:
+                pass
+    return pids
+
+def sample_process_tree(root_pid):
+    # (time, CPU seconds, RSS of the whole tree, biggest RSS of a single
+    # process, bytes read, bytes written) for root_pid's process tree. CPU
+    # and I/O include the children already waited for (cutime and friends),
+    # so they only ever go up over a build. I/O is rchar/wchar rather than
+    # read_bytes/write_bytes, which leave out network filesystems like ours.
+    cpu_ticks = 0
+    tree_rss_kb = 0
+    max_rss_kb = 0
+    read_bytes = 0
+    write_bytes = 0
+    for pid in process_tree_pids(root_pid):
+        try:
+            with open(f"/proc/{pid}/stat") as stat_file:
+                # Field n of stat is stat_fields[n - 3]
+                stat_fields = stat_file.read().rsplit(")", 1)[1].split()
+            rss_kb = int(stat_fields[21]) * os.sysconf("SC_PAGE_SIZE") // 1024
+            cpu_ticks += sum(int(ticks) for ticks in stat_fields[11:15])
+            tree_rss_kb += rss_kb
+            max_rss_kb = max(max_rss_kb, rss_kb)
+            with open(f"/proc/{pid}/io") as io_file:
+                for line in io_file:
+                    if line.startswith("rchar:"):
+                        read_bytes += int(line.split()[1])
+                    elif line.startswith("wchar:"):
+                        write_bytes += int(line.split()[1])
+        except (OSError, IndexError, ValueError):
+            # Gone already, or not ours to look at.
+            continue
+    return (time.time(), cpu_ticks / os.sysconf("SC_CLK_TCK"), tree_rss_kb, max_rss_kb, read_bytes, write_bytes)
+
+def sample_build(root_pid, samples, stop):
+    # Thread that keeps adding to samples until stop gets set.
+    while not stop.wait(resource_sample_seconds):
+        samples.append(sample_process_tree(root_pid))
+    return True
+
+def samples_between(samples, start, end):
+    # CPU seconds, peak tree RSS, peak process RSS, bytes read and bytes
+    # written from start to end, going by the samples taken then. None for
+    # all of them if no sample got taken then (sampling off, or a stage
+    # shorter than resource_sample_seconds).
+    before = [sample for sample in samples if sample[0] <= start]
+    during = [sample for sample in samples if start <= sample[0] <= end]
+    if not during:
+        return None, None, None, None, None
+    first = before[-1] if before else (start, 0, 0, 0, 0, 0)
+    last = during[-1]
+    return (max(last[1] - first[1], 0), max(sample[2] for sample in during), max(sample[3] for sample in during),
+            max(last[4] - first[4], 0), max(last[5] - first[5], 0))
+
+def record_build_task(graph, name, deps, start, duration, exit_code):
+    with timing_db() as timing_db_connection:
+        timing_db_connection.execute("INSERT INTO build_tasks VALUES (?, ?, ?, ?, ?, ?, ?)", (build_run_id, graph, name, json.dumps(deps), start, duration, exit_code))
+    timing_db_connection.close()
+    return True
+
+def upstream_url(name):
+    if upstream_base:
+        return f"{upstream_base}/{name}.git"
+    return upstream_sources[name]
+
+def mirror_path(name):
+    return f"{mirror_dir}/{name}.git"
+
+def tarball_path(name):
+    return f"{mirror_dir}/tarballs/{os.path.basename(upstream_tarballs[name])}"
+
+def resolve_relative_url(base_url, relative_url):
+    # Same thing git does with a submodule url like ../foo.git, which is
+    # relative to the superproject's remote.
+    resolved = base_url.rstrip("/")
+    for part in relative_url.split("/"):
+        if part == "..":
+            resolved = resolved.rsplit("/", 1)[0]
+        elif part not in ["", "."]:
+            resolved += f"/{part}"
+    return resolved
+
+def update_mirror(path, url):
+    # Bare clone of the branches and tags (not all of github's pull request
+    # refs) the first time, git fetch after that.
+    if not os.path.isdir(path):
+        subprocess.run(["git", "clone", "--bare", "--quiet", url, path], check=True)
+        subprocess.run(["git", "-C", path, "config", "remote.origin.fetch", "+refs/heads/*:refs/heads/*"], check=True)
+        # The build directories borrow objects from the mirror (clone
+        # --shared), so git gc must never throw any of them away.
+        subprocess.run(["git", "-C", path, "config", "gc.auto", "0"], check=True)
+    else:
+        fetch_result = subprocess.run(["git", "-C", path, "fetch", "--quiet", "--prune", "--tags", "origin"])
+        if fetch_result.returncode != 0:
+            print(f"Could not update the mirror of {url}, building from what is already in {path}")
+    return path
+
+def update_submodule_mirrors(path, url, url_rewrites, mirrors_done):
+    # Mirror every submodule (recursively) of the mirror at path, which was
+    # cloned from url. Submodules with absolute urls get mirrored under
+    # mirror_dir/submodules and added to url_rewrites (upstream url -> mirror)
+    # so clones can be pointed at them with url.<mirror>.insteadOf. Relative
+    # ones get mirrored next to path, which is where git will look for them
+    # when cloning from path anyway.
+    submodule_config = subprocess.run(["git", "-C", path, "config", "--blob", "HEAD:.gitmodules", "--get-regexp", r"submodule\..*\.url"], capture_output=True, text=True)
+    for line in submodule_config.stdout.splitlines():
+        submodule_url = line.split(maxsplit=1)[1]
+        if submodule_url.startswith("./") or submodule_url.startswith("../"):
+            submodule_upstream = resolve_relative_url(url, submodule_url)
+            submodule_mirror = resolve_relative_url(path, submodule_url)
+        else:
+            submodule_upstream = submodule_url
+            submodule_mirror = f"{mirror_dir}/submodules/{re.sub(r'[^A-Za-z0-9._-]+', '_', submodule_url)}"
+            if not submodule_mirror.endswith(".git"):
+                submodule_mirror += ".git"
+            url_rewrites[submodule_url] = submodule_mirror
+        if submodule_mirror in mirrors_done:
+            continue
+        mirrors_done.add(submodule_mirror)
+        update_mirror(submodule_mirror, submodule_upstream)
+        update_submodule_mirrors(submodule_mirror, submodule_upstream, url_rewrites, mirrors_done)
+    return url_rewrites
+
+def fetch_tarball(name):
+    # Tarballs are versioned, so once we have one we never download it again.
+    path = tarball_path(name)
+    if not os.path.exists(path):
+        url = upstream_tarballs[name]
+        if upstream_base:
+            url = f"{upstream_base}/{os.path.basename(url)}"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        urllib.request.urlretrieve(url, f"{path}.part")
+        os.rename(f"{path}.part", path)
+    return path
+
+def update_mirrors():
+    # Bring every mirror up to date before anything gets built. Done once per
+    # update, on the node that runs the update (so slurm tasks do not need
+    # to touch github at all).
+    print(f"Updating source mirrors in {mirror_dir}...")
+    os.makedirs(mirror_dir, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(upstream_sources)) as executor:
+        mirror_futures = [executor.submit(update_mirror, mirror_path(name), upstream_url(name)) for name in upstream_sources]
+        tarball_futures = [executor.submit(fetch_tarball, name) for name in upstream_tarballs]
+        for future in mirror_futures + tarball_futures:
+            future.result()
+
+    url_rewrites = update_submodule_mirrors(mirror_path("hpic2"), upstream_url("hpic2"), {}, set())
+    with open(f"{mirror_dir}/url_rewrites.json", 'w') as url_rewrites_file:
+        json.dump(url_rewrites, url_rewrites_file, indent=4)
+    return True
+
+def git_clone_command(name, dest=None, recurse_submodules=False):
+    # Shell command that checks out name from its mirror into dest. --shared
+    # borrows the mirror's objects instead of copying hundreds of MB of
+    # history for every variant. If dest is already there (an incremental
+    # rebuild), it just gets moved to the mirror's current revision instead.
+    # If it is there without being a checkout, like hypre/ with only the
+    # src/hypre a reused build left in it, the checkout goes on top of it.
+    if dest is None:
+        dest = name
+    git_config = ""
+    clone_options = ""
+    submodule_update = ""
+    if recurse_submodules:
+        # Point the submodules at their mirrors too.
+        git_config = " -c protocol.file.allow=always"
+        if os.path.exists(f"{mirror_dir}/url_rewrites.json"):
+            with open(f"{mirror_dir}/url_rewrites.json") as url_rewrites_file:
+                for submodule_url, submodule_mirror in json.load(url_rewrites_file).items():
+                    git_config += f" -c url.{submodule_mirror}.insteadOf={submodule_url}"
+        clone_options = " --recurse-submodules"
+        submodule_update = f"\n    git{git_config} -C {dest} submodule update --init --recursive"
+    return f"""if [ -d {dest}/.git ]; then
+    git -C {dest} fetch --quiet origin
+    git -C {dest} checkout --quiet --detach origin/HEAD{submodule_update}
+elif [ -e {dest} ]; then
+    rm -rf {dest}.clone
+    git{git_config} clone --quiet --shared --no-checkout {mirror_path(name)} {dest}.clone
+    mv {dest}.clone/.git {dest}/.git
+    rmdir {dest}.clone
+    git -C {dest} checkout --quiet --force --detach origin/HEAD{submodule_update}
+else
+    git{git_config} clone --shared{clone_options} {mirror_path(name)} {dest}
+fi"""
 
 def make_build_directories():
     if not os.path.isdir("builds"):
@@ -90,98 +914,963 @@ prepend-path --delim {{:}} CMAKE_PREFIX_PATH {{{top_level_dir}/cmake/install/.}}
     
     return True
 
-def build_once_modules():
-    dir_name = f"build_once_modules"
-    build_once_dir_path = f"{top_level_dir}/builds/build_once_modules"
-    build_type = f"build_once"
+def setup_ccache():
+    # Apply the size cap (ccache evicts the oldest entries past it) and start
+    # this update's stats from scratch.
+    if shutil.which("ccache") is None:
+        print("No ccache found, building without a compiler cache")
+        return False
+    os.makedirs(ccache_dir, exist_ok=True)
+    subprocess.run(["ccache", "--max-size", ccache_max_size], env=dict(os.environ, CCACHE_DIR=ccache_dir), stdout=subprocess.DEVNULL)
+    if os.path.exists(ccache_stats_dir):
+        shutil.rmtree(ccache_stats_dir)
+    os.makedirs(ccache_stats_dir)
+    return True
+
+def ccache_script(package, dir_name, autotools=False):
+    # Shell lines putting ccache in front of the compilers, when there is one.
+    # CMake (3.17+) picks the launchers up from the environment, autotools
+    # gets them through CC/CXX. Paths get hashed relative to builds/, so
+    # dated and per-variant build directories share cache entries.
+    ccache_exports = [
+        f"export CCACHE_DIR={ccache_dir}",
+        f"export CCACHE_BASEDIR={top_level_dir}/builds",
+        "export CCACHE_NOHASHDIR=1",
+        f"export CCACHE_STATSLOG={ccache_stats_dir}/{package}@{dir_name}.log",
+        "export CMAKE_C_COMPILER_LAUNCHER=ccache",
+        "export CMAKE_CXX_COMPILER_LAUNCHER=ccache",
+        "export CMAKE_CUDA_COMPILER_LAUNCHER=ccache",
+    ]
+    if autotools:
+        ccache_exports += ['export CC="ccache mpicc"', 'export CXX="ccache mpicxx"']
+    ccache_exports_script = "\n".join(f"    {line}" for line in ccache_exports)
+    return f"""if command -v ccache > /dev/null; then
+{ccache_exports_script}
+fi"""
+
+def ccache_package_stats():
+    # {package: (hits, misses)} summed over this update's builds of package.
+    package_stats = {}
+    for stats_log_path in glob.glob(f"{ccache_stats_dir}/*.log"):
+        package = os.path.basename(stats_log_path).split("@")[0]
+        hits, misses = package_stats.get(package, (0, 0))
+        with open(stats_log_path) as stats_log:
+            for line in stats_log:
+                counter = line.strip()
+                if counter in ("direct_cache_hit", "preprocessed_cache_hit"):
+                    hits += 1
+                elif counter == "cache_miss":
+                    misses += 1
+        package_stats[package] = (hits, misses)
+    return package_stats
+
+def report_ccache_stats():
+    package_stats = ccache_package_stats()
+    if not package_stats:
+        return True
+    print("Compiler cache this update:")
+    for package, (hits, misses) in sorted(package_stats.items()):
+        hit_percent = 100 * hits / (hits + misses) if hits + misses else 0
+        print(f"    {package:<10} {hits:>7} hits {misses:>7} misses ({hit_percent:.0f}% hits)")
+    return True
+
+def rust_env_script():
+    # Shell lines pointing rustup/cargo at the shared toolchain and caches.
+    return f"""export CARGO_HOME={rust_dir}/cargo
+export RUSTUP_HOME={rust_dir}/multirust
+export RUSTUP_TOOLCHAIN={rust_toolchain_version}
+export CARGO_TARGET_DIR={rust_dir}/target/RustBCA"""
+
+def cargo_offline_flags():
+    if not rust_offline:
+        return ""
+    return f"""--offline --config 'source.crates-io.replace-with="vendored-sources"' --config 'source.vendored-sources.directory="{rust_vendor_dir}"'"""
+
+def stage_script(build_dir_path, package, stage, commands):
+    # Shell lines running commands as one stage (fetched, configured, built,
+    # installed) of package's build in build_dir_path, unless an earlier run
+    # already got through it. The commands run with set -e, and a failure
+    # stops the whole build script there, without marking the stage done.
+    # Either way the stage's start, end and exit code go into the times
+    # file, for record_build_steps.
+    marker_path = f"{build_dir_path}/.stages/{package}.{stage}"
+    return f"""if [ ! -e {marker_path} ]; then
+mkdir -p {build_dir_path}/.stages
+stage_start=$(date +%s.%N)
+set +e
+(
+set -e
+{commands}
+)
+stage_exit_code=$?
+set -e
+echo "{stage} $stage_start $(date +%s.%N) $stage_exit_code" >> {build_dir_path}/.stages/{package}.times
+[ $stage_exit_code -eq 0 ] || exit $stage_exit_code
+touch {marker_path}
+echo "==> stage {stage}"
+fi"""
+
+def reset_stages(package, stage_key, build_dir_path):
+    # Stage markers only count for the build they were made for (same cache
+    # key), so a new upstream revision goes through every stage again.
+    stages_dir = f"{build_dir_path}/.stages"
+    key_path = f"{stages_dir}/{package}.key"
+    if os.path.exists(key_path):
+        with open(key_path) as key_file:
+            if key_file.read() == stage_key:
+                return True
+    for marker_path in glob.glob(f"{stages_dir}/{package}.*"):
+        os.remove(marker_path)
+    os.makedirs(stages_dir, exist_ok=True)
+    with open(key_path, 'w') as key_file:
+        key_file.write(stage_key)
+    return True
+
+def build_once_dir_name(package, build_type):
+    # Build-once packages that do not care about the build type all go in
+    # one "common" directory.
+    if "build_type" in build_once_package_axes[package]:
+        return f"build_once_modules-{build_type}-{current_datetime}"
+    return f"build_once_modules-common-{current_datetime}"
+
+def build_once_scripts(dir_name, build_type):
+    stage = functools.partial(stage_script, f"{top_level_dir}/builds/{dir_name}")
     
+    # No cuda module here, none of these use it.
     build_once_modules_script = f"""
 module purge
 module use {top_level_dir}/modulefiles
 module --ignore_cache load {compiler_module} {mpi_module} {cmake_module}
 """ 
-    build_once_files = f"""
-cd builds
-mkdir {dir_name}
-cd {dir_name}
-"""
-    build_once_rust = f"""
-# install rust
-# set up directories for rust install files
-mkdir cargo
-mkdir multirust
+    build_once_rust = build_once_modules_script + f"""
+# install rust, once for everyone, into {rust_dir}
 # setting these env variables installs rust locally,
 # rather than in home directory
-export CARGO_HOME=$PWD/cargo
-export RUSTUP_HOME=$PWD/multirust
-curl --proto '=https' --tlsv1.2 -sSf https://sh.rustup.rs | sh -s -- -y --no-modify-path
+mkdir -p {rust_dir}
+{rust_env_script()}
+if [ ! -x $CARGO_HOME/bin/rustup ]; then
+    curl --proto '=https' --tlsv1.2 -sSf https://sh.rustup.rs | sh -s -- -y --no-modify-path --profile minimal --default-toolchain {rust_toolchain_version}
+fi
 source $CARGO_HOME/env
+rustup toolchain list | grep -q "^{rust_toolchain_version}" || rustup toolchain install --profile minimal {rust_toolchain_version}
 cd {top_level_dir}/builds/{dir_name}
-""" #Rust does depend on MPI
-    build_once_hypre = f"""
-# install hypre
-# TODO build cuda-aware hypre when cuda enabled
-mkdir hypre_dev
-cd hypre_dev
-git clone https://github.com/hypre-space/hypre.git #git@github.com:hypre-space/hypre.git
-cd hypre/src
-./configure
-make -j{num_build_cores}
-make install
-cd {top_level_dir}/builds/{dir_name}
-""" #Hypre can depend on mpi and CUDA
-
-    build_once_spdlog = f"""
+"""
+    build_once_spdlog = build_once_modules_script + f"""
 # install spdlog
-mkdir spdlog_dev && cd spdlog_dev
-git clone https://github.com/gabime/spdlog.git #git@github.com:gabime/spdlog.git
-mkdir build && cd build
-cmake ../spdlog -DCMAKE_INSTALL_PREFIX=../install -DCMAKE_BUILD_TYPE={build_type}
-make -j{num_build_cores}
-make install
 cd {top_level_dir}/builds/{dir_name}
-""" #probably can depend on mpi 
-
-    build_once_metis = f"""
+{ccache_script("spdlog", dir_name)}
+mkdir -p spdlog_dev && cd spdlog_dev
+{stage("spdlog", "fetched", git_clone_command("spdlog"))}
+mkdir -p build && cd build
+{stage("spdlog", "configured", f"cmake ../spdlog -DCMAKE_INSTALL_PREFIX=../install -DCMAKE_BUILD_TYPE={build_type}")}
+{stage("spdlog", "built", "make")}
+{stage("spdlog", "installed", "make install")}
+cd {top_level_dir}/builds/{dir_name}
+"""
+    build_once_metis = build_once_modules_script + f"""
 # install metis 5
-wget https://github.com/mfem/tpls/raw/gh-pages/metis-5.1.0.tar.gz
-tar -xvf metis-5.1.0.tar.gz
+cd {top_level_dir}/builds/{dir_name}
+{ccache_script("metis", dir_name)}
+{stage("metis", "fetched", f"tar --keep-directory-symlink -xvf {tarball_path('metis')}")}
 cd metis-5.1.0
-make config prefix=install
-make -j{num_build_cores}
-make install
+{stage("metis", "configured", "make config prefix=install")}
+{stage("metis", "built", "make")}
+{stage("metis", "installed", "make install")}
 cd {top_level_dir}/builds/{dir_name}
-""" #maybe but this one is a ghost online, so probably? 
-    build_once_rustbca = f"""
+"""
+    rustbca_build_cmd = f"cargo build --release --lib {cargo_offline_flags()}"
+    # Keep the vendored crates up to date while we are online, so an offline
+    # run has them.
+    if not rust_offline:
+        rustbca_build_cmd += f"\ncargo vendor --quiet {rust_vendor_dir} > /dev/null"
+    # the target directory is shared, so keep our own copy of the library
+    rustbca_install_cmd = """mkdir -p target/release
+cp $CARGO_TARGET_DIR/release/liblibRustBCA.so target/release/
+mkdir -p include lib
+ln -sf ../RustBCA.h include/
+ln -sf ../target/release/liblibRustBCA.so lib/"""
+    build_once_rustbca = build_once_modules_script + f"""
 # install rustbca
-git clone https://github.com/lcpp-org/RustBCA.git #git@github.com:lcpp-org/RustBCA.git
+cd {top_level_dir}/builds/{dir_name}
+{rust_env_script()}
+source $CARGO_HOME/env
+{stage("RustBCA", "fetched", git_clone_command("RustBCA"))}
 cd RustBCA
-cargo build --release --lib -j {num_build_cores}
-mkdir include && cd include
-ln -s ../RustBCA.h .
-cd ..
-mkdir lib && cd lib
-ln -s ../target/release/liblibRustBCA.so .
+{stage("RustBCA", "built", rustbca_build_cmd)}
+{stage("RustBCA", "installed", rustbca_install_cmd)}
 cd {top_level_dir}/builds/{dir_name}
-"""  #Depends on rust so it can depend on mpi/cuda
-    #build_once_script = build_once_modules_script + build_once_files + build_once_rust + build_once_hypre + build_once_spdlog + build_once_metis + build_once_rustbca + build_once_hdf5
-    build_once_script = build_once_modules_script + build_once_files + build_once_rust + build_once_hypre + build_once_spdlog + build_once_metis + build_once_rustbca
-    subprocess.run(build_once_script, shell=True)
-    
+"""
+    return {
+        "rust": build_once_rust,
+        "spdlog": build_once_spdlog,
+        "metis": build_once_metis,
+        "RustBCA": build_once_rustbca,
+    }
+
+def prepare_build_once_modules(build_types):
+    # Set up the build-once directories the variants of build_types need.
+    # Returns the build tasks and their deps, keyed "<dir name>/<package>",
+    # and build_once_builds: (package, build type) -> (directory the package
+    # gets built in, its cache key), for prepare_build_dependent.
+    build_once_tasks = {}
+    build_once_deps = {}
+    build_once_builds = {}
+    for build_type in build_types:
+        packages_by_dir = {}
+        for package in build_once_package_axes:
+            packages_by_dir.setdefault(build_once_dir_name(package, build_type), []).append(package)
+        for dir_name, packages in packages_by_dir.items():
+            build_once_dir_path = f"{top_level_dir}/builds/{dir_name}"
+            if f"{dir_name}/{packages[0]}" not in build_once_tasks:
+                # Same as the variants, start over if we already updated today.
+                if os.path.exists(build_once_dir_path) and not incremental_builds:
+                    trash_build(build_once_dir_path)
+                os.makedirs(build_once_dir_path, exist_ok=True)
+                register_build(build_once_dir_path)
+            scripts = build_once_scripts(dir_name, build_type)
+            package_deps = {}
+            for package in packages:
+                package_deps[package] = dependent_package_deps[package]
+                for dep in package_deps[package]:
+                    if dep not in packages:
+                        raise ValueError(f"Build-once package {package} depends on {dep}, which is not built in the same directory")
+            cache_keys = package_cache_keys({package: scripts[package] for package in packages}, package_deps, build_once_dir_path)
+            for package in packages:
+                build_once_builds[(package, build_type)] = (build_once_dir_path, cache_keys[package])
+                if package_install_dirs[package]:
+                    build_once_tasks[f"{dir_name}/{package}"] = functools.partial(build_package_cached, package, cache_keys[package], scripts[package], build_once_dir_path)
+                else:
+                    # Installs outside the build directory (rust), so the
+                    # cache cannot tell if it is still there. The script is
+                    # a no-op when it is.
+                    build_once_tasks[f"{dir_name}/{package}"] = scripts[package]
+                build_once_deps[f"{dir_name}/{package}"] = [f"{dir_name}/{dep}" for dep in package_deps[package]]
+    return build_once_tasks, build_once_deps, build_once_builds
+
+def delete_old_build_once_modules():
+    # The variants keep their own hardlinked copies, so old build-once
+    # directories can go as soon as they age out.
+    for build_once_dir_path in {f"{top_level_dir}/builds/{build_once_dir_name(package, build_type)}" for package in build_once_package_axes for build_type in build_types_arr}:
+        if os.path.isdir(build_once_dir_path):
+            record_build_size(build_once_dir_path)
+    enforce_retention()
+    return True
+
+def build_once_modules(build_types=None):
+    # Build the packages that are the same for every openmp/cuda arch
+    # variant, once for this run. Returns build_once_builds (see
+    # prepare_build_once_modules), and the results and deps of the build
+    # tasks, for print_build_summary.
+    if build_types is None:
+        build_types = build_types_arr
+    build_once_tasks, build_once_deps, build_once_builds = prepare_build_once_modules(build_types)
+    results = run_build_graph(build_once_tasks, build_once_deps, label="[build once] ")
+    delete_old_build_once_modules()
+    return build_once_builds, results, build_once_deps
+
+def run_build_graph(build_tasks, package_deps, label="", max_workers=None):
+    # Run the build task (script or function) of every package as soon as
+    # all the packages it depends on have finished, so independent packages
+    # build concurrently and the whole thing takes about as long as the
+    # longest chain of dependencies. At most max_workers at a time, and when
+    # more are ready the one with the longest (estimated) chain after it
+    # goes first. Packages depending on one that failed are skipped.
+    # Returns a dict of package name -> exit code of its build task (None if
+    # it got skipped).
+    for package in build_tasks:
+        for dep in package_deps.get(package, []):
+            if dep not in build_tasks:
+                raise ValueError(f"{package} depends on {dep}, which has no build task")
+    if max_workers is None:
+        # Every build script holds a jobserver token while it runs, so more
+        # would only queue up for the tokens, in no particular order.
+        max_workers = num_build_cores
+
+    remaining_deps = {package: set(package_deps.get(package, [])) for package in build_tasks}
+    dependents = {package: [] for package in build_tasks}
+    failed_deps = {package: [] for package in build_tasks}
+    for package, deps in remaining_deps.items():
+        for dep in deps:
+            dependents[dep].append(package)
+
+    # Whatever is ready and has the longest chain of builds still to come
+    # after it goes first.
+    priorities = critical_path_priorities(build_tasks, package_deps, task_cost_estimates(build_tasks))
+    if build_tasks:
+        chain = [max(build_tasks, key=lambda package: priorities[package])]
+        while dependents[chain[-1]]:
+            chain.append(max(dependents[chain[-1]], key=lambda package: priorities[package]))
+        print(f"{label}Longest chain, about {priorities[chain[0]]:.0f} minutes: {' -> '.join(chain)}")
+
+    results = {}
+    ready = [(-priorities[package], package) for package, deps in remaining_deps.items() if not deps]
+    heapq.heapify(ready)
+    running = {}
+    start_times = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while ready or running:
+            while ready and len(running) < max_workers:
+                _, package = heapq.heappop(ready)
+                print(f"{label}Starting {package}")
+                start_times[package] = time.time()
+                running[executor.submit(run_build_task, build_tasks[package])] = package
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            finished = []
+            for future in done:
+                package = running.pop(future)
+                results[package] = future.result()
+                print(f"{label}Finished {package} (exit code {results[package]})")
+                record_build_task(label.strip(), package, package_deps.get(package, []), start_times[package], time.time() - start_times[package], results[package])
+                finished.append(package)
+            while finished:
+                package = finished.pop()
+                for dependent in dependents[package]:
+                    remaining_deps[dependent].discard(package)
+                    if results[package] != 0:
+                        failed_deps[dependent].append(package)
+                    if not remaining_deps[dependent]:
+                        if failed_deps[dependent]:
+                            results[dependent] = None
+                            print(f"{label}Skipping {dependent}, {', '.join(failed_deps[dependent])} did not build")
+                            finished.append(dependent)
+                        else:
+                            heapq.heappush(ready, (-priorities[dependent], dependent))
+
+    if len(results) != len(build_tasks):
+        # Only happens if the dependencies have a cycle in them.
+        stuck = [package for package in build_tasks if package not in results]
+        raise ValueError(f"Could not build {stuck}, circular dependencies?")
+
+    return results
+
+def task_package(name):
+    # Package a build task is for: "<dir>/mfem", "mfem" or "hpic2-<variant>".
+    package = name.rsplit("/", 1)[-1]
+    if package.startswith("hpic2-"):
+        return "hpic2"
+    return package
+
+def is_cuda_build(name):
+    return "cuda-arch-" in name and "cuda-arch-None" not in name
+
+def task_cost_estimates(task_names):
+    # Minutes each build task should take: the mean of the last few
+    # successful builds of its package with CUDA or without (whichever the
+    # task is, if its name says), or of any of them, or the default tables.
+    history = {}
+    if os.path.exists(timing_db_path):
+        timing_db_connection = timing_db()
+        for package, build_dir, duration in timing_db_connection.execute("SELECT package, build_dir, duration FROM build_steps WHERE phase = 'total' AND exit_code = 0 ORDER BY start DESC LIMIT 1000"):
+            for key in [(package, is_cuda_build(build_dir)), (package, None)]:
+                durations = history.setdefault(key, [])
+                if len(durations) < 5:
+                    durations.append(duration / 60)
+        timing_db_connection.close()
+    costs = {}
+    for name in task_names:
+        package = task_package(name)
+        cuda = is_cuda_build(name) if "cuda-arch-" in name else None
+        for key in [(package, cuda), (package, None)]:
+            if key in history:
+                costs[name] = sum(history[key]) / len(history[key])
+                break
+        else:
+            costs[name] = default_build_minutes.get(package, 1)
+            if cuda:
+                costs[name] = default_cuda_build_minutes.get(package, costs[name])
+    return costs
+
+def critical_path_priorities(build_tasks, package_deps, costs):
+    # For every task, the minutes from when it starts to when the last task
+    # depending on it (directly or not) can finish: its own cost plus the
+    # longest such chain after it. Worked out from the end of the graph.
+    dependents = {package: [] for package in build_tasks}
+    for package in build_tasks:
+        for dep in package_deps.get(package, []):
+            dependents[dep].append(package)
+    dependents_left = {package: len(dependents[package]) for package in build_tasks}
+    priorities = {}
+    done = [package for package in build_tasks if not dependents[package]]
+    for package in done:
+        priorities[package] = costs[package] + max((priorities[dependent] for dependent in dependents[package]), default=0)
+        for dep in package_deps.get(package, []):
+            dependents_left[dep] -= 1
+            if dependents_left[dep] == 0:
+                done.append(dep)
+    # Anything left is in a cycle, which run_build_graph reports.
+    for package in build_tasks:
+        priorities.setdefault(package, costs[package])
+    return priorities
+
+def run_build_task(task):
+    # A task is either a shell script or a python function that returns True
+    # when it worked (like the rest of the functions in here). Either way,
+    # hand back an exit code.
+    if isinstance(task, str):
+        return run_build_script(task).returncode
+    try:
+        return 0 if task() else 1
+    except Exception:
+        # Counts as a failed build, the rest of the graph keeps going.
+        traceback.print_exc()
+        return 1
+
+def print_build_summary(results, task_deps):
+    # What happened to every build task (see run_build_graph), and for the
+    # skipped ones, which of their dependencies did not make it.
+    print("Build summary:")
+    name_width = max(len(name) for name in results)
+    for name, exit_code in sorted(results.items()):
+        if exit_code == 0:
+            status = "ok"
+        elif exit_code is None:
+            failed_deps = [dep for dep in task_deps.get(name, []) if results.get(dep) != 0]
+            status = f"skipped, {', '.join(failed_deps)} did not build"
+        else:
+            status = f"FAILED (exit code {exit_code})"
+        print(f"    {name:<{name_width}}  {status}")
+    return True
+
+def package_revision(package):
+    # What upstream version of package a build would get right now.
+    if package in upstream_sources:
+        rev_parse = subprocess.run(["git", "-C", mirror_path(package), "rev-parse", "HEAD"], capture_output=True, text=True)
+        return rev_parse.stdout.strip()
+    if package in upstream_tarballs:
+        tarball_hash = hashlib.sha256()
+        with open(tarball_path(package), 'rb') as tarball:
+            for chunk in iter(lambda: tarball.read(1024 * 1024), b""):
+                tarball_hash.update(chunk)
+        return tarball_hash.hexdigest()
+    if package == "rust":
+        return rust_toolchain_version
+    return None
+
+def remote_revision(package):
+    # Like package_revision, but asks upstream directly, so it works before
+    # the mirrors get fetched. Goes by the mirror if upstream is unreachable.
+    if package in upstream_sources:
+        ls_remote = subprocess.run(["git", "ls-remote", upstream_url(package), "HEAD"], capture_output=True, text=True)
+        if ls_remote.returncode == 0 and ls_remote.stdout.strip():
+            return ls_remote.stdout.split()[0]
+        print(f"Could not reach upstream {package}, going by its mirror")
+        if not os.path.isdir(mirror_path(package)):
+            return None
+    if package in upstream_tarballs and not os.path.exists(tarball_path(package)):
+        return None
+    return package_revision(package)
+
+def script_hash():
+    # Changing the variants, flags, etc. in here has to trigger a rebuild too.
+    with open(os.path.abspath(__file__), 'rb') as script_file:
+        return hashlib.sha256(script_file.read()).hexdigest()
+
+def upstream_packages():
+    return list(upstream_sources) + list(upstream_tarballs) + ["rust"]
+
+def built_upstream_packages(with_hpic2):
+    # The upstream packages an update builds. The serial update never
+    # builds hpic2, and the others only with Release deps to build it on.
+    return [package for package in upstream_packages() if with_hpic2 or package != "hpic2"]
+
+def read_upstream_lock():
+    if not os.path.exists(upstream_lock_path):
+        return None
+    with open(upstream_lock_path) as lock_file:
+        return json.load(lock_file)
+
+def changed_upstream_packages(packages):
+    # Which of packages moved upstream since the last successful update
+    # that built them, or None if everything has to be rebuilt anyway (no
+    # lock yet, or this script changed).
+    upstream_lock = read_upstream_lock()
+    if upstream_lock is None or upstream_lock["script"] != script_hash():
+        return None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(packages)) as executor:
+        revisions = dict(zip(packages, executor.map(remote_revision, packages)))
+    return [package for package, revision in revisions.items() if revision is None or upstream_lock["revisions"].get(package) != revision]
+
+def check_upstream_changes(packages):
+    # Pre-flight for the updates, which build packages. Returns False if
+    # there is nothing to do.
+    if force_update:
+        return True
+    changed_packages = changed_upstream_packages(packages)
+    if changed_packages is None:
+        return True
+    if not changed_packages:
+        print(f"Nothing changed upstream since the update in {upstream_lock_path}, nothing to do (use --force to rebuild anyway)")
+        return False
+    # Only to tell what to expect: everything gets built as always, and
+    # the build cache reuses what did not change.
+    affected_packages = set(changed_packages)
+    while True:
+        dependents = {package for package, deps in dependent_package_deps.items() if affected_packages.intersection(deps)}
+        if dependents <= affected_packages:
+            break
+        affected_packages |= dependents
+    if "hpic2" in packages:
+        affected_packages.add("hpic2")
+    print(f"Changed upstream: {', '.join(sorted(changed_packages))}; rebuilding {', '.join(sorted(affected_packages))}")
+    return True
+
+def write_upstream_lock(packages):
+    # Call after a successful update that built packages, once the mirrors
+    # have what got built. The revisions of packages it did not build stay
+    # at the last update that did (if it was with the same script).
+    upstream_lock = read_upstream_lock()
+    revisions = {}
+    if upstream_lock is not None and upstream_lock["script"] == script_hash():
+        revisions = upstream_lock["revisions"]
+    revisions.update({package: package_revision(package) for package in packages})
+    upstream_lock = {
+        "date": current_datetime,
+        "script": script_hash(),
+        "revisions": revisions,
+    }
+    with open(f"{upstream_lock_path}.{os.getpid()}", 'w') as lock_file:
+        json.dump(upstream_lock, lock_file, indent=4)
+    os.replace(f"{upstream_lock_path}.{os.getpid()}", upstream_lock_path)
+    return True
+
+def package_cache_keys(build_scripts, package_deps, build_dir_path, known_keys=None):
+    # Cache key of every package: its upstream revision, its build script
+    # (which has the configure/cmake flags and compiler/MPI/CUDA modules in
+    # it) and the keys of everything it depends on. The build directory is
+    # taken out of the script since it has the date in it. known_keys has the
+    # keys of dependencies built somewhere else (the build-once packages).
+    cache_keys = dict(known_keys or {})
+    def cache_key(package):
+        if package not in cache_keys:
+            key_contents = {
+                "package": package,
+                "revision": package_revision(package),
+                "script": build_scripts[package].replace(build_dir_path, "@BUILD_DIR@").replace(os.path.basename(build_dir_path), "@BUILD_DIR_NAME@"),
+                "deps": {dep: cache_key(dep) for dep in sorted(package_deps.get(package, []))},
+            }
+            cache_keys[package] = hashlib.sha256(json.dumps(key_contents, sort_keys=True).encode()).hexdigest()
+        return cache_keys[package]
+    for package in build_scripts:
+        cache_key(package)
+    return {package: cache_keys[package] for package in build_scripts}
+
+def find_cached_build(package, cache_key):
+    # Build directory of an earlier build of package with the same cache key,
+    # if one is still around and complete.
+    entry_path = f"{build_cache_dir}/{cache_key}.json"
+    if not os.path.exists(entry_path):
+        return None
+    with open(entry_path) as entry_file:
+        cached_dir_path = json.load(entry_file)["path"]
+    for install_dir in package_install_dirs[package]:
+        if not os.path.isdir(f"{cached_dir_path}/{install_dir}"):
+            return None
+    return cached_dir_path
+
+def record_cached_build(package, cache_key, build_dir_path):
+    # One file per entry, written with a rename, so concurrent builds (or
+    # slurm tasks on other nodes) never step on each other.
+    os.makedirs(build_cache_dir, exist_ok=True)
+    entry_path = f"{build_cache_dir}/{cache_key}.json"
+    with open(f"{entry_path}.{os.getpid()}", 'w') as entry_file:
+        json.dump({"package": package, "path": build_dir_path, "date": current_datetime}, entry_file, indent=4)
+    os.replace(f"{entry_path}.{os.getpid()}", entry_path)
+    return True
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+def unlink_hardlinks(path):
+    # Give every file under path that is hardlinked from somewhere else (by
+    # reuse_cached_build) a copy of its own, before a build writes into
+    # path in place: make install and cp overwrite existing files through
+    # the link, which would change the build it came from too.
+    for root, dirs, files in os.walk(path):
+        for file_name in files:
+            file_path = os.path.join(root, file_name)
+            if file_name.endswith(".hpic2-unlink"):
+                # Left by a killed update.
+                os.remove(file_path)
+                continue
+            file_stat = os.lstat(file_path)
+            if stat.S_ISREG(file_stat.st_mode) and file_stat.st_nlink > 1:
+                shutil.copy2(file_path, f"{file_path}.hpic2-unlink")
+                os.replace(f"{file_path}.hpic2-unlink", file_path)
+    return True
+
+def elf_rpaths(contents):
+    # [(dynamic tag, offset in contents, path list)] of the DT_RPATH and
+    # DT_RUNPATH entries of an ELF file, [] for anything else.
+    if contents[:4] != b"\x7fELF":
+        return []
+    rpaths = []
+    try:
+        bits64 = contents[4] == 2
+        endian = "<" if contents[5] == 1 else ">"
+        if bits64:
+            section_headers, = struct.unpack_from(f"{endian}Q", contents, 0x28)
+            section_header_size, num_sections = struct.unpack_from(f"{endian}HH", contents, 0x3A)
+        else:
+            section_headers, = struct.unpack_from(f"{endian}I", contents, 0x20)
+            section_header_size, num_sections = struct.unpack_from(f"{endian}HH", contents, 0x2E)
+        def section(index):
+            # (type, offset, size, link) of a section header.
+            header = section_headers + index * section_header_size
+            if bits64:
+                return struct.unpack_from(f"{endian}I", contents, header + 4) + struct.unpack_from(f"{endian}QQI", contents, header + 24)
+            return struct.unpack_from(f"{endian}I", contents, header + 4) + struct.unpack_from(f"{endian}III", contents, header + 16)
+        entry_format = f"{endian}qQ" if bits64 else f"{endian}iI"
+        for index in range(num_sections):
+            section_type, offset, size, link = section(index)
+            if section_type != 6: # SHT_DYNAMIC
+                continue
+            strings_offset = section(link)[1]
+            for tag, value in struct.iter_unpack(entry_format, contents[offset:offset + size - size % struct.calcsize(entry_format)]):
+                if tag in [15, 29]: # DT_RPATH, DT_RUNPATH
+                    path_offset = strings_offset + value
+                    rpaths.append((tag, path_offset, contents[path_offset:contents.index(b"\0", path_offset)].decode()))
+    except (struct.error, IndexError, ValueError, UnicodeDecodeError):
+        return []
+    return rpaths
+
+def relocate_rpaths(file_path, contents, old_prefix, new_prefix):
+    # Point the RPATHs of a binary that point into old_prefix at new_prefix
+    # instead. Leaving them would break it once old_prefix is gone (scratch,
+    # or an old build that got deleted), so this fails if it cannot.
+    for tag, path_offset, rpath in elf_rpaths(contents):
+        if old_prefix not in rpath:
+            continue
+        new_rpath = ":".join(new_prefix + path[len(old_prefix):] if path.startswith(old_prefix) else path for path in rpath.split(":"))
+        shutil.copy2(file_path, f"{file_path}.relocate")
+        if patchelf_path is not None:
+            if subprocess.run([patchelf_path, "--set-rpath", new_rpath] + (["--force-rpath"] if tag == 15 else []) + [f"{file_path}.relocate"]).returncode != 0:
+                os.remove(f"{file_path}.relocate")
+                print(f"{file_path}: patchelf could not change its RPATH {rpath} to {new_rpath}")
+                return False
+        elif len(new_rpath) <= len(rpath):
+            with open(f"{file_path}.relocate", 'r+b') as new_file:
+                new_file.seek(path_offset)
+                new_file.write(new_rpath.encode().ljust(len(rpath.encode()), b"\0"))
+        else:
+            os.remove(f"{file_path}.relocate")
+            print(f"{file_path}: its RPATH {rpath} points into {old_prefix}, and {new_rpath} does not fit in its place without patchelf (set HPIC2_PATCHELF)")
+            return False
+        os.replace(f"{file_path}.relocate", file_path)
     return True
 
-def build_dependent(openmp_option, cuda_arch_option, build_type):
+def relocate_prefix(path, old_prefix, new_prefix):
+    # Installs have their own absolute path baked into cmake configs,
+    # pkg-config files, compiler wrappers, the RPATHs of binaries, etc. Fix
+    # up the text files, binaries and symlinks under path. Changed files
+    # are written out fresh so the hardlinked original in the old build is
+    # left alone. Returns False if a binary could not be fixed.
+    old_prefix_bytes = old_prefix.encode()
+    new_prefix_bytes = new_prefix.encode()
+    for root, dirs, files in os.walk(path):
+        for file_name in files:
+            file_path = os.path.join(root, file_name)
+            if os.path.islink(file_path):
+                link_target = os.readlink(file_path)
+                if link_target.startswith(old_prefix):
+                    os.unlink(file_path)
+                    os.symlink(new_prefix + link_target[len(old_prefix):], file_path)
+                continue
+            with open(file_path, 'rb') as old_file:
+                if old_file.read(4) == b"\x7fELF":
+                    # Whatever their size, and only their RPATHs.
+                    old_file.seek(0)
+                    contents = old_file.read()
+                    if old_prefix_bytes in contents and not relocate_rpaths(file_path, contents, old_prefix, new_prefix):
+                        return False
+                    continue
+            if os.path.getsize(file_path) > relocate_max_bytes:
+                continue
+            with open(file_path, 'rb') as old_file:
+                contents = old_file.read()
+            if old_prefix_bytes not in contents or b"\0" in contents:
+                continue
+            with open(f"{file_path}.relocate", 'wb') as new_file:
+                new_file.write(contents.replace(old_prefix_bytes, new_prefix_bytes))
+            shutil.copymode(file_path, f"{file_path}.relocate")
+            os.replace(f"{file_path}.relocate", file_path)
+    return True
+
+def reuse_build_once(package, cache_key, build_dir_path):
+    # Variant's copy of a build-once package, as long as that actually built.
+    if not package_install_dirs[package]:
+        return True
+    cached_dir_path = find_cached_build(package, cache_key)
+    if cached_dir_path is None:
+        print(f"{package}: the build-once build of it did not finish, nothing to reuse")
+        return False
+    return reuse_cached_build(package, cached_dir_path, build_dir_path)
+
+def reuse_cached_build(package, cached_dir_path, build_dir_path):
+    # Hardlink package's install directories from cached_dir_path into
+    # build_dir_path. Fails (with nothing left of them) if the RPATHs of
+    # its binaries could not be pointed at build_dir_path, since
+    # cached_dir_path may get slimmed or deleted.
+    for install_dir in package_install_dirs[package]:
+        if os.path.exists(f"{build_dir_path}/{install_dir}"):
+            shutil.rmtree(f"{build_dir_path}/{install_dir}")
+        shutil.copytree(f"{cached_dir_path}/{install_dir}", f"{build_dir_path}/{install_dir}", symlinks=True, copy_function=link_or_copy)
+        if not relocate_prefix(f"{build_dir_path}/{install_dir}", cached_dir_path, build_dir_path):
+            for install_dir in package_install_dirs[package]:
+                shutil.rmtree(f"{build_dir_path}/{install_dir}", ignore_errors=True)
+            return False
+    return True
+
+# GB of scratch_dir the packages building on it right now might still take.
+scratch_lock = threading.Lock()
+scratch_reserved_gb = 0
+
+def published_dirs(package):
+    # What of a package built on scratch gets copied back: what the
+    # modulefiles and build cache use, and all of hpic2 (its build
+    # directory is on the PATH, and see slim_builds for its source), so
+    # the tree ends up the same as when building in place.
+    if package == "hpic2":
+        return package_work_dirs["hpic2"]
+    return package_install_dirs[package]
+
+def stage_on_scratch(package, build_dir_path):
+    # Point the work directories of package in build_dir_path at scratch,
+    # if scratch builds are on and there is room. Returns where
+    # build_dir_path is on scratch, or None to build in place.
+    global scratch_reserved_gb
+    if not scratch_builds or not package_work_dirs.get(package):
+        return None
+    for work_dir in package_work_dirs[package]:
+        if os.path.exists(f"{build_dir_path}/{work_dir}") and not os.path.islink(f"{build_dir_path}/{work_dir}"):
+            # Built in place before (an incremental rebuild), stay there.
+            return None
+    with scratch_lock:
+        os.makedirs(scratch_dir, exist_ok=True)
+        free_gb = shutil.disk_usage(scratch_dir).free / 1024**3 - scratch_reserved_gb
+        if free_gb < scratch_package_gb:
+            print(f"{package}: only {free_gb:.1f} GB left on {scratch_dir}, building in place")
+            return None
+        scratch_reserved_gb += scratch_package_gb
+        # Under the lock, publish_package might be removing it.
+        scratch_build_path = f"{scratch_dir}/{os.path.basename(build_dir_path)}"
+        fresh = False
+        for work_dir in package_work_dirs[package]:
+            scratch_work_path = f"{scratch_build_path}/{work_dir}"
+            if not os.path.isdir(scratch_work_path):
+                if os.path.islink(scratch_work_path):
+                    os.unlink(scratch_work_path)
+                os.makedirs(scratch_work_path)
+                fresh = True
+            if os.path.islink(f"{build_dir_path}/{work_dir}"):
+                os.unlink(f"{build_dir_path}/{work_dir}")
+            os.makedirs(build_dir_path, exist_ok=True)
+            os.symlink(scratch_work_path, f"{build_dir_path}/{work_dir}")
+        # What got built (or reused) in place already, for relative paths
+        # like in publish_package.
+        for work_dirs in package_work_dirs.values():
+            for work_dir in work_dirs:
+                if os.path.isdir(f"{build_dir_path}/{work_dir}") and not os.path.lexists(f"{scratch_build_path}/{work_dir}"):
+                    os.symlink(f"{build_dir_path}/{work_dir}", f"{scratch_build_path}/{work_dir}")
+    if fresh:
+        # Whatever stages an earlier run got through happened on a scratch
+        # that is gone now (another node, or wiped), so start over.
+        for marker_path in glob.glob(f"{build_dir_path}/.stages/{package}.*"):
+            if not marker_path.endswith((".key", ".times")):
+                os.remove(marker_path)
+    return scratch_build_path
+
+def unstage_from_scratch(package, build_dir_path, scratch_build_path):
+    for work_dir in package_work_dirs[package]:
+        if os.path.islink(f"{build_dir_path}/{work_dir}"):
+            os.unlink(f"{build_dir_path}/{work_dir}")
+        shutil.rmtree(f"{scratch_build_path}/{work_dir}", ignore_errors=True)
+    for marker_path in glob.glob(f"{build_dir_path}/.stages/{package}.*"):
+        if not marker_path.endswith((".key", ".times")):
+            os.remove(marker_path)
+    return True
+
+def publish_package(package, build_dir_path, scratch_build_path):
+    # Copy what package built on scratch into build_dir_path, each of its
+    # published_dirs in one go under a temporary name and then renamed into
+    # place, with the scratch paths baked into it fixed. Its work
+    # directories on scratch then become symlinks to the published ones,
+    # for packages still building on scratch that find it by a relative
+    # path (like pumiMBBL's ../../kokkos_dev/install), and once only such
+    # symlinks are left the build directory on scratch goes. If a binary
+    # could not be fixed up, nothing gets published and the package stays
+    # on scratch.
+    for work_dir in package_work_dirs[package]:
+        if os.path.islink(f"{build_dir_path}/{work_dir}"):
+            os.unlink(f"{build_dir_path}/{work_dir}")
+    publish_paths = []
+    for install_dir in published_dirs(package):
+        if not os.path.isdir(f"{scratch_build_path}/{install_dir}"):
+            # Went somewhere else, say the build script replaced the
+            # symlink with a directory of its own.
+            continue
+        publish_path = f"{build_dir_path}/{install_dir}"
+        os.makedirs(os.path.dirname(publish_path), exist_ok=True)
+        if os.path.lexists(f"{publish_path}.publish"):
+            # Left by an update that got killed publishing.
+            shutil.rmtree(f"{publish_path}.publish")
+        shutil.copytree(f"{scratch_build_path}/{install_dir}", f"{publish_path}.publish", symlinks=True)
+        publish_paths.append(publish_path)
+        if not relocate_prefix(f"{publish_path}.publish", scratch_build_path, build_dir_path):
+            print(f"{package}: not publishing it from {scratch_build_path}")
+            for publish_path in publish_paths:
+                shutil.rmtree(f"{publish_path}.publish")
+            for work_dir in package_work_dirs[package]:
+                shutil.rmtree(f"{build_dir_path}/{work_dir}", ignore_errors=True)
+                os.symlink(f"{scratch_build_path}/{work_dir}", f"{build_dir_path}/{work_dir}")
+            return False
+    for publish_path in publish_paths:
+        os.rename(f"{publish_path}.publish", publish_path)
+    for work_dir in package_work_dirs[package]:
+        shutil.rmtree(f"{scratch_build_path}/{work_dir}", ignore_errors=True)
+        os.symlink(f"{build_dir_path}/{work_dir}", f"{scratch_build_path}/{work_dir}")
+    with scratch_lock:
+        if all(os.path.islink(f"{scratch_build_path}/{entry}") for entry in os.listdir(scratch_build_path)):
+            shutil.rmtree(scratch_build_path)
+    return True
+
+def run_staged_build_script(script, package, build_dir_path):
+    # run_build_script, on scratch if stage_on_scratch says so. If the
+    # build fails because scratch filled up, it goes again in place.
+    global scratch_reserved_gb
+    scratch_build_path = stage_on_scratch(package, build_dir_path)
+    if scratch_build_path is None:
+        return run_build_script(script, package, build_dir_path)
+    try:
+        build_result = run_build_script(script, package, build_dir_path)
+        if build_result.returncode == 0:
+            if not publish_package(package, build_dir_path, scratch_build_path):
+                return subprocess.CompletedProcess(script, 1, stdout=build_result.stdout)
+            return build_result
+        if b"No space left on device" not in (build_result.stdout or b"") and shutil.disk_usage(scratch_dir).free > 1024**3:
+            # Failed for real, leave it on scratch for resume.
+            return build_result
+        print(f"{package}: {scratch_dir} ran out of space, building in place instead")
+        unstage_from_scratch(package, build_dir_path, scratch_build_path)
+    finally:
+        with scratch_lock:
+            scratch_reserved_gb -= scratch_package_gb
+    return run_build_script(script, package, build_dir_path)
+
+def clean_scratch():
+    # Drop the build directories on scratch that everything got published
+    # from, which only have symlinks left in them.
+    if not os.path.isdir(scratch_dir):
+        return True
+    for scratch_build_path in glob.glob(f"{scratch_dir}/*"):
+        if all(os.path.islink(f"{scratch_build_path}/{work_dir}") for work_dir in os.listdir(scratch_build_path)):
+            shutil.rmtree(scratch_build_path)
+    return True
+
+def slim_tree(path, relative_path, keep):
+    # Delete everything under path except the paths in keep (relative to
+    # the build directory, like relative_path is for path).
+    for entry in os.listdir(path):
+        entry_path = f"{path}/{entry}"
+        entry_relative_path = f"{relative_path}/{entry}"
+        if entry_relative_path in keep:
+            continue
+        if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+            if any(keep_path.startswith(f"{entry_relative_path}/") for keep_path in keep):
+                slim_tree(entry_path, entry_relative_path, keep)
+            else:
+                trash_build(entry_path)
+        else:
+            os.remove(entry_path)
+    return True
+
+def slim_package(package, build_dir_path):
+    # Cut package in build_dir_path down to its install directories (see
+    # slim_builds), with the big directories going through the trash.
+    keep = slim_keep_dirs.get(package, package_install_dirs[package])
+    for work_dir in package_work_dirs[package]:
+        if work_dir in keep or not os.path.isdir(f"{build_dir_path}/{work_dir}"):
+            continue
+        slim_tree(f"{build_dir_path}/{work_dir}", work_dir, keep)
+    if slim_docs:
+        for install_dir in package_install_dirs[package]:
+            for doc_glob in slim_doc_globs:
+                for doc_path in glob.glob(f"{build_dir_path}/{install_dir}/{doc_glob}"):
+                    if os.path.isdir(doc_path) and not os.path.islink(doc_path):
+                        trash_build(doc_path)
+    return True
+
+def slim_old_builds():
+    # slim_package every package that finished in the builds from before
+    # today that have not been slimmed yet, and size them again.
+    if not slim_builds:
+        return True
+    for name, entry in sorted(read_build_manifest().items()):
+        build_dir_path = f"{top_level_dir}/builds/{name}"
+        if entry["date"] == current_datetime or entry.get("slimmed") or not os.path.isdir(build_dir_path):
+            continue
+        for package in group_packages(entry["group"]):
+            # Not hpic2, and not what failed or lives in another build.
+            if package in package_install_dirs and package_install_dirs[package] and all(os.path.isdir(f"{build_dir_path}/{install_dir}") for install_dir in package_install_dirs[package]):
+                slim_package(package, build_dir_path)
+        entry["slimmed"] = True
+        entry["size"] = build_size(build_dir_path)
+        write_build_entry(entry)
+    return True
+
+def build_package_cached(package, cache_key, build_script, build_dir_path):
+    # Reuse an identical earlier build of package if there is one, otherwise
+    # run its build script and remember the result for next time.
+    cached_dir_path = find_cached_build(package, cache_key)
+    if cached_dir_path == build_dir_path:
+        # Only happens in incremental builds, it already got built earlier today.
+        print(f"{package}: already built in {build_dir_path}")
+    elif cached_dir_path is not None:
+        print(f"{package}: unchanged, reusing the build in {cached_dir_path}")
+        if not reuse_cached_build(package, cached_dir_path, build_dir_path):
+            print(f"{package}: could not reuse it, building it again")
+            cached_dir_path = None
+    if cached_dir_path is None:
+        reset_stages(package, cache_key, build_dir_path)
+        # Only there in an incremental rebuild or a resume, and maybe
+        # linked from another build by reuse_cached_build.
+        for install_dir in package_install_dirs[package]:
+            if os.path.isdir(f"{build_dir_path}/{install_dir}"):
+                unlink_hardlinks(f"{build_dir_path}/{install_dir}")
+        if run_staged_build_script(build_script, package, build_dir_path).returncode != 0:
+            return False
+        for install_dir in package_install_dirs[package]:
+            if not os.path.isdir(f"{build_dir_path}/{install_dir}"):
+                print(f"{package}: build finished without creating {install_dir}")
+                return False
+    record_cached_build(package, cache_key, build_dir_path)
+    return True
+
+# {(openmp option, cuda arch option, build type): {package: cache key}} of
+# the variants prepare_build_dependent set up, for hpic2's stage key.
+variant_cache_keys = {}
+
+def prepare_build_dependent(openmp_option, cuda_arch_option, build_type, build_once_builds):
+    # Set up the build directory for one variant and return the build task
+    # of every package in it, keyed like dependent_package_deps. Packages
+    # that have not changed since an earlier build get reused from it, and
+    # the build-once packages come from build_once_builds (see
+    # prepare_build_once_modules).
     option_spec_string = f"{'+' if openmp_option else '~'}openmp-cuda-arch-{str(cuda_arch_option)}"
     dir_name = f"hpic2deps-{option_spec_string}-{build_type}-{current_datetime}"
     
     build_dependent_dir_path = f"{top_level_dir}/builds/{dir_name}"
     
-    build_depepndent_dirs = f"cd builds; mkdir {dir_name}; cd {dir_name}"
+    build_depepndent_dirs = f"cd builds; mkdir -p {dir_name}; cd {dir_name}"
+    stage = functools.partial(stage_script, build_dependent_dir_path)
     
     # Remove the build directories for this datetime if it already
     # exists, i.e. if we have already updated today.
-    if os.path.exists(f"builds/{dir_name}"):
-        shutil.rmtree(f"builds/{dir_name}")
+    if os.path.exists(f"builds/{dir_name}") and not incremental_builds:
+        trash_build(f"{top_level_dir}/builds/{dir_name}")
 
     cuda_enabled = cuda_arch_option != None
     # May want to enable Broadwell optimizations, but not sure
@@ -218,7 +1907,6 @@ def build_dependent(openmp_option, cuda_arch_option, build_type):
         hdf5_mpicc_cmd += f"""
 export CC=mpicc
 export HDF5_MPI="ON"
-mpicc ./configure --enable-parallel --enable-shared
 """
     #Starting to load modules with the changes due to ompi and cuda
     module_load_script = f"""
@@ -231,123 +1919,511 @@ module --ignore_cache load {compiler_module} {mpi_module} {cmake_module} {cuda_m
     build_dependent_script_kokkos = module_load_script + f"""
 # install kokkos
 cd {top_level_dir}/builds/{dir_name}
-mkdir kokkos_dev && cd kokkos_dev
-git clone https://github.com/kokkos/kokkos.git #git@github.com:kokkos/kokkos.git
-mkdir build && cd build
-{kokkos_cmake_cmd}
-make -j{num_build_cores}
-make install
+{ccache_script("kokkos", dir_name)}
+mkdir -p kokkos_dev && cd kokkos_dev
+{stage("kokkos", "fetched", git_clone_command("kokkos"))}
+mkdir -p build && cd build
+{stage("kokkos", "configured", kokkos_cmake_cmd)}
+{stage("kokkos", "built", "make")}
+{stage("kokkos", "installed", "make install")}
 cd {top_level_dir}/builds/{dir_name}
 """
     build_dependent_hdf5_mpicc = module_load_script + f"""
 # install hdf5
 cd {top_level_dir}/builds/{dir_name}
-mkdir hdf5_dev && cd hdf5_dev
-git clone https://github.com/HDFGroup/hdf5.git #git@github.com:HDFGroup/hdf5.git
-mkdir build && cd build
+{ccache_script("hdf5", dir_name)}
+mkdir -p hdf5_dev && cd hdf5_dev
+{stage("hdf5", "fetched", git_clone_command("hdf5"))}
+mkdir -p build && cd build
 {hdf5_mpicc_cmd}
-cmake ../hdf5 -DCMAKE_BUILD_TYPE={build_type} -DHDF5_BUILD_EXAMPLES=OFF -DHDF5_ENABLE_PARALLEL=ON -DHDF5_BUILD_CPP_LIB=ON -DHDF5_ALLOW_UNSUPPORTED=ON -DCMAKE_INSTALL_PREFIX=../install -DBUILD_TESTING=OFF
-make -j{num_build_cores}
-make install
-cd {top_level_dir}/builds/{dir_name}
-"""
-    build_dependent_script_rust = module_load_script + f"""
-# install rust
-# set up directories for rust install files
-cd {top_level_dir}/builds/{dir_name}
-mkdir cargo
-mkdir multirust
-# setting these env variables installs rust locally,
-# rather than in home directory
-export CARGO_HOME=$PWD/cargo
-export RUSTUP_HOME=$PWD/multirust
-curl --proto '=https' --tlsv1.2 -sSf https://sh.rustup.rs | sh -s -- -y --no-modify-path
-source $CARGO_HOME/env
+{stage("hdf5", "configured", f"cmake ../hdf5 -DCMAKE_BUILD_TYPE={build_type} -DHDF5_BUILD_EXAMPLES=OFF -DHDF5_ENABLE_PARALLEL=ON -DHDF5_BUILD_CPP_LIB=ON -DHDF5_ALLOW_UNSUPPORTED=ON -DCMAKE_INSTALL_PREFIX=../install -DBUILD_TESTING=OFF")}
+{stage("hdf5", "built", "make")}
+{stage("hdf5", "installed", "make install")}
 cd {top_level_dir}/builds/{dir_name}
 """
     build_dependent_script_hypre = module_load_script + f"""
-module --ignore_cache load kokkos
 cd {top_level_dir}/builds/{dir_name}
 # install hypre
 # TODO build cuda-aware hypre when cuda enabled
-mkdir hypre_dev
+{ccache_script("hypre", dir_name, autotools=True)}
+mkdir -p hypre_dev
 cd hypre_dev
-git clone https://github.com/hypre-space/hypre.git #git@github.com:hypre-space/hypre.git
+{stage("hypre", "fetched", git_clone_command("hypre"))}
 cd hypre/src
-{hypre_configure_cmd} #./configure
-make -j{num_build_cores}
-make install
-cd {top_level_dir}/builds/{dir_name}
-"""
-    build_dependent_spdlog = module_load_script + f"""
-# install spdlog
-cd {top_level_dir}/builds/{dir_name}
-mkdir spdlog_dev && cd spdlog_dev
-git clone https://github.com/gabime/spdlog.git #git@github.com:gabime/spdlog.git
-mkdir build && cd build
-cmake ../spdlog -DCMAKE_INSTALL_PREFIX=../install -DCMAKE_BUILD_TYPE={build_type}
-make -j{num_build_cores}
-make install
-cd {top_level_dir}/builds/{dir_name}
-"""
-    build_dependent_metis = module_load_script + f"""
-# install metis 5
-cd {top_level_dir}/builds/{dir_name}
-wget https://github.com/mfem/tpls/raw/gh-pages/metis-5.1.0.tar.gz
-tar -xvf metis-5.1.0.tar.gz
-cd metis-5.1.0
-make config prefix=install
-make -j{num_build_cores}
-make install
+# configure is in-source and regenerates headers, which would make make
+# rebuild everything, so an incremental rebuild keeps the old configuration
+{stage("hypre", "configured", f"[ -f config.status ] || {hypre_configure_cmd} #./configure")}
+{stage("hypre", "built", "make")}
+{stage("hypre", "installed", "make install")}
 cd {top_level_dir}/builds/{dir_name}
 """
     build_dependent_script_mfem = module_load_script + f"""
 # install mfem
 cd {top_level_dir}/builds/{dir_name}
-mkdir mfem_dev && cd mfem_dev
-git clone https://github.com/mfem/mfem.git #git@github.com:mfem/mfem.git
-mkdir build && cd build
-{mfem_cmake_cmd}
-make -j{num_build_cores}
-make install
+{ccache_script("mfem", dir_name)}
+mkdir -p mfem_dev && cd mfem_dev
+{stage("mfem", "fetched", git_clone_command("mfem"))}
+mkdir -p build && cd build
+{stage("mfem", "configured", mfem_cmake_cmd)}
+{stage("mfem", "built", "make")}
+{stage("mfem", "installed", "make install")}
 cd {top_level_dir}/builds/{dir_name}
 """
     build_dependent_script_pumimbbl = module_load_script + f"""
 cd {top_level_dir}/builds/{dir_name}
 # install pumimbbl
-mkdir pumiMBBL_dev && cd pumiMBBL_dev
-git clone https://github.com/SCOREC/pumiMBBL.git #git@github.com:SCOREC/pumiMBBL.git
-mkdir build && cd build
-cmake ../pumiMBBL -DCMAKE_INSTALL_PREFIX=../install -DKokkos_ROOT=../../kokkos_dev/install -DCMAKE_BUILD_TYPE={build_type}
-make -j{num_build_cores}
-make install
-cd {top_level_dir}/builds/{dir_name}
-"""
-    build_dependent_script_rustbca = module_load_script + f"""
-# install rustbca
-cd {top_level_dir}/builds/{dir_name}
-source {top_level_dir}/builds/{dir_name}/cargo/env
-git clone https://github.com/lcpp-org/RustBCA.git #git@github.com:lcpp-org/RustBCA.git
-cd RustBCA
-cargo build --release --lib -j {num_build_cores}
-mkdir include && cd include
-ln -s ../RustBCA.h .
-cd ..
-mkdir lib && cd lib
-ln -s ../target/release/liblibRustBCA.so .
+{ccache_script("pumiMBBL", dir_name)}
+mkdir -p pumiMBBL_dev && cd pumiMBBL_dev
+{stage("pumiMBBL", "fetched", git_clone_command("pumiMBBL"))}
+mkdir -p build && cd build
+{stage("pumiMBBL", "configured", f"cmake ../pumiMBBL -DCMAKE_INSTALL_PREFIX=../install -DKokkos_ROOT=../../kokkos_dev/install -DCMAKE_BUILD_TYPE={build_type}")}
+{stage("pumiMBBL", "built", "make")}
+{stage("pumiMBBL", "installed", "make install")}
 cd {top_level_dir}/builds/{dir_name}
 """
     subprocess.run(build_depepndent_dirs, shell=True)
-    subprocess.run(build_dependent_script_kokkos, shell=True)
-    subprocess.run(build_dependent_hdf5_mpicc, shell=True)
-    subprocess.run(build_dependent_script_rust, shell=True)
-    subprocess.run(build_dependent_script_hypre, shell=True)
-    subprocess.run(build_dependent_spdlog, shell=True)
-    subprocess.run(build_dependent_metis, shell=True)
-    subprocess.run(build_dependent_script_mfem, shell=True)
-    subprocess.run(build_dependent_script_pumimbbl, shell=True)
-    subprocess.run(build_dependent_script_rustbca, shell=True)
-    
+    register_build(build_dependent_dir_path)
+    # Every script cd's into its own package directory, so they can all run
+    # at once; run_build_graph only holds back the ones that need others.
+    build_scripts = {
+        "kokkos": build_dependent_script_kokkos,
+        "hdf5": build_dependent_hdf5_mpicc,
+        "hypre": build_dependent_script_hypre,
+        "mfem": build_dependent_script_mfem,
+        "pumiMBBL": build_dependent_script_pumimbbl,
+    }
+    # The build-once packages just get hardlinked in from where
+    # build_once_modules built them.
+    build_tasks = {}
+    build_once_keys = {}
+    for package in build_once_package_axes:
+        build_once_dir_path, build_once_keys[package] = build_once_builds[(package, build_type)]
+        build_tasks[package] = functools.partial(reuse_build_once, package, build_once_keys[package], build_dependent_dir_path)
+    cache_keys = package_cache_keys(build_scripts, dependent_package_deps, build_dependent_dir_path, known_keys=build_once_keys)
+    variant_cache_keys[(openmp_option, cuda_arch_option, build_type)] = dict(build_once_keys, **cache_keys)
+    for package, build_script in build_scripts.items():
+        build_tasks[package] = functools.partial(build_package_cached, package, cache_keys[package], build_script, build_dependent_dir_path)
+    return build_tasks
+
+def build_group(dir_name):
+    # (group, date) of a build directory. The builds of one variant (or of
+    # one build-once directory) are a group, told apart by their dates. A
+    # name without a date at the end is a group of its own.
+    match = re.fullmatch(r"(.+)-(\d{4}-\d\d-\d\d)", dir_name)
+    if match is None:
+        return dir_name, None
+    return match.group(1), match.group(2)
+
+def group_modulefile_dir(group):
+    # Where the dated modulefiles (and latest) of a group's builds are.
+    if group.startswith("hpic2deps-") and "-" in group[len("hpic2deps-"):]:
+        option_spec_string, build_type = group[len("hpic2deps-"):].rsplit("-", 1)
+        return f"{top_level_dir}/modulefiles/hpic2deps/{option_spec_string}/{build_type}"
+    if group.startswith("hpic2-"):
+        return f"{top_level_dir}/modulefiles/hpic2/{group[len('hpic2-'):]}"
+    return None
+
+def group_packages(group):
+    if group.startswith("hpic2deps-"):
+        return list(dependent_package_deps)
+    if group.startswith("hpic2-"):
+        return ["hpic2"]
+    if group.startswith("build_once_modules-"):
+        return list(build_once_package_axes)
+    return []
+
+def write_build_entry(entry):
+    # Same as the build cache, one file per build written with a rename, so
+    # slurm tasks registering their builds never step on each other.
+    os.makedirs(build_manifest_dir, exist_ok=True)
+    entry_path = f"{build_manifest_dir}/{entry['name']}.json"
+    with open(f"{entry_path}.{os.getpid()}", 'w') as entry_file:
+        json.dump(entry, entry_file, indent=4)
+    os.replace(f"{entry_path}.{os.getpid()}", entry_path)
+    return True
+
+def register_build(build_dir_path):
+    # Put a build directory in the manifest when it gets created, so even
+    # builds that fail get deleted eventually. Its size gets filled in when
+    # it is finished (see record_build_size), or by enforce_retention.
+    name = os.path.basename(build_dir_path)
+    group, date = build_group(name)
+    return write_build_entry({
+        "name": name,
+        "group": group,
+        "date": date,
+        "created": time.time(),
+        "size": None,
+        "revisions": {package: package_revision(package) for package in group_packages(group)},
+    })
+
+def record_build_size(build_dir_path):
+    # Size a finished build once. register_build (when an update builds in
+    # it again) and slim_old_builds are the only ones that change it.
+    entry_path = f"{build_manifest_dir}/{os.path.basename(build_dir_path)}.json"
+    if not os.path.exists(entry_path):
+        register_build(build_dir_path)
+    with open(entry_path) as entry_file:
+        entry = json.load(entry_file)
+    if entry["size"] is not None:
+        return True
+    entry["size"] = build_size(build_dir_path)
+    return write_build_entry(entry)
+
+def build_size(build_dir_path):
+    # Bytes on disk, with files hardlinked from other builds (by the build
+    # cache or dedup_builds) counted by their share, so the sizes of all the
+    # builds add up to about what they really take.
+    size = 0
+    for root, dirs, files in os.walk(build_dir_path):
+        for file_name in files:
+            file_stat = os.lstat(os.path.join(root, file_name))
+            size += file_stat.st_blocks * 512 / file_stat.st_nlink
+    return int(size)
+
+def read_build_manifest():
+    # {build directory name: manifest entry} of every build we have. The
+    # first time, the builds from before there was a manifest get added from
+    # a listing of builds/, after that builds/ never gets listed again.
+    adopted_path = f"{build_manifest_dir}/.adopted"
+    if not os.path.exists(adopted_path):
+        for build_dir_path in sorted(glob.glob(f"{top_level_dir}/builds/*")):
+            name = os.path.basename(build_dir_path)
+            if not name.startswith(build_dir_prefixes) or not os.path.isdir(build_dir_path) or os.path.exists(f"{build_manifest_dir}/{name}.json"):
+                continue
+            group, date = build_group(name)
+            write_build_entry({"name": name, "group": group, "date": date, "created": os.path.getmtime(build_dir_path), "size": None, "revisions": {}})
+        os.makedirs(build_manifest_dir, exist_ok=True)
+        open(adopted_path, 'w').close()
+    entries = {}
+    for entry_file_name in os.listdir(build_manifest_dir):
+        if entry_file_name.endswith(".json"):
+            with open(f"{build_manifest_dir}/{entry_file_name}") as entry_file:
+                entry = json.load(entry_file)
+            entries[entry["name"]] = entry
+    return entries
+
+def modulefile_build_names(modulefile_path):
+    # Builds a modulefile uses: the ones its paths are in, and the ones of
+    # the dated hpic2deps modulefile an hpic2 one loads.
+    with open(modulefile_path) as modulefile:
+        contents = modulefile.read()
+    names = set(re.findall(rf"{re.escape(top_level_dir)}/builds/([^/\s{{}}]+)", contents))
+    for option_spec_string, build_type, date in re.findall(r"(?:module load|depends-on) hpic2deps/([^/\s]+)/([^/\s]+)/(\d{4}-\d\d-\d\d)\b", contents):
+        names.add(f"hpic2deps-{option_spec_string}-{build_type}-{date}")
+    return names
+
+def latest_build_names(entries):
+    # Builds a latest modulefile points at (latest is a hardlink to one of
+    # the dated modulefiles), or uses.
+    names = set()
+    entries_by_group = {}
+    for entry in entries.values():
+        entries_by_group.setdefault(entry["group"], []).append(entry)
+    for group, group_entries in entries_by_group.items():
+        modulefile_dir = group_modulefile_dir(group)
+        if modulefile_dir is None or not os.path.exists(f"{modulefile_dir}/latest"):
+            continue
+        latest_stat = os.stat(f"{modulefile_dir}/latest")
+        names |= modulefile_build_names(f"{modulefile_dir}/latest")
+        for entry in group_entries:
+            modulefile_path = f"{modulefile_dir}/{entry['date']}"
+            if entry["date"] is not None and os.path.exists(modulefile_path) and os.path.samestat(os.stat(modulefile_path), latest_stat):
+                names.add(entry["name"])
+    return names
+
+def build_age_days(entry):
+    if entry["date"] is None:
+        return (time.time() - entry["created"]) / 86400
+    return (datetime.datetime.strptime(current_datetime, datetime_format) - datetime.datetime.strptime(entry["date"], datetime_format)).days
+
+def delete_build(entry, reason):
+    # A build directory (into the trash, see trash_build), its modulefile,
+    # the dated modulefiles of other builds that use it (an hpic2 one
+    # loading this hpic2deps, which would not load any more) and its
+    # manifest entry, in that order, so a build that never made it into the
+    # trash is still in the manifest and gets deleted next time.
+    print(f"Deleting {entry['name']} ({reason})")
+    build_dir_path = f"{top_level_dir}/builds/{entry['name']}"
+    if os.path.exists(build_dir_path):
+        trash_build(build_dir_path)
+    modulefile_dir = group_modulefile_dir(entry["group"])
+    if modulefile_dir is not None and entry["date"] is not None and os.path.exists(f"{modulefile_dir}/{entry['date']}"):
+        os.remove(f"{modulefile_dir}/{entry['date']}")
+    for modulefile_path in glob.glob(f"{top_level_dir}/modulefiles/hpic2*/**/????-??-??", recursive=True):
+        # Not latest, enforce_retention keeps what that uses.
+        if os.path.isfile(modulefile_path) and entry["name"] in modulefile_build_names(modulefile_path):
+            print(f"Deleting {modulefile_path}, it uses {entry['name']}")
+            os.remove(modulefile_path)
+    os.remove(f"{build_manifest_dir}/{entry['name']}.json")
+    return True
+
+# Background deletion of trash_dir, see start_trash_deletion.
+trash_condition = threading.Condition()
+trash_thread = None
+trash_stopping = False
+
+def trash_build(build_dir_path):
+    # Get build_dir_path out of the way with one rename into trash_dir, for
+    # the background thread to delete (if there is one, otherwise the next
+    # update, update_parallel or update_slurm, whose wait_for_trash also
+    # takes care of what their Slurm tasks put there).
+    os.makedirs(trash_dir, exist_ok=True)
+    try:
+        os.rename(build_dir_path, f"{trash_dir}/{os.path.basename(build_dir_path)}.{time.time_ns()}")
+    except OSError:
+        # Not on the same filesystem as trash_dir, somehow.
+        shutil.rmtree(build_dir_path)
+        return True
+    with trash_condition:
+        trash_condition.notify_all()
+    return True
+
+def delete_tree(path):
+    # shutil.rmtree, but with trash_delete_workers threads each on its own
+    # directory two levels down (like a package's source, build and install
+    # directories), since on GPFS every unlink waits on the metadata server
+    # and many of them at once go a lot faster.
+    subtrees = []
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            subtrees.extend(sub_entry.path for sub_entry in os.scandir(entry.path) if sub_entry.is_dir(follow_symlinks=False))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=trash_delete_workers) as executor:
+        list(executor.map(functools.partial(shutil.rmtree, ignore_errors=True), subtrees))
+    shutil.rmtree(path, ignore_errors=True)
+    return True
+
+def trash_items(skipped):
+    if not os.path.isdir(trash_dir):
+        return []
+    return sorted(item for item in os.listdir(trash_dir) if item not in skipped)
+
+def empty_trash():
+    # The background thread: delete everything in trash_dir, then wait for
+    # more until wait_for_trash says to stop.
+    failed_items = set()
+    while True:
+        with trash_condition:
+            items = trash_items(failed_items)
+            while not items and not trash_stopping:
+                trash_condition.wait()
+                items = trash_items(failed_items)
+            if not items:
+                return not failed_items
+        for item in items:
+            try:
+                delete_tree(f"{trash_dir}/{item}")
+            except OSError as error:
+                print(f"Could not delete {trash_dir}/{item} ({error}), trying again next update")
+                failed_items.add(item)
+
+def start_trash_deletion():
+    # Start the background thread, which right away deletes anything an
+    # earlier update left in trash_dir.
+    global trash_thread
+    with trash_condition:
+        if trash_thread is None:
+            trash_thread = threading.Thread(target=empty_trash, daemon=True)
+            trash_thread.start()
+    return True
+
+def wait_for_trash():
+    # Let the background thread finish what is in trash_dir (including
+    # what the Slurm tasks put there) and stop.
+    global trash_thread, trash_stopping
+    start_trash_deletion()
+    items = trash_items(set())
+    if items:
+        # Whole builds, or what slim_package cut out of one.
+        num_builds = len([item for item in items if item.startswith(build_dir_prefixes)])
+        print(f"Waiting for {num_builds} old builds and {len(items) - num_builds} directories slimmed out of builds to finish deleting...")
+    with trash_condition:
+        trash_stopping = True
+        trash_condition.notify_all()
+    trash_thread.join()
+    with trash_condition:
+        trash_thread = None
+        trash_stopping = False
+    return True
+
+retention_lock = threading.Lock()
+
+def enforce_retention():
+    # Delete the builds past the num_versions_kept newest of their group,
+    # the ones older than max_build_age_days, and then the oldest ones of
+    # any group while all of them together take more than builds_quota_gb.
+    # Never today's builds, or one a latest modulefile points at. Goes by
+    # the manifest, so other than sizing each build once it costs the same
+    # however big the builds are.
+    with retention_lock:
+        entries = {}
+        for name, entry in read_build_manifest().items():
+            build_dir_path = f"{top_level_dir}/builds/{name}"
+            if entry["date"] == current_datetime:
+                # Might not even exist yet.
+                entries[name] = entry
+            elif not os.path.isdir(build_dir_path):
+                # Deleted by hand.
+                os.remove(f"{build_manifest_dir}/{name}.json")
+            else:
+                if entry["size"] is None:
+                    entry["size"] = build_size(build_dir_path)
+                    write_build_entry(entry)
+                entries[name] = entry
+        protected = {name for name, entry in entries.items() if entry["date"] == current_datetime} | latest_build_names(entries)
+        newest_first = sorted(entries.values(), key=lambda entry: (entry["date"] or "", entry["created"]), reverse=True)
+
+        doomed = {}
+        group_counts = collections.Counter()
+        for entry in newest_first:
+            group_counts[entry["group"]] += 1
+            if group_counts[entry["group"]] > num_versions_kept:
+                doomed[entry["name"]] = f"more than {num_versions_kept} builds of {entry['group']}"
+            elif max_build_age_days is not None and build_age_days(entry) > max_build_age_days:
+                doomed[entry["name"]] = f"older than {max_build_age_days:g} days"
+        doomed = {name: reason for name, reason in doomed.items() if name not in protected}
+        if builds_quota_gb is not None:
+            total_bytes = sum(entry["size"] or 0 for name, entry in entries.items() if name not in doomed)
+            for entry in newest_first[::-1]:
+                if total_bytes <= builds_quota_gb * 1024**3:
+                    break
+                if entry["name"] not in doomed and entry["name"] not in protected and entry["size"]:
+                    doomed[entry["name"]] = f"builds over the {builds_quota_gb:g} GB quota"
+                    total_bytes -= entry["size"] or 0
+        for name, reason in doomed.items():
+            delete_build(entries[name], reason)
+    return True
+
+def finalize_modulefile(modulefile_dir, build_dir_path):
+    # Point "latest" at today's modulefile in modulefile_dir, now that
+    # today's build in build_dir_path is done, then delete whatever builds
+    # (and their modulefiles) enforce_retention says should go.
+    # Swapped in with a rename, so there always is a latest.
+    os.link(f"{modulefile_dir}/{current_datetime}", f"{modulefile_dir}/latest.{os.getpid()}")
+    os.replace(f"{modulefile_dir}/latest.{os.getpid()}", f"{modulefile_dir}/latest")
+    record_build_size(build_dir_path)
+    enforce_retention()
+    return True
+
+def dedup_dirs():
+    # Directories dedup_builds may hardlink files across: the install
+    # directories of every build in the manifest, and the hpic2 build
+    # directories (what its modulefile points at), from before today.
+    # Today's builds are left out since an incremental rebuild or a resume
+    # would write into them in place (make install and hypre's src/hypre
+    # copy over existing files), through the links, into the older builds.
+    dirs = []
+    for name, entry in sorted(read_build_manifest().items()):
+        build_dir_path = f"{top_level_dir}/builds/{name}"
+        if entry["date"] == current_datetime:
+            continue
+        if name.startswith("hpic2-"):
+            if os.path.isdir(f"{build_dir_path}/build"):
+                dirs.append(f"{build_dir_path}/build")
+            continue
+        for package, install_dirs in package_install_dirs.items():
+            for install_dir in install_dirs:
+                if os.path.isdir(f"{build_dir_path}/{install_dir}"):
+                    dirs.append(f"{build_dir_path}/{install_dir}")
+    return dirs
+
+def file_hash(path):
+    file_hasher = hashlib.sha256()
+    with open(path, 'rb') as hashed_file:
+        for block in iter(functools.partial(hashed_file.read, 1024 * 1024), b""):
+            file_hasher.update(block)
+    return file_hasher.hexdigest()
+
+def dedup_builds(dirs=None):
+    # Replace every file in dirs (dedup_dirs by default) that has the same
+    # contents, permissions and owner as another one with a hardlink to
+    # that one. Only files of a size that occurs more than once get hashed,
+    # and only once per inode, so files linked by an earlier dedup (or by
+    # the build cache) cost nothing. Each duplicate is replaced by renaming
+    # a new link over it, so a killed dedup leaves every file either as it
+    # was or linked, never missing. Returns the bytes reclaimed.
+    if dirs is None:
+        dirs = dedup_dirs()
+    inode_paths = {}
+    inode_stats = {}
+    same_size_inodes = {}
+    for dir_path in dirs:
+        for root, dirs_in_root, files in os.walk(dir_path):
+            for file_name in files:
+                file_path = os.path.join(root, file_name)
+                if file_name.endswith(dedup_temp_suffix):
+                    os.remove(file_path)
+                    continue
+                file_stat = os.lstat(file_path)
+                if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_size == 0:
+                    continue
+                inode = (file_stat.st_dev, file_stat.st_ino)
+                if inode not in inode_paths:
+                    inode_paths[inode] = []
+                    inode_stats[inode] = file_stat
+                    same_size_inodes.setdefault((file_stat.st_dev, file_stat.st_size, file_stat.st_mode, file_stat.st_uid, file_stat.st_gid), []).append(inode)
+                inode_paths[inode].append(file_path)
+
+    linked_files = 0
+    reclaimed_bytes = 0
+    for inodes in same_size_inodes.values():
+        if len(inodes) < 2:
+            continue
+        same_hash_inodes = {}
+        for inode in inodes:
+            try:
+                same_hash_inodes.setdefault(file_hash(inode_paths[inode][0]), []).append(inode)
+            except OSError:
+                continue
+        for duplicate_inodes in same_hash_inodes.values():
+            # Keep the inode with the most links already, the fewest renames.
+            duplicate_inodes.sort(key=lambda inode: inode_stats[inode].st_nlink, reverse=True)
+            keeper_path = inode_paths[duplicate_inodes[0]][0]
+            for inode in duplicate_inodes[1:]:
+                replaced_paths = 0
+                for file_path in inode_paths[inode]:
+                    try:
+                        current_stat = os.lstat(file_path)
+                    except FileNotFoundError:
+                        continue
+                    if (current_stat.st_ino, current_stat.st_mtime_ns, current_stat.st_size) != (inode[1], inode_stats[inode].st_mtime_ns, inode_stats[inode].st_size):
+                        # Changed since it got hashed.
+                        continue
+                    try:
+                        os.link(keeper_path, f"{file_path}{dedup_temp_suffix}")
+                    except OSError:
+                        # Too many links to the keeper (or some other filesystem
+                        # limit), leave it be.
+                        continue
+                    os.replace(f"{file_path}{dedup_temp_suffix}", file_path)
+                    replaced_paths += 1
+                linked_files += replaced_paths
+                # The space only comes back once nothing links to the old inode.
+                if replaced_paths == inode_stats[inode].st_nlink:
+                    reclaimed_bytes += inode_stats[inode].st_blocks * 512
+    print(f"Dedup: hardlinked {linked_files} duplicate files in {len(dirs)} build directories, {reclaimed_bytes / 1024**3:.2f} GB reclaimed")
+    return reclaimed_bytes
+
+def build_dependent(openmp_option, cuda_arch_option, build_type, build_once_builds):
+    option_spec_string = f"{'+' if openmp_option else '~'}openmp-cuda-arch-{str(cuda_arch_option)}"
+    package_tasks = prepare_build_dependent(openmp_option, cuda_arch_option, build_type, build_once_builds)
+    results = run_build_graph(package_tasks, dependent_package_deps, label=f"[{option_spec_string} {build_type}] ")
+    # A modulefile pointing at missing packages is worse than yesterday's.
+    if all(exit_code == 0 for exit_code in results.values()):
+        write_dependent_modulefile(openmp_option, cuda_arch_option, build_type)
+    else:
+        print(f"Not all of {option_spec_string} {build_type} built, leaving its latest modulefile alone")
+
+    return results
+
+def write_dependent_modulefile(openmp_option, cuda_arch_option, build_type, finalize=True):
+    # finalize=False writes today's modulefile but leaves "latest" and the
+    # old builds alone, for when someone else decides if the build worked.
+    option_spec_string = f"{'+' if openmp_option else '~'}openmp-cuda-arch-{str(cuda_arch_option)}"
+    dir_name = f"hpic2deps-{option_spec_string}-{build_type}-{current_datetime}"
+    build_dependent_dir_path = f"{top_level_dir}/builds/{dir_name}"
+    cuda_enabled = cuda_arch_option != None
+
     # Logan wrote this modulefile based on the modulefiles generated by
     # spack for each of these packages.
     # good luck understanding it, I don't - Stephen
@@ -412,65 +2488,52 @@ setenv HDF5_MPI ON
     with open(f"{modulefile_dir}/{current_datetime}", 'w') as modulefile:
         modulefile.write(modulefile_contents)
 
-    # Remove the "latest" modulefile
-    if os.path.exists(f"{modulefile_dir}/latest"):
-        os.unlink(f"{modulefile_dir}/latest")
-
-    # Delete old builds, if necessary.
-    old_builds = glob.glob(f"{top_level_dir}/builds/hpic2deps-{option_spec_string}-{build_type}-*")
-    build_dates = [old_build[-datetime_format_length:] for old_build in old_builds]
-    # Convert date strings to datetime objects, for comparisons
-    build_dates = np.array([datetime.datetime.strptime(build_date, datetime_format) for build_date in build_dates])
-    sorted_build_date_indices = np.argsort(build_dates)
-    for old_build_index in sorted_build_date_indices[:-num_versions_kept]:
-        old_build = old_builds[old_build_index]
-        shutil.rmtree(old_build)
-
-    # Delete old modulefiles, if necessary.
-    old_mfs = glob.glob(f"{modulefile_dir}/*")
-    # The modulefile names are their build dates.
-    # Convert date strings to datetime objects, for comparisons.
-    build_dates = np.array([datetime.datetime.strptime(build_date[-datetime_format_length:], datetime_format) for build_date in old_mfs])
-    sorted_build_date_indices = np.argsort(build_dates)
-    for old_mf_index in sorted_build_date_indices[:-num_versions_kept]:
-        old_mf = old_mfs[old_mf_index]
-        os.remove(old_mf)
-
-    # Update the "latest" modulefile
-    os.link(f"{modulefile_dir}/{current_datetime}", f"{modulefile_dir}/latest")
+    if finalize:
+        finalize_modulefile(modulefile_dir, f"{top_level_dir}/builds/hpic2deps-{option_spec_string}-{build_type}-{current_datetime}")
 
     return True
 
-def build_release_version_hpic2(openmp_option, cuda_arch_option):
+def build_release_version_hpic2(openmp_option, cuda_arch_option, deps_version="latest", finalize=True):
     option_spec_string = f"{'+' if openmp_option else '~'}openmp-cuda-arch-{str(cuda_arch_option)}"
     # Now build Release version of hpic2 itself
     dir_name = f"hpic2-{option_spec_string}-{current_datetime}"
 
     # Remove the build directories for this datetime if it already
     # exists, i.e. if we have already updated today.
-    if os.path.exists(f"builds/{dir_name}"):
-        shutil.rmtree(f"builds/{dir_name}")
+    if os.path.exists(f"builds/{dir_name}") and not incremental_builds:
+        trash_build(f"{top_level_dir}/builds/{dir_name}")
     
-    deps_module = f"hpic2deps/{option_spec_string}/Release/latest"
+    register_build(f"{top_level_dir}/builds/{dir_name}")
+    deps_module = f"hpic2deps/{option_spec_string}/Release/{deps_version}"
+    build_dir_path = f"{top_level_dir}/builds/{dir_name}"
+    stage = functools.partial(stage_script, build_dir_path)
         
     build_dependent_hpic2_script = f"""
 module purge
 module use {top_level_dir}/modulefiles
 module load {deps_module}
+{ccache_script("hpic2", dir_name)}
 
 cd builds
-mkdir {dir_name}
+mkdir -p {dir_name}
 cd {dir_name}
 
-git clone --recurse-submodules https://github.com/lcpp-org/hpic2.git #git@github.com:lcpp-org/hpic2.git
-mkdir build && cd build
+{stage("hpic2", "fetched", git_clone_command("hpic2", recurse_submodules=True))}
+mkdir -p build && cd build
 #cmake ../hpic2 -DWITH_RUSTBCA=ON -DWITH_PUMIMBBL=ON -DWITH_MFEM=ON
-cmake ../hpic2 -DWITH_RUSTBCA=ON -DWITH_PUMIMBBL=ON
-make -j{num_build_cores}
+{stage("hpic2", "configured", "cmake ../hpic2 -DWITH_RUSTBCA=ON -DWITH_PUMIMBBL=ON")}
+{stage("hpic2", "built", "make")}
 
         """
 
-    subprocess.run(build_dependent_hpic2_script, shell=True)
+    # hpic2 is not in the build cache, so its stages go by the revision, the
+    # script and the cache keys of the deps it links against (statically,
+    # so a dep that changed means building hpic2 again).
+    deps_keys = variant_cache_keys.get((openmp_option, cuda_arch_option, "Release"), {})
+    reset_stages("hpic2", hashlib.sha256(f"{package_revision('hpic2')}\n{build_dependent_hpic2_script}\n{json.dumps(deps_keys, sort_keys=True)}".encode()).hexdigest(), build_dir_path)
+    if run_staged_build_script(build_dependent_hpic2_script, "hpic2", build_dir_path).returncode != 0:
+        print(f"hpic2 {option_spec_string}: build failed, see above")
+        return False
 
     # I wrote this modulefile based on the modulefiles generated by
     # spack for each of these packages.
@@ -499,46 +2562,43 @@ prepend-path --delim {{:}} PATH {{{top_level_dir}/builds/{dir_name}/build}}
     with open(f"{modulefile_dir}/{current_datetime}", 'w') as modulefile:
         modulefile.write(modulefile_contents)
 
-    # Remove the "latest" modulefile
-    if os.path.exists(f"{modulefile_dir}/latest"):
-        os.unlink(f"{modulefile_dir}/latest")
-
-    # Delete old builds, if necessary.
-    old_builds = glob.glob(f"{top_level_dir}/builds/hpic2-{option_spec_string}-*")
-    build_dates = [old_build[-datetime_format_length:] for old_build in old_builds]
-    # Convert date strings to datetime objects, for comparisons
-    build_dates = np.array([datetime.datetime.strptime(build_date, datetime_format) for build_date in build_dates])
-    sorted_build_date_indices = np.argsort(build_dates)
-    for old_build_index in sorted_build_date_indices[:-num_versions_kept]:
-        old_build = old_builds[old_build_index]
-        shutil.rmtree(old_build)
-
-    # Delete old modulefiles, if necessary.
-    old_mfs = glob.glob(f"{modulefile_dir}/*")
-    # The modulefile names are their build dates.
-    # Convert date strings to datetime objects, for comparisons.
-    build_dates = np.array([datetime.datetime.strptime(build_date[-datetime_format_length:], datetime_format) for build_date in old_mfs])
-    sorted_build_date_indices = np.argsort(build_dates)
-    for old_mf_index in sorted_build_date_indices[:-num_versions_kept]:
-        old_mf = old_mfs[old_mf_index]
-        os.remove(old_mf)
-
-    # Update the "latest" modulefile
-    os.link(f"{modulefile_dir}/{current_datetime}", f"{modulefile_dir}/latest")
+    if finalize:
+        finalize_modulefile(modulefile_dir, build_dir_path)
     return True
 
 def update():
     print(f"Updating hpic2 and dependencies on ICC...")
+    if not check_upstream_changes(built_upstream_packages(False)):
+        return True
     make_build_directories()
+    start_trash_deletion()
     make_cmake_module()
-    #build_once_modules() # There are no dependencies that are not build dependent
+    update_mirrors()
+    setup_ccache()
+    start_jobserver()
+    build_once_builds, results, task_deps = build_once_modules()
     for openmp_option, cuda_arch_option in itertools.product(openmp_options, cuda_arch_options):
         
         # Want to build both Debug and Release versions of hpic2deps,
         # but only the Release version of hpic2 itself.
         # First, hpic2deps
         for build_type in build_types_arr:
-            build_dependent(openmp_option, cuda_arch_option, build_type)
+            option_spec_string = f"{'+' if openmp_option else '~'}openmp-cuda-arch-{str(cuda_arch_option)}"
+            variant_name = f"hpic2deps-{option_spec_string}-{build_type}"
+            variant_results = build_dependent(openmp_option, cuda_arch_option, build_type, build_once_builds)
+            for package, exit_code in variant_results.items():
+                results[f"{variant_name}/{package}"] = exit_code
+                task_deps[f"{variant_name}/{package}"] = [f"{variant_name}/{dep}" for dep in dependent_package_deps[package]]
+    print_build_summary(results, task_deps)
+    report_ccache_stats()
+    clean_scratch()
+    slim_old_builds()
+    if dedup_enabled:
+        dedup_builds()
+    wait_for_trash()
+    built_everything = all(exit_code == 0 for exit_code in results.values())
+    if built_everything:
+        write_upstream_lock(built_upstream_packages(False))
     
     print(f"""
 Done! If you haven't already, update your module search path with
@@ -546,32 +2606,651 @@ Done! If you haven't already, update your module search path with
 module use {top_level_dir}/modulefiles
     """)
     
-    return True
+    return built_everything
 
-def update_mpi():
-    print(f"Updating hpic2 and dependencies on ICC...")
+def update_parallel(resume=False):
+    # Build every (openmp, cuda arch, build type) variant at the same time.
+    # All the variants go into one dependency graph, with every package of
+    # every variant building in its own shell (with its own module purge/load,
+    # so module environments never leak between variants), and hpic2 for a
+    # variant starting as soon as that variant's Release deps are done.
+    # The jobserver keeps the whole thing at num_build_cores compile jobs, so
+    # the full matrix takes about as long as the slowest variant.
+    # resume picks up today's update where it stopped (see stage_script),
+    # without fetching anything new that would start packages over.
+    global incremental_builds
+    if resume:
+        print("Resuming today's update of hpic2 and dependencies on ICC...")
+        incremental_builds = True
+    else:
+        print("Updating hpic2 and dependencies on ICC in parallel...")
+        if not check_upstream_changes(built_upstream_packages("Release" in build_types_arr)):
+            return True
     make_build_directories()
+    start_trash_deletion()
     make_cmake_module()
-    #for openmp_option, cuda_arch_option in itertools.product(openmp_options, cuda_arch_options):
-    #    for build_type in build_types_arr:
-    
-    pool_vars = list(itertools.product(openmp_options, cuda_arch_options, build_types_arr))
-    with MPIPoolExecutor(max_workers=num_build_cores) as executor:
-        results_build_modules = list(executor.map(build_dependent, pool_vars))
-    print(f"Done building modules: {results_build_modules}")
-    
-    pool_vars2 = list(itertools.product(openmp_options, cuda_arch_options))
-    with MPIPoolExecutor(max_workers=num_build_cores) as executor:
-        results_build_hpic2 = list(executor.map(build_release_version_hpic2, pool_vars2))
-    print(f"Done building hpic2: {results_build_hpic2}")
-    
+    if not resume:
+        update_mirrors()
+    setup_ccache()
+    start_jobserver()
+
+    # The build-once packages go in the same graph, and each variant's copy
+    # of one waits for it.
+    build_tasks, task_deps, build_once_builds = prepare_build_once_modules(build_types_arr)
+    for openmp_option, cuda_arch_option, build_type in itertools.product(openmp_options, cuda_arch_options, build_types_arr):
+        option_spec_string = f"{'+' if openmp_option else '~'}openmp-cuda-arch-{str(cuda_arch_option)}"
+        variant_name = f"hpic2deps-{option_spec_string}-{build_type}"
+        package_tasks = prepare_build_dependent(openmp_option, cuda_arch_option, build_type, build_once_builds)
+        for package, package_task in package_tasks.items():
+            build_tasks[f"{variant_name}/{package}"] = package_task
+            task_deps[f"{variant_name}/{package}"] = [f"{variant_name}/{dep}" for dep in dependent_package_deps[package]]
+            if package in build_once_package_axes:
+                task_deps[f"{variant_name}/{package}"].append(f"{build_once_dir_name(package, build_type)}/{package}")
+        build_tasks[f"{variant_name}/modulefile"] = functools.partial(write_dependent_modulefile, openmp_option, cuda_arch_option, build_type)
+        task_deps[f"{variant_name}/modulefile"] = [f"{variant_name}/{package}" for package in package_tasks]
+
+    # hpic2 itself only gets built against the Release deps.
+    if "Release" in build_types_arr:
+        for openmp_option, cuda_arch_option in itertools.product(openmp_options, cuda_arch_options):
+            option_spec_string = f"{'+' if openmp_option else '~'}openmp-cuda-arch-{str(cuda_arch_option)}"
+            build_tasks[f"hpic2-{option_spec_string}"] = functools.partial(build_release_version_hpic2, openmp_option, cuda_arch_option)
+            task_deps[f"hpic2-{option_spec_string}"] = [f"hpic2deps-{option_spec_string}-Release/modulefile"]
+
+    results = run_build_graph(build_tasks, task_deps, label="[parallel] ")
+    delete_old_build_once_modules()
+    print_build_summary(results, task_deps)
+    report_ccache_stats()
+    clean_scratch()
+    slim_old_builds()
+    if dedup_enabled:
+        dedup_builds()
+    wait_for_trash()
+    built_everything = all(exit_code == 0 for exit_code in results.values())
+    if built_everything:
+        write_upstream_lock(built_upstream_packages("Release" in build_types_arr))
+
     print(f"""
 Done! If you haven't already, update your module search path with
 
 module use {top_level_dir}/modulefiles
     """)
+
+    return built_everything
     
+def critical_path(tasks):
+    # The chain of tasks that decided when the graph finished: start from the
+    # task that finished last and keep going to whichever of its deps
+    # finished last. tasks is {name: (deps, start, duration)}.
+    if not tasks:
+        return []
+    path = [max(tasks, key=lambda name: tasks[name][1] + tasks[name][2])]
+    while True:
+        deps = [dep for dep in tasks[path[-1]][0] if dep in tasks]
+        if not deps:
+            return path[::-1]
+        path.append(max(deps, key=lambda dep: tasks[dep][1] + tasks[dep][2]))
+
+def resource_bound(duration, cpu_seconds, tree_rss_kb, io_bytes, cores, mem_total_kb):
+    # Rough guess at what held a build stage back: memory if it got near
+    # what the node has (run fewer of those at once), cpu if it kept the
+    # cores busy, io if it mostly moved bytes around, serial if it never
+    # used much more than one core (more -j will not help it).
+    cores_busy = cpu_seconds / max(duration, 1)
+    if mem_total_kb and tree_rss_kb and tree_rss_kb >= 0.5 * mem_total_kb:
+        return "memory"
+    if cores and cores_busy >= 0.75 * cores:
+        return "cpu"
+    if io_bytes / max(duration, 1) >= 50 * 1024 * 1024:
+        return "io"
+    if cores_busy < 1.5:
+        return "serial"
+    return "-"
+
+def report():
+    # Where the update hours go: per package build times over the last dated
+    # builds, the stages of the latest one and the critical path of the
+    # last run.
+    if not os.path.exists(timing_db_path):
+        print(f"No build times recorded yet ({timing_db_path} does not exist)")
+        return True
+    timing_db_connection = timing_db()
+    build_dates = [row[0] for row in timing_db_connection.execute("SELECT DISTINCT build_date FROM build_steps ORDER BY build_date DESC LIMIT 7")][::-1]
+    if build_dates:
+        package_minutes = {}
+        for package, build_date, duration in timing_db_connection.execute("SELECT package, build_date, AVG(duration) FROM build_steps WHERE phase = 'total' AND exit_code = 0 GROUP BY package, build_date"):
+            package_minutes.setdefault(package, {})[build_date] = duration / 60
+        print("Build minutes per package (mean over the variants that built it, - if reused or failed):")
+        print(f"    {'package':<10}" + "".join(f" {build_date:>10}" for build_date in build_dates))
+        for package in sorted(package_minutes):
+            print(f"    {package:<10}" + "".join(f" {package_minutes[package][build_date]:>10.1f}" if build_date in package_minutes[package] else f" {'-':>10}" for build_date in build_dates))
+
+        phases = ["fetched", "configured", "built", "installed", "total"]
+        phase_minutes = {}
+        peak_rss_gb = {}
+        for package, phase, duration, max_rss_kb in timing_db_connection.execute("SELECT package, phase, AVG(duration), MAX(max_rss_kb) FROM build_steps WHERE build_date = ? GROUP BY package, phase", (build_dates[-1],)):
+            phase_minutes.setdefault(package, {})[phase] = duration / 60
+            if max_rss_kb is not None:
+                peak_rss_gb[package] = max_rss_kb / 1024 / 1024
+        print(f"\nStage minutes on {build_dates[-1]} (mean over variants), and peak memory:")
+        print(f"    {'package':<10}" + "".join(f" {phase:>10}" for phase in phases) + f" {'peak GB':>10}")
+        for package in sorted(phase_minutes):
+            print(f"    {package:<10}" + "".join(f" {phase_minutes[package][phase]:>10.1f}" if phase in phase_minutes[package] else f" {'-':>10}" for phase in phases) + (f" {peak_rss_gb[package]:>10.2f}" if package in peak_rss_gb else f" {'-':>10}"))
+
+        resource_rows = timing_db_connection.execute("""SELECT package, phase, AVG(duration), AVG(cpu_seconds), MAX(tree_rss_kb), AVG(read_bytes), AVG(write_bytes), MAX(cores), MAX(mem_total_kb)
+            FROM build_steps WHERE build_date = ? AND cpu_seconds IS NOT NULL GROUP BY package, phase""", (build_dates[-1],)).fetchall()
+        if resource_rows:
+            print(f"\nResources per stage on {build_dates[-1]} (cores busy on average, peak GB of the whole process tree, GB read and written):")
+            print(f"    {'package':<10} {'stage':<10} {'minutes':>8} {'cores':>6} {'peak GB':>8} {'GB/core':>8} {'read GB':>8} {'write GB':>8}  bound")
+            resource_rows.sort(key=lambda row: (row[0], phases.index(row[1]) if row[1] in phases else len(phases)))
+            for package, phase, duration, cpu_seconds, tree_rss_kb, read_bytes, write_bytes, cores, mem_total_kb in resource_rows:
+                cores_busy = cpu_seconds / max(duration, 1)
+                tree_rss_gb = (tree_rss_kb or 0) / 1024 / 1024
+                print(f"    {package:<10} {phase:<10} {duration / 60:>8.1f} {cores_busy:>6.1f} {tree_rss_gb:>8.2f} {tree_rss_gb / max(cores_busy, 1):>8.2f}"
+                      f" {(read_bytes or 0) / 1024**3:>8.2f} {(write_bytes or 0) / 1024**3:>8.2f}  {resource_bound(duration, cpu_seconds, tree_rss_kb, (read_bytes or 0) + (write_bytes or 0), cores, mem_total_kb)}")
+
+    last_run = timing_db_connection.execute("SELECT run FROM build_tasks ORDER BY start DESC LIMIT 1").fetchone()
+    if last_run:
+        graphs = {}
+        for graph, name, deps, start, duration in timing_db_connection.execute("SELECT graph, name, deps, start, duration FROM build_tasks WHERE run = ?", last_run):
+            graphs.setdefault(graph, {})[name] = (json.loads(deps), start, duration)
+        print(f"\nCritical path of the last run ({last_run[0]}):")
+        for graph, tasks in graphs.items():
+            graph_start = min(start for deps, start, duration in tasks.values())
+            graph_end = max(start + duration for deps, start, duration in tasks.values())
+            print(f"    {graph} {(graph_end - graph_start) / 60:.1f} minutes:")
+            for name in critical_path(tasks):
+                print(f"        {tasks[name][2] / 60:>8.1f}  {name}")
+    timing_db_connection.close()
+    return True
+
+def analyze_package_name(name):
+    # Package a directory (or clone) name in a log belongs to, if any.
+    name = name.decode(errors="replace")
+    if name.endswith("_dev"):
+        name = name[:-len("_dev")]
+    if name.startswith("metis-"):
+        name = "metis"
+    if name in ["cargo", "multirust"]:
+        name = "rust"
+    if name == "build":
+        # Only hpic2 builds straight in build/ under its directory.
+        name = "hpic2"
+    if name in dependent_package_deps or name == "hpic2":
+        return name
+    return None
+
+def analyze_timestamp(line):
+    # Seconds since the epoch (or since midnight, for bare times) of a line
+    # starting with a timestamp, otherwise None.
+    timestamp_match = analyze_timestamp_re.match(line)
+    if timestamp_match is None:
+        return None
+    date, hours, minutes, seconds = timestamp_match.groups()
+    seconds_of_day = int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    if date is None:
+        return seconds_of_day
+    return datetime.datetime.strptime(date.decode(), "%Y-%m-%d").timestamp() + seconds_of_day
+
+def analyze_lines_after(chunk, position):
+    # Up to analyze_context_lines whole lines of chunk from position on.
+    lines = []
+    while len(lines) < analyze_context_lines:
+        line_end = chunk.find(b"\n", position)
+        if line_end == -1:
+            break
+        lines.append(chunk[position:line_end])
+        position = line_end + 1
+    return lines
+
+def analyze_lines_before(chunk, position):
+    # Up to analyze_context_lines lines of chunk before the line starting at position.
+    lines = []
+    line_end = position - 1
+    while len(lines) < analyze_context_lines and line_end >= 0:
+        line_start = chunk.rfind(b"\n", 0, line_end) + 1
+        lines.insert(0, chunk[line_start:line_end])
+        line_end = line_start - 1
+    return lines
+
+def analyze_log(log_path):
+    # Split a (possibly huge, possibly gzipped) update log into one section
+    # per package and variant, and pull out the errors and warnings, with
+    # some context, and phase times if the lines have timestamps. One pass
+    # over the log, a chunk at a time, so memory use does not grow with it:
+    # only lines with one of analyze_markers get looked at one by one.
+    analyze_start = time.time()
+    open_log = gzip.open if log_path.endswith(".gz") else open
+    sections = {}
+    def get_section(name):
+        if name not in sections:
+            sections[name] = {"lines": 0, "bytes": 0, "errors": 0, "warnings": 0, "shown": [],
+                              "first_time": None, "last_time": None, "phase": None, "phase_start": None, "phases": {}}
+        return sections[name]
+    section_dir = None
+    section_name = "(not in any package)"
+    # The logs of run_build_script are <build dir>/logs/<package>.log(.gz)
+    logs_dir_path = os.path.dirname(os.path.abspath(log_path))
+    log_package = analyze_package_name(os.path.basename(log_path).split(".")[0].encode())
+    if os.path.basename(logs_dir_path) == "logs" and log_package:
+        section_dir = os.path.basename(os.path.dirname(logs_dir_path))
+        section_name = f"{section_dir}/{log_package}"
+    section = get_section(section_name)
+    line_number = 0
+    total_bytes = 0
+    previous_lines = collections.deque(maxlen=analyze_context_lines)
+    markers = None
+    # Shown errors/warnings still waiting for lines after them: [event, lines wanted]
+    pending = []
+
+    def count_lines(chunk, start, end):
+        lines = chunk.count(b"\n", start, end)
+        section["lines"] += lines
+        section["bytes"] += end - start
+        return lines
+
+    def saw_time(timestamp):
+        if timestamp is None:
+            return
+        if section["first_time"] is None:
+            section["first_time"] = timestamp
+        if section["phase"] is not None and section["phase_start"] is None:
+            section["phase_start"] = timestamp
+        section["last_time"] = timestamp
+
+    def set_phase(phase, timestamp):
+        if phase == section["phase"]:
+            return
+        if section["phase"] is not None and section["phase_start"] is not None and timestamp is not None:
+            section["phases"][section["phase"]] = section["phases"].get(section["phase"], 0) + timestamp - section["phase_start"]
+        section["phase"] = phase
+        section["phase_start"] = timestamp
+
+    with open_log(log_path, 'rb') as log_file:
+        leftover = b""
+        while True:
+            data = log_file.read(analyze_chunk_bytes)
+            chunk = leftover + data
+            if data:
+                # Only whole lines, the rest waits for the next chunk.
+                chunk_end = chunk.rfind(b"\n") + 1
+                if chunk_end == 0:
+                    leftover = chunk
+                    continue
+                chunk, leftover = chunk[:chunk_end], chunk[chunk_end:]
+            else:
+                leftover = b""
+                if not chunk:
+                    break
+                if not chunk.endswith(b"\n"):
+                    chunk += b"\n"
+            total_bytes += len(chunk)
+
+            if pending:
+                first_lines = analyze_lines_after(chunk, 0)
+                for event, lines_wanted in pending:
+                    event["after"] += first_lines[:lines_wanted]
+                # A chunk can be shorter than the context wanted
+                pending = [[event, lines_wanted - len(first_lines)] for event, lines_wanted in pending if lines_wanted > len(first_lines)]
+
+            if markers is None:
+                markers = analyze_markers
+                if any(analyze_timestamp(first_line) is not None for first_line in chunk[:100000].split(b"\n")[:1000]):
+                    markers = analyze_markers + analyze_phase_markers
+            line_markers = {}
+            for marker in markers:
+                marker_position = chunk.find(marker)
+                while marker_position != -1:
+                    line_start = chunk.rfind(b"\n", 0, marker_position) + 1
+                    line_markers.setdefault(line_start, marker)
+                    # On to the next line, one hit per line is enough.
+                    marker_position = chunk.find(b"\n", marker_position)
+                    marker_position = chunk.find(marker, marker_position)
+            position = 0
+            for line_start in sorted(line_markers):
+                line_end = chunk.find(b"\n", line_start)
+                line = chunk[line_start:line_end]
+                line_number += count_lines(chunk, position, line_start)
+                position = line_start
+                # Module environment dumps mention every package there is.
+                if line.startswith(b"os.environ[") or line.startswith(b"export ") or b"__LMOD" in line:
+                    continue
+                timestamp = analyze_timestamp(line)
+
+                new_dir, new_package = section_dir, None
+                section_match = None
+                if any(section_marker in line for section_marker in analyze_section_markers):
+                    section_match = analyze_section_re.search(line)
+                if section_match:
+                    new_package = analyze_package_name(section_match.group("package"))
+                    if new_package:
+                        new_dir = section_match.group("dir").decode(errors="replace")
+                clone_match = analyze_clone_re.search(line)
+                if clone_match and not section_match:
+                    new_package = analyze_package_name(clone_match.group("package"))
+                    # hpic2 gets cloned into a directory of its own
+                    if new_package == "hpic2":
+                        new_dir = None
+                if new_package:
+                    new_section_name = f"{new_dir}/{new_package}" if new_dir else new_package
+                    if section_name == new_package and new_dir and new_section_name not in sections:
+                        # Now we know which variant the output so far was from
+                        sections[new_section_name] = sections.pop(section_name)
+                        section_dir, section_name = new_dir, new_section_name
+                    if new_section_name != section_name:
+                        saw_time(timestamp)
+                        section_dir, section_name = new_dir, new_section_name
+                        section = get_section(section_name)
+                saw_time(timestamp)
+
+                if markers is not analyze_markers:
+                    for phase, phase_re in analyze_phase_res:
+                        if phase_re.search(line):
+                            set_phase(phase, timestamp)
+                            break
+                # Error and warning markers get looked for first, so this line has neither.
+                if line_markers[line_start] in analyze_section_markers:
+                    continue
+
+                kind = None
+                if analyze_error_re.search(line):
+                    kind = "error"
+                    section["errors"] += 1
+                elif analyze_warning_re.search(line):
+                    kind = "warning"
+                    section["warnings"] += 1
+                if kind and sum(1 for event in section["shown"] if event["kind"] == kind) < analyze_max_shown:
+                    before = analyze_lines_before(chunk, line_start)
+                    if len(before) < analyze_context_lines:
+                        before = list(previous_lines)[len(before) - analyze_context_lines:] + before
+                    after = analyze_lines_after(chunk, line_end + 1)
+                    event = {"kind": kind, "line_number": line_number + 1, "line": line, "before": before[-analyze_context_lines:], "after": after}
+                    section["shown"].append(event)
+                    if len(after) < analyze_context_lines:
+                        pending.append([event, analyze_context_lines - len(after)])
+
+            line_number += count_lines(chunk, position, len(chunk))
+            last_lines = analyze_lines_before(chunk, len(chunk))
+            for last_line in last_lines:
+                previous_lines.append(last_line)
+            if last_lines:
+                saw_time(analyze_timestamp(last_lines[-1]))
+            if not data:
+                break
+
+    for each_section in sections.values():
+        if each_section["phase"] is not None and each_section["phase_start"] is not None and each_section["last_time"] is not None:
+            each_section["phases"][each_section["phase"]] = each_section["phases"].get(each_section["phase"], 0) + each_section["last_time"] - each_section["phase_start"]
+
+    def show_line(line):
+        line = line.decode(errors="replace").rstrip()
+        return line if len(line) <= 300 else line[:300] + "..."
+
+    print(f"{log_path}: {total_bytes / 1024 / 1024:.1f} MB, {line_number} lines, read in {time.time() - analyze_start:.1f} seconds")
+    name_width = max(len(name) for name in sections)
+    print(f"    {'section':<{name_width}} {'lines':>9} {'MB':>8} {'errors':>7} {'warnings':>9} {'minutes':>8}")
+    for name, each_section in sections.items():
+        if not each_section["lines"]:
+            continue
+        minutes = "-"
+        if each_section["first_time"] is not None and each_section["last_time"] is not None:
+            minutes = f"{(each_section['last_time'] - each_section['first_time']) / 60:.1f}"
+        print(f"    {name:<{name_width}} {each_section['lines']:>9} {each_section['bytes'] / 1024 / 1024:>8.2f} {each_section['errors']:>7} {each_section['warnings']:>9} {minutes:>8}")
+        if each_section["phases"]:
+            print(f"    {'':<{name_width}} " + ", ".join(f"{phase} {seconds / 60:.1f} min" for phase, seconds in each_section["phases"].items()))
+    for kind in ["error", "warning"]:
+        for name, each_section in sections.items():
+            events = [event for event in each_section["shown"] if event["kind"] == kind]
+            if not events:
+                continue
+            print(f"\n{kind.capitalize()}s in {name} ({each_section[kind + 's']}, showing the first {len(events)}):")
+            for event in events:
+                print(f"  line {event['line_number']}:")
+                for before_line in event["before"]:
+                    print(f"    | {show_line(before_line)}")
+                print(f"    > {show_line(event['line'])}")
+                for after_line in event["after"]:
+                    print(f"    | {show_line(after_line)}")
     return True
+
+def slurm_task_resources(openmp_option, cuda_arch_option, build_type):
+    # (cpus, memory in GB) to ask for when building one variant.
+    if cuda_arch_option != None:
+        return slurm_cpus_per_task, slurm_cpus_per_task * slurm_cuda_mem_per_cpu_gb
+    return slurm_cpus_per_task, slurm_cpus_per_task * slurm_mem_per_cpu_gb
+
+def slurm_script_options(cpus, mem_gb, output, after_job_id=None):
+    sbatch_options = f"""#SBATCH --job-name=hpic2-update
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --mem={mem_gb}G
+#SBATCH --time={slurm_time_limit}
+#SBATCH --output={output}
+"""
+    if after_job_id:
+        # If that job fails, cancel this one instead of leaving it pending
+        # forever (and the driver waiting on it).
+        sbatch_options += f"#SBATCH --dependency=afterok:{after_job_id}\n#SBATCH --kill-on-invalid-dep=yes\n"
+    if slurm_partition:
+        sbatch_options += f"#SBATCH --partition={slurm_partition}\n"
+    if slurm_account:
+        sbatch_options += f"#SBATCH --account={slurm_account}\n"
+    return sbatch_options
+
+def write_slurm_script(script_path, sbatch_options, task_command, run_dir):
+    slurm_script = f"""#!/bin/bash
+{sbatch_options}
+module purge
+module load {python_module}
+export HPIC2_BUILD_DATE={current_datetime}
+export HPIC2_RUN_ID={build_run_id}
+export HPIC2_INCREMENTAL={"1" if incremental_builds else ""}
+cd {top_level_dir}
+python3 -u {os.path.abspath(__file__)} {task_command} {run_dir}
+"""
+    with open(script_path, 'w') as slurm_script_file:
+        slurm_script_file.write(slurm_script)
+    return script_path
+
+def submit_slurm_script(script_path):
+    sbatch_result = subprocess.run([sbatch_command, "--parsable", script_path], capture_output=True, text=True)
+    if sbatch_result.returncode != 0:
+        raise RuntimeError(f"sbatch failed for {script_path}: {sbatch_result.stderr}")
+    # --parsable prints "jobid" or "jobid;cluster"
+    return sbatch_result.stdout.strip().split(";")[0]
+
+def submit_slurm_build_once(run_dir):
+    # The build-once packages get their own job, which every array job waits on.
+    cpus, mem_gb = slurm_cpus_per_task, slurm_cpus_per_task * slurm_mem_per_cpu_gb
+    sbatch_options = slurm_script_options(cpus, mem_gb, f"{run_dir}/build_once.out")
+    script_path = write_slurm_script(f"{run_dir}/build_once.sbatch", sbatch_options, "slurm_build_once", run_dir)
+    job_id = submit_slurm_script(script_path)
+    print(f"Submitted build-once job {job_id}")
+    return job_id
+
+def submit_slurm_variants(run_dir, variants, after_job_id=None):
+    # One array job per distinct resource request (so CUDA variants can ask
+    # for more memory), one array task per variant. Returns the job ids.
+    tasks_by_resources = {}
+    for task_id, variant in enumerate(variants):
+        tasks_by_resources.setdefault(slurm_task_resources(*variant), []).append(task_id)
+
+    job_ids = []
+    for (cpus, mem_gb), task_ids in tasks_by_resources.items():
+        sbatch_options = slurm_script_options(cpus, mem_gb, f"{run_dir}/task-%a.out", after_job_id)
+        sbatch_options += f"#SBATCH --array={','.join(str(task_id) for task_id in task_ids)}\n"
+        array_script_path = write_slurm_script(f"{run_dir}/array-{cpus}cpus-{mem_gb}G.sbatch", sbatch_options, "slurm_task", run_dir)
+        job_id = submit_slurm_script(array_script_path)
+        print(f"Submitted array job {job_id} for tasks {task_ids} ({cpus} cpus, {mem_gb}G each)")
+        job_ids.append(job_id)
+    return job_ids
+
+def slurm_jobs_active(job_ids):
+    # Whether sacct still has any of job_ids (or their array tasks) in a
+    # state that is not final. None if sacct is not there or did not work,
+    # which leaves it to squeue.
+    try:
+        sacct_result = subprocess.run([sacct_command, "-n", "-X", "-P", "-o", "State", "-j", ",".join(job_ids)], capture_output=True, text=True)
+    except FileNotFoundError:
+        return None
+    if sacct_result.returncode != 0:
+        return None
+    # Like "CANCELLED by 1234".
+    return any(line.split()[0] in slurm_active_states for line in sacct_result.stdout.splitlines() if line.strip())
+
+def wait_for_slurm_jobs(job_ids):
+    poll_errors = 0
+    while True:
+        squeue_result = subprocess.run([squeue_command, "-h", "-o", "%i", "-j", ",".join(job_ids)], capture_output=True, text=True)
+        # squeue errors out with "Invalid job id" once it has forgotten
+        # about the jobs, which means they are done. Any other error (say
+        # slurmctld timing out) says nothing about them, so try again.
+        if squeue_result.returncode != 0 and "Invalid job id" not in squeue_result.stderr:
+            poll_errors += 1
+            if poll_errors >= slurm_max_poll_errors:
+                raise RuntimeError(f"squeue failed {poll_errors} times in a row, last with: {squeue_result.stderr.strip()}")
+            print(f"squeue failed ({squeue_result.stderr.strip()}), trying again")
+            time.sleep(slurm_poll_seconds)
+            continue
+        poll_errors = 0
+        if squeue_result.returncode == 0 and squeue_result.stdout.strip():
+            print(f"{len(squeue_result.stdout.split())} array tasks still queued or running...")
+        elif slurm_jobs_active(job_ids):
+            # squeue lost them, but they are not done as far as the
+            # accounting is concerned.
+            print("squeue no longer lists the array tasks, but sacct says they are not done yet...")
+        else:
+            return True
+        time.sleep(slurm_poll_seconds)
+
+def slurm_build_once(run_dir):
+    # Runs as the build-once job, and tells the array tasks where things went.
+    # Returns False if anything failed, which fails the job so Slurm cancels
+    # the array jobs (every variant needs all of these) instead of running
+    # them for nothing.
+    make_build_directories()
+    start_jobserver()
+    build_once_builds, results, task_deps = build_once_modules()
+    print_build_summary(results, task_deps)
+    clean_scratch()
+    if any(exit_code != 0 for exit_code in results.values()):
+        return False
+    with open(f"{run_dir}/build_once.json", 'w') as build_once_file:
+        json.dump([[package, build_type, path, cache_key] for (package, build_type), (path, cache_key) in build_once_builds.items()], build_once_file, indent=4)
+    return True
+
+def slurm_task(run_dir):
+    # Runs inside one array task: build one variant, write its dated
+    # modulefiles and report back to the driver. "latest" is left to the
+    # driver so it only moves once the task has reported in.
+    task_id = int(os.environ["SLURM_ARRAY_TASK_ID"])
+    with open(f"{run_dir}/variants.json") as variants_file:
+        openmp_option, cuda_arch_option, build_type = json.load(variants_file)[task_id]
+
+    with open(f"{run_dir}/build_once.json") as build_once_file:
+        build_once_builds = {(package, build_type): (path, cache_key) for package, build_type, path, cache_key in json.load(build_once_file)}
+
+    make_build_directories()
+    start_jobserver()
+    package_tasks = prepare_build_dependent(openmp_option, cuda_arch_option, build_type, build_once_builds)
+    option_spec_string = f"{'+' if openmp_option else '~'}openmp-cuda-arch-{str(cuda_arch_option)}"
+    results = run_build_graph(package_tasks, dependent_package_deps, label=f"[{option_spec_string} {build_type}] ")
+    built_everything = all(exit_code == 0 for exit_code in results.values())
+    if built_everything:
+        write_dependent_modulefile(openmp_option, cuda_arch_option, build_type, finalize=False)
+    # hpic2 only builds against Release deps, and has to use today's dated
+    # modulefile since "latest" has not moved yet.
+    built_hpic2 = False
+    if build_type == "Release" and built_everything:
+        built_hpic2 = build_release_version_hpic2(openmp_option, cuda_arch_option, deps_version=current_datetime, finalize=False)
+    clean_scratch()
+
+    task_report = {
+        "variant": [openmp_option, cuda_arch_option, build_type],
+        "results": results,
+        "hpic2": built_hpic2,
+    }
+    with open(f"{run_dir}/task-{task_id}.json", 'w') as report_file:
+        json.dump(task_report, report_file, indent=4)
+    # The driver goes by the report, this is for sacct and the task's log.
+    return built_everything and (built_hpic2 or build_type != "Release")
+
+def update_slurm():
+    print("Updating hpic2 and dependencies on ICC with a Slurm job array...")
+    if not check_upstream_changes(built_upstream_packages("Release" in build_types_arr)):
+        return True
+    make_build_directories()
+    start_trash_deletion()
+    # Done here once so the array tasks do not all try to download cmake.
+    make_cmake_module()
+    update_mirrors()
+    setup_ccache()
+
+    variants = list(itertools.product(openmp_options, cuda_arch_options, build_types_arr))
+    run_dir = f"{top_level_dir}/builds/slurm/{current_datetime}-{int(time.time())}"
+    os.makedirs(run_dir)
+    with open(f"{run_dir}/variants.json", 'w') as variants_file:
+        json.dump(variants, variants_file, indent=4)
+
+    build_once_job_id = submit_slurm_build_once(run_dir)
+    job_ids = submit_slurm_variants(run_dir, variants, after_job_id=build_once_job_id)
+    wait_for_slurm_jobs([build_once_job_id] + job_ids)
+
+    if not os.path.exists(f"{run_dir}/build_once.json"):
+        print(f"The build-once job failed, so Slurm cancelled the variants, see {run_dir}/build_once.out")
+
+    # Move "latest" for every variant that reported back with everything
+    # built, leave the rest.
+    built_everything = True
+    results = {}
+    task_deps = {}
+    for task_id, (openmp_option, cuda_arch_option, build_type) in enumerate(variants):
+        option_spec_string = f"{'+' if openmp_option else '~'}openmp-cuda-arch-{str(cuda_arch_option)}"
+        report_path = f"{run_dir}/task-{task_id}.json"
+        if not os.path.exists(report_path):
+            print(f"Task {task_id} ({option_spec_string} {build_type}) never reported back, see {run_dir}/task-{task_id}.out")
+            built_everything = False
+            continue
+        with open(report_path) as report_file:
+            task_report = json.load(report_file)
+        variant_name = f"hpic2deps-{option_spec_string}-{build_type}"
+        for package, exit_code in task_report["results"].items():
+            results[f"{variant_name}/{package}"] = exit_code
+            task_deps[f"{variant_name}/{package}"] = [f"{variant_name}/{dep}" for dep in dependent_package_deps[package]]
+        if build_type == "Release":
+            # Same as update_parallel, hpic2 counts as depending on all of its deps.
+            task_deps[f"hpic2-{option_spec_string}"] = [f"{variant_name}/{package}" for package in task_report["results"]]
+            if all(exit_code == 0 for exit_code in task_report["results"].values()):
+                results[f"hpic2-{option_spec_string}"] = 0 if task_report["hpic2"] else 1
+            else:
+                results[f"hpic2-{option_spec_string}"] = None
+        if any(exit_code != 0 for exit_code in task_report["results"].values()):
+            print(f"Task {task_id} ({option_spec_string} {build_type}) did not build everything, leaving its latest modulefile alone")
+            built_everything = False
+            continue
+        finalize_modulefile(f"{top_level_dir}/modulefiles/hpic2deps/{option_spec_string}/{build_type}", f"{top_level_dir}/builds/hpic2deps-{option_spec_string}-{build_type}-{current_datetime}")
+        if task_report["hpic2"]:
+            finalize_modulefile(f"{top_level_dir}/modulefiles/hpic2/{option_spec_string}", f"{top_level_dir}/builds/hpic2-{option_spec_string}-{current_datetime}")
+        elif build_type == "Release":
+            print(f"Task {task_id} ({option_spec_string} {build_type}): hpic2 did not build")
+            built_everything = False
+    if results:
+        print_build_summary(results, task_deps)
+    report_ccache_stats()
+    slim_old_builds()
+    if dedup_enabled:
+        dedup_builds()
+    wait_for_trash()
+    if built_everything:
+        write_upstream_lock(built_upstream_packages("Release" in build_types_arr))
+
+    print(f"""
+Done! If you haven't already, update your module search path with
+
+module use {top_level_dir}/modulefiles
+    """)
+
+    return built_everything
     
 if __name__ == "__main__":
     help_message = f"""
@@ -586,12 +3265,21 @@ before using this. This script will build the most recent versions of hpic2
 and its dependencies, creating modulefiles for all of them, and deleting old
 versions. Currently, you can update once per day; if you run this more than once
 in a day, it will delete the builds from earlier in the day and proceed with
-a fresh build. You may run this for the first time in an empty directory.
+a fresh build, unless you add --incremental, which picks the builds from
+earlier in the day up where they left off. If an update fails, run resume to
+continue it from the last step every package got through. You may run this for the first time in an empty directory.
 Afterward, update by running from inside the same directory.
 Usage:
 
 python3 {os.path.basename(__file__)} update
-python3 {os.path.basename(__file__)} update_mpi
+python3 {os.path.basename(__file__)} update_parallel
+python3 {os.path.basename(__file__)} update_slurm
+python3 {os.path.basename(__file__)} update --incremental
+python3 {os.path.basename(__file__)} update --force
+python3 {os.path.basename(__file__)} resume
+python3 {os.path.basename(__file__)} report
+python3 {os.path.basename(__file__)} dedup
+python3 {os.path.basename(__file__)} analyze_log path/to/update.log
 python3 {os.path.basename(__file__)} "openmp options"
 python3 {os.path.basename(__file__)} "openmp options" "cuda arch options"
     """
@@ -600,12 +3288,41 @@ python3 {os.path.basename(__file__)} "openmp options" "cuda arch options"
     #    update()
     #elif len(sys.argv) == 3 and sys.argv[1] == "update":
     
-    MPI_update = False
+    parallel_update = False
+
+    if "--incremental" in sys.argv:
+        sys.argv.remove("--incremental")
+        incremental_builds = True
+    if "--force" in sys.argv:
+        sys.argv.remove("--force")
+        force_update = True
     
-    if len(sys.argv) == 2 and sys.argv[1] == "update":
-        MPI_update = False
-    elif len(sys.argv) == 2 and sys.argv[1] == "update_mpi":
-        MPI_update = True #This option is untested (4/10/2025) and will remain that way for a while.
+    # The updates exit with 1 when anything did not build, so cron and
+    # update.sh can tell.
+    if len(sys.argv) == 2 and sys.argv[1] == "update_slurm":
+        sys.exit(0 if update_slurm() else 1)
+    elif len(sys.argv) == 3 and sys.argv[1] == "slurm_task":
+        # Only meant to be run by the array jobs update_slurm submits.
+        sys.exit(0 if slurm_task(sys.argv[2]) else 1)
+    elif len(sys.argv) == 3 and sys.argv[1] == "slurm_build_once":
+        # Same, for the build-once job.
+        sys.exit(0 if slurm_build_once(sys.argv[2]) else 1)
+    elif len(sys.argv) == 3 and sys.argv[1] == "analyze_log":
+        analyze_log(sys.argv[2])
+        sys.exit(0)
+    elif len(sys.argv) == 2 and sys.argv[1] == "dedup":
+        dedup_builds()
+        sys.exit(0)
+    elif len(sys.argv) == 2 and sys.argv[1] == "report":
+        report()
+        sys.exit(0)
+    elif len(sys.argv) == 2 and sys.argv[1] == "resume":
+        sys.exit(0 if update_parallel(resume=True) else 1)
+    elif len(sys.argv) == 2 and sys.argv[1] == "update":
+        parallel_update = False
+    elif len(sys.argv) == 2 and sys.argv[1] in ["update_parallel", "update_mpi"]:
+        # update_mpi never worked, it is just another name for update_parallel now.
+        parallel_update = True
     elif len(sys.argv) == 3: # not tested yet
         openmp_option = sys.argv[1]
     elif len(sys.argv) == 4: # also not tested yet 
@@ -614,7 +3331,7 @@ python3 {os.path.basename(__file__)} "openmp options" "cuda arch options"
     else:
         print(help_message)
     
-    if MPI_update:
-        update_mpi()
+    if parallel_update:
+        sys.exit(0 if update_parallel() else 1)
     else:
-        update()
+        sys.exit(0 if update() else 1)
@@ -1,3 +1,11 @@
 module load python/3.13.2
 export PYTHON_UNBUFFERED=1
-(sh -c "python3 -u campuscluster_update.py update" &> output_update_spack_py.log) & echo $! > output_update_spack_py.pid # Or whichever one is actually working now
\ No newline at end of file
+# The update runs in the background (pid in output_update_spack_py.pid), and
+# its exit code (1 if anything did not build) goes to
+# output_update_spack_py.status. With --wait this waits for it and exits with
+# that, say for cron.
+(python3 -u campus_cluster_update_3_fixing_mpi_errors.py update > output_update_spack_py.log 2>&1; status=$?; echo $status > output_update_spack_py.status; exit $status) & echo $! > output_update_spack_py.pid
+if [ "$1" = "--wait" ]; then
+    wait $!
+    exit $?
+fi